@@ -0,0 +1,368 @@
+"""
+Micro-benchmarks for hot paths in the firmware
+
+Runs on both MicroPython Unix port and CPython.
+On CPython, timebased.py from emlearn-micropython must be on PYTHONPATH
+
+    micropython firmware/benchmark.py
+    PYTHONPATH=emlearn-micropython/examples/har_trees python firmware/benchmark.py
+"""
+
+import gc
+import sys
+import array
+
+sys.path.insert(0, 'firmware/')
+
+from core import MedianFilter, median
+from core import window_stats, mean, energy_xyz, window_stats_int
+from core import WindowBuffer, SlidingWindowStats, GravitySplitter
+import core
+import decode
+from compat import ticks_us, ticks_diff
+
+
+def run_timed(func, repeats):
+    """
+    Return the average time per call, in microseconds
+    """
+    start = ticks_us()
+    for i in range(repeats):
+        func(i)
+    duration = ticks_diff(ticks_us(), start)
+    return duration / repeats
+
+
+def measure_allocated(func, repeats=100):
+    """
+    Return the number of bytes allocated on heap per call, or None if not supported
+    """
+    if not hasattr(gc, 'mem_alloc'):
+        return None
+
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.mem_alloc()
+        for i in range(repeats):
+            func(i)
+        after = gc.mem_alloc()
+    finally:
+        gc.enable()
+    return (after - before) // repeats
+
+
+def bench_median_filter(repeats=2000):
+
+    inputs = [ ((i*7) % 11) / 10.0 for i in range(64) ]
+
+    for length in (3, 5, 9):
+
+        # Reference. Same as what StateMachine used to do
+        history = [0.0] * length
+        def reference(i):
+            nonlocal history
+            history = history[1:]
+            history.append(inputs[i % 64])
+            return median(history)
+
+        f = MedianFilter(length)
+        def running(i):
+            return f.push(inputs[i % 64])
+
+        ref_us = run_timed(reference, repeats)
+        new_us = run_timed(running, repeats)
+        # bytes per push, None on CPython
+        ref_bytes = measure_allocated(reference)
+        new_bytes = measure_allocated(running)
+        print('bench-median-filter', length, round(ref_us, 2), round(new_us, 2), ref_bytes, new_bytes)
+
+
+def make_window(length):
+    xs = array.array('h', ( ((i*1237) % 8000) - 4000 for i in range(length) ))
+    ys = array.array('h', ( 16000 + ((i*311) % 2000) for i in range(length) ))
+    zs = array.array('h', ( ((i*733) % 4000) - 2000 for i in range(length) ))
+    return xs, ys, zs
+
+
+def bench_window_stats(repeats=200):
+
+    for length in (50, 128):
+        xs, ys, zs = make_window(length)
+
+        def reference(i):
+            orientation = mean(xs), mean(ys), mean(zs)
+            return energy_xyz(xs, ys, zs, orientation)
+
+        def fused(i):
+            return window_stats(xs, ys, zs)
+
+        ref_us = run_timed(reference, repeats)
+        new_us = run_timed(fused, repeats)
+        print('bench-window-stats', length, round(ref_us, 2), round(new_us, 2))
+
+
+def bench_window_stats_int(repeats=200):
+
+    for length in (50, 128):
+        xs, ys, zs = make_window(length)
+
+        def floats(i):
+            return window_stats(xs, ys, zs)
+
+        def ints(i):
+            return window_stats_int(xs, ys, zs)
+
+        float_us = run_timed(floats, repeats)
+        int_us = run_timed(ints, repeats)
+        float_bytes = measure_allocated(floats)
+        int_bytes = measure_allocated(ints)
+        print('bench-window-stats-int', length,
+            round(float_us, 2), round(int_us, 2), float_bytes, int_bytes)
+
+
+def bench_sliding_window_stats(repeats=200, window_length=128):
+
+    for hop_length in (16, 64):
+        xs, ys, zs = make_window(hop_length)
+
+        buffers = [ WindowBuffer(window_length) for _ in range(3) ]
+        def recompute(i):
+            for buf, values in zip(buffers, (xs, ys, zs)):
+                buf.push(values)
+            wx, wy, wz = [ buf.window() for buf in buffers ]
+            return window_stats(wx, wy, wz)
+
+        sliding = SlidingWindowStats(window_length)
+        def incremental(i):
+            sliding.push(xs, ys, zs)
+            return sliding.stats()
+
+        full_us = run_timed(recompute, repeats)
+        incremental_us = run_timed(incremental, repeats)
+        print('bench-sliding-window-stats', window_length, hop_length,
+            round(full_us, 2), round(incremental_us, 2))
+
+
+def bench_gravity_splitter(repeats=100, hop_length=50):
+
+    xs, ys, zs = make_window(hop_length)
+    mx, my, mz = make_window(hop_length)
+
+    per_sample = GravitySplitter(samplerate=50)
+    def samples(i):
+        for j in range(hop_length):
+            per_sample.process((xs[j], ys[j], zs[j]))
+
+    block = GravitySplitter(samplerate=50)
+    def blocks(i):
+        block.process_block(xs, ys, zs, mx, my, mz)
+
+    sample_us = run_timed(samples, repeats)
+    block_us = run_timed(blocks, repeats)
+    # throughput in samples per second
+    print('bench-gravity-splitter', hop_length,
+        round(sample_us, 2), round(block_us, 2),
+        int(hop_length * 1e6 / sample_us), int(hop_length * 1e6 / block_us))
+
+
+def bench_decode_chunk(repeats=200, n=50):
+
+    # XIAO: GxGyGzAxAyAz little-endian, 12 bytes per sample
+    chunk = bytearray((i*7) % 256 for i in range(12*n))
+    xs, ys, zs = make_window(n)
+    record = array.array('h', (0 for _ in range(6*n)))
+
+    def separate(i):
+        decode.deinterleave_samples_xiao(chunk, xs, ys, zs, rowstride=12, offset=6, format='<hhh')
+        decode.decode_samples(chunk, record, rowstride=12, format='<hhhhhh')
+
+    def fused(i):
+        decode.decode_chunk_xiao(chunk, xs, ys, zs, record, rowstride=12, format='<hhhhhh', accel_index=3)
+
+    # FIFO read directly into record array
+    def direct(i):
+        decode.decode_chunk_xiao(record, xs, ys, zs, record, rowstride=12, format='<hhhhhh', accel_index=3)
+
+    separate_us = run_timed(separate, repeats)
+    fused_us = run_timed(fused, repeats)
+    direct_us = run_timed(direct, repeats)
+    print('bench-decode-chunk', n, round(separate_us, 2), round(fused_us, 2), round(direct_us, 2))
+
+
+def bench_kernels(repeats=200):
+    """
+    Compare selected kernels (native/viper accelerated, if available) against pure-Python versions
+    """
+
+    n = 50
+    xs, ys, zs = make_window(n)
+    orientation = mean(xs), mean(ys), mean(zs)
+    # XIAO: GxGyGzAxAyAz little-endian, 12 bytes per sample
+    chunk = bytearray((i*7) % 256 for i in range(12*n))
+    record = array.array('h', (0 for _ in range(6*n)))
+
+    kernels = [
+        ('mean', lambda m: m.mean(xs), lambda m: m.mean_python(xs), core),
+        ('energy_xyz', lambda m: m.energy_xyz(xs, ys, zs, orientation),
+            lambda m: m.energy_xyz_python(xs, ys, zs, orientation), core),
+        ('deinterleave_samples_xiao',
+            lambda m: m.deinterleave_samples_xiao(chunk, xs, ys, zs, rowstride=12, offset=6, format='<hhh'),
+            lambda m: m.deinterleave_samples_xiao_python(chunk, xs, ys, zs, rowstride=12, offset=6, format='<hhh'),
+            decode),
+        ('deinterleave_samples_m5stick',
+            lambda m: m.deinterleave_samples_m5stick(chunk, xs, ys, zs, rowstride=12, offset=6, format='>hhh'),
+            lambda m: m.deinterleave_samples_m5stick_python(chunk, xs, ys, zs, rowstride=12, offset=6, format='>hhh'),
+            decode),
+        ('decode_samples',
+            lambda m: m.decode_samples(chunk, record, rowstride=12, format='<hhhhhh'),
+            lambda m: m.decode_samples_python(chunk, record, rowstride=12, format='<hhhhhh'),
+            decode),
+    ]
+
+    print('bench-kernels-native', decode.kernels_native is not None)
+    print('| kernel | python (us) | selected (us) | speedup |')
+    print('|--------|-------------|---------------|---------|')
+    for name, selected, python, module in kernels:
+        python_us = run_timed(lambda i: python(module), repeats)
+        selected_us = run_timed(lambda i: selected(module), repeats)
+        speedup = python_us / selected_us
+        print('|', name, '|', round(python_us, 2), '|', round(selected_us, 2), '|', round(speedup, 2), '|')
+
+
+def bench_model_load(repeats=5):
+    """
+    Compare boot time and RAM for loading the model from CSV and from binary format
+    """
+    try:
+        import emlearn_trees
+    except ImportError:
+        print('bench-model-load', 'skipped, emlearn_trees not available')
+        return
+
+    processor = core.DataProcessor.__new__(core.DataProcessor)
+    for path in ('firmware/brushing.trees.csv', 'firmware/brushing.trees.bin'):
+        load_us = run_timed(lambda i: processor.load_model(path), repeats)
+
+        # memory retained by the loaded model
+        gc.collect()
+        before = gc.mem_alloc() if hasattr(gc, 'mem_alloc') else None
+        model = processor.load_model(path)
+        gc.collect()
+        retained = None if before is None else gc.mem_alloc() - before
+        print('bench-model-load', path, round(load_us, 2), retained)
+        del model
+
+
+def bench_cascade(stage1_path='firmware/brushing_stage1.trees.bin', pattern='.npy',
+        data_dir='data/jonnor-brushing-1/testdata', hop_length=50):
+    """
+    Evaluate the model cascade on recorded sessions: time per window, and agreement with the full model
+
+    Brushing time is also given for the first stage alone, deciding every window
+    """
+    import os
+    from process import read_data_file, process_file
+
+    try:
+        os.stat(stage1_path)
+        full = core.DataProcessor()
+        cascade = core.DataProcessor(cascade_model_path=stage1_path)
+    except (OSError, ImportError) as e:
+        print('bench-cascade', 'skipped', e)
+        return
+
+    xs = core.empty_array('h', hop_length)
+    ys = core.empty_array('h', hop_length)
+    zs = core.empty_array('h', hop_length)
+
+    print('| session | windows | full model (%) | full (us) | cascade (us) | agreement (%) | brushing time full/cascade/stage 1 |')
+    print('|---------|---------|----------------|-----------|--------------|---------------|------------------------------------|')
+    for f in sorted(os.listdir(data_dir)):
+        if not f.endswith(pattern):
+            continue
+        path = data_dir + '/' + f
+        full.windows_cascaded = 0
+        cascade.windows_cascaded = 0
+        windows = 0
+        agree = 0
+        full_us = 0
+        cascade_us = 0
+        for xyz in read_data_file(path, chunk_length=hop_length):
+            n = len(xyz) // 3
+            if n != hop_length:
+                break
+            for i in range(n):
+                xs[i] = xyz[(i*3)+0]
+                ys[i] = xyz[(i*3)+1]
+                zs[i] = xyz[(i*3)+2]
+
+            start = ticks_us()
+            _, a = full.process(xs, ys, zs)
+            mid = ticks_us()
+            _, b = cascade.process(xs, ys, zs)
+            end = ticks_us()
+            full_us += ticks_diff(mid, start)
+            cascade_us += ticks_diff(end, mid)
+            windows += 1
+            agree += int((a >= 0.5) == (b >= 0.5))
+
+        full_time = max(r[4] for r in process_file(path))
+        cascade_time = max(r[4] for r in process_file(path, cascade_model_path=stage1_path))
+        stage1_time = max(r[4] for r in process_file(path, cascade_model_path=stage1_path,
+            cascade_band=(0.5, 0.5)))
+        fallthrough = 100.0 * (windows - cascade.windows_cascaded) / max(windows, 1)
+        print('|', f, '|', windows, '|', round(fallthrough, 1), '|',
+            round(full_us / max(windows, 1), 1), '|', round(cascade_us / max(windows, 1), 1), '|',
+            round(100.0 * agree / max(windows, 1), 1), '|', full_time, '/', cascade_time, '/', stage1_time, '|')
+
+
+def bench_record_encode(data_dir='data/jonnor-brushing-1/har_record', hop_length=50, items=3):
+    """
+    Compressed recording format on the recorded data: compression ratio, and encode time per hop
+    """
+    import os
+    from process import read_data_file
+    import recording
+
+    try:
+        files = sorted(f for f in os.listdir(data_dir) if f.endswith('.npy'))
+    except OSError as e:
+        print('bench-record-encode', 'skipped', e)
+        return
+
+    out = bytearray(recording.HRZ_MAX_VALUE_BYTES*items*hop_length)
+    hops = 0
+    raw = 0
+    encoded = 0
+    encode_us = 0
+    for f in files:
+        for values in read_data_file(data_dir + '/' + f, chunk_length=hop_length, n_features=items):
+            start = ticks_us()
+            shift = recording.zero_low_bits(recording.or_int16(values))
+            size = recording.encode_delta_varint(values, out, items, shift)
+            encode_us += ticks_diff(ticks_us(), start)
+            hops += 1
+            raw += 2*len(values)
+            encoded += recording.HRZ_BLOCK_HEADER_SIZE + size
+
+    print('bench-record-encode', 'files', len(files), 'hops', hops,
+        'ratio', round(raw / max(encoded, 1), 2), 'bytes-per-sample', round(encoded / max(hops*hop_length, 1), 2),
+        'us-per-hop', round(encode_us / max(hops, 1), 1))
+
+
+def main():
+    print('bench-implementation', sys.implementation.name)
+    bench_median_filter()
+    bench_window_stats()
+    bench_window_stats_int()
+    bench_sliding_window_stats()
+    bench_gravity_splitter()
+    bench_decode_chunk()
+    bench_kernels()
+    bench_model_load()
+    bench_cascade()
+    bench_record_encode()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Binary log with fixed-size records in a preallocated ring buffer
+
+Logging a record only packs a few integers, no formatting or I/O.
+Records are drained later on demand, and decoded on the host:
+
+    python firmware/binlog.py serial-capture.txt
+    python firmware/binlog.py log.bin
+"""
+
+import struct
+
+from compat import ticks_ms
+
+# ticks_ms, event, a, v0-v4
+RECORD_FORMAT = '<IBBhhhhh'
+RECORD_SIZE = 16
+
+# StateMachine states, as logged
+STATES = ('sleep', 'idle', 'brushing', 'done', 'failed')
+
+# Events. Values are logged as int16, scaled by the given factor
+EVENT_INPUTS = 1
+EVENT_PROGRESS = 2
+EVENT_LATENCY = 3
+EVENT_TRANSITION = 4
+EVENT_SM_NEXT = 5
+EVENT_SAMPLERATE = 6
+
+# id: (name, name of a, (name, scale) of values)
+EVENTS = {
+    EVENT_INPUTS: ('main-inputs', 'state', (('brushing', 100), ('motion', 100))),
+    EVENT_PROGRESS: ('main-progress', 'progress_state', (('brushing_time', 10), ('progress', 1))),
+    EVENT_LATENCY: ('main-latency', None, (('latency_ms', 1), )),
+    EVENT_TRANSITION: ('sm-transition', 'state', (('next_state', 1), )),
+    EVENT_SM_NEXT: ('sm-next', 'state', (('v0', 100), ('v1', 100), ('v2', 100))),
+    EVENT_SAMPLERATE: ('main-samplerate', None, (('samplerate', 1), )),
+}
+
+def scaled(value, scale):
+    """
+    Convert value to int16 with scale, saturating
+    """
+    v = int(value * scale)
+    if v > 32767:
+        return 32767
+    if v < -32768:
+        return -32768
+    return v
+
+def state_index(state):
+    return STATES.index(state)
+
+
+class BinaryLog():
+    """
+    Ring buffer of binary log records
+
+    When full, the oldest records are overwritten and counted in dropped.
+    log() does not allocate
+    """
+
+    def __init__(self, records=256):
+        self.records = records
+        self.buffer = bytearray(RECORD_SIZE * records)
+        self.view = memoryview(self.buffer)
+        self.head = 0 # next record to write
+        self.count = 0
+        self.dropped = 0
+
+    def log(self, event, a=0, v0=0, v1=0, v2=0, v3=0, v4=0):
+        struct.pack_into(RECORD_FORMAT, self.buffer, self.head * RECORD_SIZE,
+            ticks_ms() & 0xFFFFFFFF, event, a, v0, v1, v2, v3, v4)
+        self.head += 1
+        if self.head == self.records:
+            self.head = 0
+        if self.count == self.records:
+            self.dropped += 1
+        else:
+            self.count += 1
+
+    def drain(self, write):
+        """
+        Pass pending records to write(), oldest first, as one or two memoryviews
+
+        Returns the number of records drained
+        """
+        n = self.count
+        if n == 0:
+            return 0
+        start = self.head - n
+        if start < 0:
+            start += self.records
+            write(self.view[start*RECORD_SIZE:])
+            write(self.view[:self.head*RECORD_SIZE])
+        else:
+            write(self.view[start*RECORD_SIZE:self.head*RECORD_SIZE])
+        self.count = 0
+        return n
+
+    def report(self, prefix='binlog'):
+        """
+        Print pending records as hex, for capture over serial
+        """
+        from binascii import hexlify
+        def write(data):
+            for offset in range(0, len(data), RECORD_SIZE):
+                print(prefix, hexlify(data[offset:offset+RECORD_SIZE]).decode())
+        self.drain(write)
+        print(prefix + '-dropped', self.dropped)
+
+
+def decode_records(data):
+    """
+    Decode binary records. Returns generator of (ticks_ms, name, dict of values)
+    """
+    for offset in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+        ticks, event, a, *values = struct.unpack_from(RECORD_FORMAT, data, offset)
+        name, a_name, fields = EVENTS.get(event, ('unknown-{}'.format(event), 'a', ()))
+        out = {}
+        if a_name == 'state':
+            out[a_name] = STATES[a] if a < len(STATES) else a
+        elif a_name is not None:
+            out[a_name] = a
+        for (field, scale), v in zip(fields, values):
+            out[field] = v / scale if scale != 1 else v
+        if name == 'sm-transition':
+            out['next_state'] = STATES[out['next_state']]
+        yield ticks, name, out
+
+
+def read_log(path, prefix='binlog'):
+    """
+    Read records from a binary log file, or from a text capture of the serial output
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    lines = [ line.split() for line in data.splitlines() ]
+    if any(len(tok) == 2 and tok[0] == prefix.encode() for tok in lines):
+        # serial capture, hex lines
+        data = b''.join(bytes.fromhex(tok[1].decode()) for tok in lines
+            if len(tok) == 2 and tok[0] == prefix.encode())
+    return data
+
+
+def main():
+    import sys
+
+    for ticks, name, values in decode_records(read_log(sys.argv[1])):
+        print(ticks, name, *('{}={}'.format(k, v) for k, v in values.items()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""
+Fallbacks for the MicroPython-specific time and asyncio functions
+
+So the firmware modules can also run on CPython, for testing and benchmarks.
+On CPython, ticks do not wrap around
+"""
+
+import time
+import asyncio
+
+if hasattr(time, 'ticks_ms'):
+    ticks_ms = time.ticks_ms
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+else:
+    # CPython
+    def ticks_ms():
+        return time.perf_counter_ns() // 1000000
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+    def ticks_diff(end, start):
+        return end - start
+
+# Blocking sleep, for use in threads
+if hasattr(time, 'sleep_ms'):
+    thread_sleep_ms = time.sleep_ms
+else:
+    def thread_sleep_ms(ms):
+        time.sleep(ms / 1000.0)
+
+# Sleep in a task
+if hasattr(asyncio, 'sleep_ms'):
+    sleep_ms = asyncio.sleep_ms
+else:
+    def sleep_ms(ms):
+        return asyncio.sleep(ms / 1000.0)
@@ -6,12 +6,15 @@ Toothbrush timer using accelerometer and machine learning
 import math
 import array
 import gc
-import time
+import struct
 import asyncio
 
-import emlearn_trees
 import timebased
 
+import binlog
+import compat
+from compat import ticks_diff
+
 def empty_array(typecode, length, value=0):
     return array.array(typecode, (value for _ in range(length)))
 
@@ -34,14 +37,175 @@ def median(values):
     #print('median', out, values)
     return out 
 
-def buffer_push_end(values : list, new, length):
-    assert len(values) <= length
-    # NOTE: mutates values
-    if len(values) == length:
-        values = values[1:]
-    values.append(new)
-    assert len(values) <= length
-    return values
+class MedianFilter():
+    """
+    Running median over the last N values
+
+    Uses a preallocated ring buffer, plus a sorted copy of the same values
+    that is updated by insertion/deletion. So push() does no allocation and no full sort.
+    Gives the same output as median() over the last N values.
+    """
+
+    def __init__(self, length, value=0.0):
+        if length < 1:
+            raise ValueError('length must be 1 or more')
+        self.length = length
+
+        # NOTE: lists of references, not array.array
+        # avoids boxing a new float on every read with MicroPython
+        self.values = [value] * length
+        self.ordered = [value] * length
+        self.index = 0 # next position to write in ring buffer
+
+    def reset(self, value=0.0):
+        for i in range(self.length):
+            self.values[i] = value
+            self.ordered[i] = value
+        self.index = 0
+
+    def push(self, new):
+        L = self.length
+        ordered = self.ordered
+
+        # replace oldest value in ring buffer
+        old = self.values[self.index]
+        self.values[self.index] = new
+        self.index += 1
+        if self.index == L:
+            self.index = 0
+
+        # find the old value in sorted list
+        i = 0
+        while i < L-1 and ordered[i] != old:
+            i += 1
+
+        # shift neighbours to keep sorted order, then insert new value
+        if new > old:
+            while i < L-1 and ordered[i+1] < new:
+                ordered[i] = ordered[i+1]
+                i += 1
+        else:
+            while i > 0 and ordered[i-1] > new:
+                ordered[i] = ordered[i-1]
+                i -= 1
+        ordered[i] = new
+
+        return self.median()
+
+    def median(self):
+        L = self.length
+        if (L % 2) == 1:
+            return self.ordered[L//2]
+        else:
+            l = self.ordered[(L//2)-1]
+            h = self.ordered[(L//2)-0]
+            return (l+h)/2
+
+
+class WindowBuffer():
+    """
+    Sliding window over a stream of samples, for one axis
+
+    Mirrored ring buffer: every sample is stored twice, length apart.
+    So the latest window is always contiguous, and window() returns it without copying.
+    Cost of push() scales with the number of new samples, not the window length.
+    """
+
+    def __init__(self, length, typecode='h'):
+        self.length = length
+        self.data = empty_array(typecode, 2*length)
+        self.view = memoryview(self.data)
+        self.index = 0 # next position to write, also start of window
+        self.empty = True
+
+    def push(self, values):
+        L = self.length
+        data = self.data
+
+        if self.empty and len(values):
+            # fill with first value, to avoid a jump from zeros at start
+            v = values[0]
+            for i in range(2*L):
+                data[i] = v
+            self.empty = False
+
+        idx = self.index
+        for i in range(len(values)):
+            v = values[i]
+            data[idx] = v
+            data[idx+L] = v
+            idx += 1
+            if idx == L:
+                idx = 0
+        self.index = idx
+
+    def reset(self):
+        """
+        Forget all samples. Next push() fills the window again
+        """
+        self.index = 0
+        self.empty = True
+
+    def window(self):
+        """
+        Return the last length samples, oldest first
+        """
+        return self.view[self.index:self.index+self.length]
+
+
+class SampleClock():
+    """
+    Time in seconds, derived from the number of samples at a fixed samplerate
+
+    Exact and with sub-second resolution, unlike time.time() on MicroPython.
+    Also follows the sensor data when processing lags behind or the FIFO has a backlog.
+    Can also track the latency from newest sample to decision, using ticks_ms()
+    ticks_ms is for testing, defaults to compat.ticks_ms
+    """
+
+    def __init__(self, samplerate, start=0.0, ticks_ms=None):
+        self.samplerate = samplerate
+        self.start = start
+        self.samples = 0
+        self.ticks_ms = compat.ticks_ms if ticks_ms is None else ticks_ms
+
+        # latency tracking
+        self.read_ticks = None
+        self.read_backlog = 0
+        self.latency_ms = None
+        self.max_latency_ms = 0
+
+    def time(self):
+        return self.start + (self.samples / self.samplerate)
+
+    def set_samplerate(self, samplerate):
+        """
+        Change samplerate for samples after this point
+        """
+        self.start = self.time()
+        self.samples = 0
+        self.samplerate = samplerate
+
+    def advance(self, samples):
+        self.samples += samples
+
+    def mark_read(self, backlog=0):
+        """
+        Note the time when samples were read. backlog is the number of newer samples still in FIFO
+        """
+        self.read_ticks = self.ticks_ms()
+        self.read_backlog = backlog
+
+    def mark_decision(self):
+        """
+        Update latency from the newest sample read, until now
+        """
+        if self.read_ticks is None:
+            return None
+        waited = (self.read_backlog * 1000) // self.samplerate
+        self.latency_ms = waited + ticks_diff(self.ticks_ms(), self.read_ticks)
+        self.max_latency_ms = max(self.latency_ms, self.max_latency_ms)
+        return self.latency_ms
 
 
 class StateMachine:
@@ -57,6 +221,7 @@ class StateMachine:
             prediction_filter_length=5,
             idle_time_max=30.0,
             verbose=2,
+            log=None,
         ):
 
         # config
@@ -70,13 +235,15 @@ class StateMachine:
         self.brushing_started_time = 10.0
         self.prediction_filter_length = prediction_filter_length
         self.verbose = verbose
+        # binlog.BinaryLog for tracing. If None, print() is used
+        self.log = log
 
         # state
         self.state = self.SLEEP
         self.state_enter_time = time
         self.last_time = time
-        self.motion_history = [0.0] * self.prediction_filter_length
-        self.brushing_history = [0.0] * self.prediction_filter_length
+        self.motion_filter = MedianFilter(self.prediction_filter_length)
+        self.brushing_filter = MedianFilter(self.prediction_filter_length)
         self.brushing_time = 0.0 # how long active
 
         self._state_functions = {
@@ -89,17 +256,19 @@ class StateMachine:
 
     def _get_predictions(self):
         # return filtered predictions
-        m = median(self.motion_history)
-        b = median(self.brushing_history)
+        m = self.motion_filter.median()
+        b = self.brushing_filter.median()
         return m, b
 
     def _update_predictions(self, motion, brushing):
-        # update filter states
-        l = self.prediction_filter_length
-        self.motion_history = buffer_push_end(self.motion_history, motion, l)
-        self.brushing_history = buffer_push_end(self.brushing_history, brushing, l)
-        # return filter outputs
-        return self._get_predictions()
+        # update filter states, and return filter outputs
+        m = self.motion_filter.push(motion)
+        if brushing is None:
+            # model was skipped, keep the history of actual predictions
+            b = self.brushing_filter.median()
+        else:
+            b = self.brushing_filter.push(brushing)
+        return m, b
 
     @property
     def progress_state(self):
@@ -112,24 +281,42 @@ class StateMachine:
     def next(self, time, motion, brushing):
         # Handle logic common to all states,
         # and then delegate to current state
+        # brushing is None if the model was not run for this window
         motion, brushing = self._update_predictions(motion, brushing)
         kwargs = dict(time=time, motion=motion, brushing=brushing)
         func = self._state_functions[self.state]
         next_state = func(**kwargs)
         if not next_state is None:
             if self.verbose >= 1:
-                print('sm-transition', self.state, next_state)
+                if self.log is None:
+                    print('sm-transition', self.state, next_state)
+                else:
+                    self.log.log(binlog.EVENT_TRANSITION, binlog.state_index(self.state),
+                        binlog.state_index(next_state))
             self.state = next_state
             self.state_enter_time = time
         self.last_time = time
 
+    def _trace(self, name, v0, v1=None, v2=None):
+        # trace of state function, for verbose >= 2
+        if self.log is None:
+            if v1 is None:
+                print(name, v0)
+            elif v2 is None:
+                print(name, v0, v1)
+            else:
+                print(name, v0, v1, v2)
+        else:
+            self.log.log(binlog.EVENT_SM_NEXT, binlog.state_index(self.state), binlog.scaled(v0, 100),
+                0 if v1 is None else binlog.scaled(v1, 100), 0 if v2 is None else binlog.scaled(v2, 100))
+
     # State functions
     def sleep_next(self, motion, **kwargs):
         # reset accumulated time
         self.brushing_time = 0.0
 
         if self.verbose >= 2:
-            print('sm-sleep-next', motion)
+            self._trace('sm-sleep-next', motion)
 
         if motion > self.motion_threshold:
             return self.IDLE
@@ -139,7 +326,7 @@ class StateMachine:
         since_enter = time - self.state_enter_time
 
         if self.verbose >= 2:
-            print('sm-idle-next', is_brushing, since_enter)
+            self._trace('sm-idle-next', is_brushing, since_enter)
 
         if is_brushing:
             return self.BRUSHING
@@ -156,7 +343,7 @@ class StateMachine:
         since_last = time - self.last_time
 
         if self.verbose >= 2:
-            print('sm-brushing-next', brushing, is_idle, since_last)
+            self._trace('sm-brushing-next', brushing, is_idle, since_last)
 
         if is_idle:
             return self.IDLE
@@ -170,25 +357,25 @@ class StateMachine:
         since_enter = time - self.state_enter_time
 
         if self.verbose >= 2:
-            print('sm-done-next', since_enter)
+            self._trace('sm-done-next', since_enter)
 
         if since_enter >= self.done_wait_time:
-            self.brushing_history = [0.0] * self.prediction_filter_length
+            self.brushing_filter.reset(0.0)
             return self.SLEEP
 
     def failed_next(self, time, **kwargs):
         since_enter = time - self.state_enter_time
 
         if self.verbose >= 2:
-            print('sm-failed-next', since_enter)
+            self._trace('sm-failed-next', since_enter)
 
         if since_enter >= self.fail_wait_time:
-            self.brushing_history = [0.0] * self.prediction_filter_length
+            self.brushing_filter.reset(0.0)
             return self.SLEEP
 
 
 
-def mean(arr):
+def mean_python(arr):
     m = sum(arr) / float(len(arr))
     return m
 
@@ -211,93 +398,705 @@ def clamp(value, lower, upper) -> float:
     v = max(v, lower)
     return v
 
-def energy_xyz(xs, ys, zs, orientation):
+def energy_xyz_python(xs, ys, zs, orientation):
     assert len(xs) == len(ys)
     assert len(ys) == len(zs)
 
     xo, yo, zo = orientation
-    
+
     # compute RMS of magnitude, after having removed orientation
     s = 0.0
     for i in range(len(xs)):
-        m = magnitude_3d(xs[i]-xo, ys[i]-yo, zs[i]-zo)
-        s += m**2
+        dx = xs[i] - xo
+        dy = ys[i] - yo
+        dz = zs[i] - zo
+        s += (dx*dx) + (dy*dy) + (dz*dz)
 
     rms = math.sqrt(s)
     return rms
 
+# Use versions accelerated with MicroPython native/viper emitters, when available
+# Otherwise fall back to the pure-Python versions
+try:
+    import kernels_native
+except (ImportError, SyntaxError):
+    kernels_native = None
+
+if kernels_native is None:
+    mean = mean_python
+    energy_xyz = energy_xyz_python
+else:
+    mean = kernels_native.mean
+    energy_xyz = kernels_native.energy_xyz
+
+def window_stats(xs, ys, zs):
+    """
+    Compute orientation (mean per axis) and energy in a single pass over the samples
+
+    Returns (xo, yo, zo, energy). Same results as mean() and energy_xyz(), within float tolerance
+    """
+    n = len(xs)
+    assert len(ys) == n
+    assert len(zs) == n
+    if n == 0:
+        raise ValueError('Input empty')
+
+    # Sums are taken relative to the first sample.
+    # Keeps the values small, and avoids cancellation when subtracting the mean
+    kx = xs[0]
+    ky = ys[0]
+    kz = zs[0]
+
+    sx = 0
+    sy = 0
+    sz = 0
+    ss = 0.0
+    for i in range(n):
+        dx = xs[i] - kx
+        dy = ys[i] - ky
+        dz = zs[i] - kz
+        sx += dx
+        sy += dy
+        sz += dz
+        ss += (dx*dx) + (dy*dy) + (dz*dz)
+
+    mx = sx / n
+    my = sy / n
+    mz = sz / n
+
+    # sum of squared deviations from the mean, over all axes
+    s = ss - (n * ((mx*mx) + (my*my) + (mz*mz)))
+    if s < 0.0:
+        s = 0.0 # rounding
+    energy = math.sqrt(s)
+
+    return kx + mx, ky + my, kz + mz, energy
+
+def isqrt(n):
+    """
+    Integer square root, rounded down
+    """
+    if n < 0:
+        raise ValueError('Input negative')
+    if n < 2:
+        return n
+    x = n
+    y = (x + 1) // 2
+    while y < x:
+        x = y
+        y = (x + (n // x)) // 2
+    return x
+
+def energy_shift(n):
+    """
+    Number of bits to drop from squared deviations in window_stats_int
+    Even, and large enough that the sum of 3*n int16 squares stays below 2**30 (MicroPython small int)
+    """
+    shift = 0
+    while (1 << shift) < (3*n):
+        shift += 2
+    return shift
+
+def window_stats_int(xs, ys, zs):
+    """
+    Integer-only version of window_stats(), for int16 input
+
+    Returns (xo, yo, zo, energy), all int.
+    Avoids floats, which are heap-allocated on most MicroPython ports.
+    Intermediate values stay within MicroPython small ints for deviations below 2**15.
+
+    Error bounds relative to window_stats(), with s = energy_shift(n):
+    orientation is rounded to nearest, so at most 0.5.
+    energy**2 is off by at most 1.5*n*2**s (rounding of squares) + 0.75*n (rounding of mean).
+    So the energy error is at most sqrt() of that, and for larger energy E at most that / (2*E).
+    Integer square root adds at most 2**(s/2).
+    For n=50, s=8: at most 155 for energy close to 0, and at most 26 for energy above 1000.
+    """
+    n = len(xs)
+    assert len(ys) == n
+    assert len(zs) == n
+    if n == 0:
+        raise ValueError('Input empty')
+
+    # orientation, rounded to nearest
+    sx = 0
+    sy = 0
+    sz = 0
+    for i in range(n):
+        sx += xs[i]
+        sy += ys[i]
+        sz += zs[i]
+    half = n // 2
+    xo = (sx + half) // n
+    yo = (sy + half) // n
+    zo = (sz + half) // n
+
+    # energy. Sum of squared deviations, scaled down by 2**shift
+    shift = energy_shift(n)
+    rounding = (1 << shift) >> 1
+    ss = 0
+    for i in range(n):
+        dx = xs[i] - xo
+        dy = ys[i] - yo
+        dz = zs[i] - zo
+        ss += (((dx*dx) + rounding) >> shift) \
+            + (((dy*dy) + rounding) >> shift) \
+            + (((dz*dz) + rounding) >> shift)
+
+    # take back as much of the scaling as possible, before the square root
+    half_shift = shift // 2
+    while half_shift > 0 and ss < (1 << 27):
+        ss <<= 2
+        half_shift -= 1
+    energy = isqrt(ss) << half_shift
+
+    return xo, yo, zo, energy
+
+class SlidingWindowStats():
+    """
+    Orientation and energy over a sliding window of x,y,z samples, updated incrementally
+
+    Keeps running sums of (x-k) and (x-k)**2 per axis, with reference k close to the mean.
+    These are updated as samples enter and leave the window, so the cost per hop scales with the hop length.
+    The sums are integers, so adding and removing samples is exact and does not drift.
+    To keep the sums small, they are recomputed from the window relative to the current mean,
+    once every recompute_windows window lengths of samples.
+    Gives the same results as window_stats() / window_stats_int() on the window.
+
+    With shift, each squared deviation is scaled down by 2**shift and rounded, like in window_stats_int().
+    Then the sums, and the intermediate values of stats_int(), stay MicroPython small ints
+    for deviations below 2**15, when shift is energy_shift(length). Still exact when adding and removing samples
+    """
+
+    def __init__(self, length, recompute_windows=4, shift=0):
+        self.length = length
+        self.recompute_interval = recompute_windows * length
+        self.shift = shift
+        self.rounding = (1 << shift) >> 1
+        self.buffers = [ WindowBuffer(length) for _ in range(3) ]
+        self.references = [0, 0, 0]
+        self.sums = [0, 0, 0]
+        self.squares = [0, 0, 0]
+        self.since_recompute = 0
+
+    def reset(self):
+        for buf in self.buffers:
+            buf.reset()
+
+    def push(self, xs, ys, zs):
+        n = len(xs)
+        assert len(ys) == n
+        assert len(zs) == n
+        L = self.length
+
+        if self.buffers[0].empty or n >= L:
+            for buf, values in zip(self.buffers, (xs, ys, zs)):
+                buf.push(values)
+            self.recompute()
+            return
+
+        for axis, values in enumerate((xs, ys, zs)):
+            buf = self.buffers[axis]
+            data = buf.data
+            k = self.references[axis]
+            s = self.sums[axis]
+            ss = self.squares[axis]
+            shift = self.shift
+            rounding = self.rounding
+
+            # samples at the start of the window are the ones leaving
+            idx = buf.index
+            for i in range(n):
+                old = data[idx] - k
+                new = values[i] - k
+                s += new - old
+                ss += (((new*new) + rounding) >> shift) - (((old*old) + rounding) >> shift)
+                idx += 1
+                if idx == L:
+                    idx = 0
+
+            self.sums[axis] = s
+            self.squares[axis] = ss
+            buf.push(values)
+
+        self.since_recompute += n
+        if self.since_recompute >= self.recompute_interval:
+            self.recompute()
+
+    def recompute(self):
+        """
+        Compute the sums from scratch, relative to the current mean
+        """
+        L = self.length
+        shift = self.shift
+        rounding = self.rounding
+        for axis in range(3):
+            window = self.buffers[axis].window()
+            k = sum(window) // L
+            s = 0
+            ss = 0
+            for i in range(L):
+                d = window[i] - k
+                s += d
+                ss += ((d*d) + rounding) >> shift
+            self.references[axis] = k
+            self.sums[axis] = s
+            self.squares[axis] = ss
+        self.since_recompute = 0
+
+    def windows(self):
+        """
+        Return the latest x,y,z windows, without copying
+        """
+        return [ buf.window() for buf in self.buffers ]
+
+    def stats(self):
+        """
+        Return (xo, yo, zo, energy), same as window_stats()
+        """
+        n = self.length
+        kx, ky, kz = self.references
+        sx, sy, sz = self.sums
+        mx = sx / n
+        my = sy / n
+        mz = sz / n
+        s = (sum(self.squares) << self.shift) - (n * ((mx*mx) + (my*my) + (mz*mz)))
+        if s < 0.0:
+            s = 0.0 # rounding
+        energy = math.sqrt(s)
+        return kx + mx, ky + my, kz + mz, energy
+
+    def stats_int(self, out):
+        """
+        Write xo, yo, zo, energy as integers into out, like window_stats_int(). Returns out
+
+        Orientation is rounded to nearest, so error at most 0.5.
+        With shift=0, energy is rounded down, error at most 1.
+        Otherwise, with s = shift, energy**2 is off by at most 3*n*2**s + 2**(s+1) + 3,
+        from rounding of squares and of the squared mean. Integer square root adds at most 2**(s/2) + 1.
+        Does not allocate, as long as the values are small ints
+        """
+        n = self.length
+        half = n // 2
+        shift = self.shift
+        rounding = self.rounding
+        squares = 0
+        for axis in range(3):
+            s = self.sums[axis]
+            out[axis] = self.references[axis] + ((s + half) // n)
+            # sum of squared deviations from mean is squares - s*s/n. With s = q*n + r,
+            # s*s/n = n*q*q + 2*q*r + r*r/n, scaled down by 2**shift without forming s*s
+            q = s // n
+            r = s - (q*n)
+            mean_squares = (n * (((q*q) + rounding) >> shift)) + \
+                (((2*q*r) + ((r*r) // n) + rounding) >> shift)
+            squares += self.squares[axis] - mean_squares
+        if squares < 0:
+            squares = 0 # rounding
+
+        # take back as much of the scaling as possible, before the square root
+        half_shift = shift // 2
+        while half_shift > 0 and squares < (1 << 27):
+            squares <<= 2
+            half_shift -= 1
+        out[3] = isqrt(squares) << half_shift
+        return out
+
+def copy_features(values, out):
+    """
+    Copy feature values into the preallocated array out, truncated to integers
+
+    Does not allocate
+    """
+    assert len(values) == len(out), (len(values), len(out))
+    for i in range(len(out)):
+        out[i] = int(values[i])
+
 def dirname(path, sep='/'):
     parts = path.split(sep)
     dirname = sep.join(parts[:-1])
     return dirname
 
 
+class GravitySplitter():
+
+    def __init__(self, samplerate, lowpass_cutoff=0.5):
+
+        self.lowpass_cutoff = lowpass_cutoff
+        self.set_samplerate(samplerate)
+
+        self.gravity = array.array('f', [0, 0, 0])
+        self.started = False # gravity is set from the first sample
+        self.motion = array.array('f', [0, 0, 0])
+
+    def set_samplerate(self, samplerate):
+        # keeps the gravity estimate, it does not depend on samplerate
+        rc = 1.0/(2*3.14*self.lowpass_cutoff)
+        dt = 1.0/samplerate
+        self.lowpass_alpha = rc / (rc + dt)
+
+    def process(self, xyz):
+        assert len(xyz) == 3, xyz
+
+        if not self.started:
+            # jump straigth to it, to avoid slow ramp-in
+            for i in range(3):
+                self.gravity[i] = xyz[i]
+            self.started = True
+
+        a = self.lowpass_alpha
+        for i in range(len(xyz)):
+            self.gravity[i] = (a * self.gravity[i]) + ((1.0 - a) * xyz[i])
+            self.motion[i] = xyz[i] - self.gravity[i]
+
+    def process_block(self, xs, ys, zs, out_x, out_y, out_z):
+        """
+        Filter a block of samples, writing the motion (gravity removed) to out_x, out_y, out_z
+
+        The output arrays may be the same as the inputs, for in-place operation.
+        Filter state is carried over between calls.
+        Motion is saturated to the int16 range.
+        """
+        n = len(xs)
+        assert len(ys) == n
+        assert len(zs) == n
+        if n == 0:
+            return
+
+        g = self.gravity
+        if not self.started:
+            # jump straigth to it, to avoid slow ramp-in
+            g[0] = xs[0]
+            g[1] = ys[0]
+            g[2] = zs[0]
+            self.started = True
+
+        a = self.lowpass_alpha
+        b = 1.0 - a
+        gx = g[0]
+        gy = g[1]
+        gz = g[2]
+        for i in range(n):
+            x = xs[i]
+            y = ys[i]
+            z = zs[i]
+            gx = (a * gx) + (b * x)
+            gy = (a * gy) + (b * y)
+            gz = (a * gz) + (b * z)
+            # a step from one extreme to the other gives motion outside int16
+            out_x[i] = int(clamp(x - gx, -32768, 32767))
+            out_y[i] = int(clamp(y - gy, -32768, 32767))
+            out_z[i] = int(clamp(z - gz, -32768, 32767))
+
+        g[0] = gx
+        g[1] = gy
+        g[2] = gz
+        self.motion[0] = x - gx
+        self.motion[1] = y - gy
+        self.motion[2] = z - gz
+
+
+# First stage of model cascade uses features that are computed anyway for the motion heuristic
+# energy, orientation x, y, z. Scaled to int16
+# NOTE: must match software/model/train_cascade.py
+CASCADE_FEATURES = 4
+CASCADE_ORIENTATION_SCALE = 1000
+
+def compute_cascade_features(energy, norm_orientation, out):
+    """
+    Fill out with the first stage features, from window energy and normalized orientation
+    """
+    out[0] = int(min(energy, 32767))
+    out[1] = int(norm_orientation[0] * CASCADE_ORIENTATION_SCALE)
+    out[2] = int(norm_orientation[1] * CASCADE_ORIENTATION_SCALE)
+    out[3] = int(norm_orientation[2] * CASCADE_ORIENTATION_SCALE)
+
+# Binary format for tree ensembles, see software/model/convert_trees.py
+# Header: magic, version, n_classes, n_features, n_trees, n_nodes, n_leaves, reserved
+TREES_MAGIC = b'EMLT'
+TREES_VERSION = 1
+TREES_HEADER_FORMAT = '<4sBBHHHHH'
+TREES_HEADER_SIZE = 16
+# Each node: feature, left, right, threshold
+TREES_NODE_FORMAT = '<hhhf'
+TREES_NODE_SIZE = 10
+
+def load_trees_binary(f, new):
+    """
+    Load a tree ensemble in binary format from file f
+
+    new(n_trees, n_nodes, n_leaves) is called to create the model, like emlearn_trees.new.
+    The model is filled using the same methods as emlearn_trees.load_model for CSV.
+    """
+    header = f.read(TREES_HEADER_SIZE)
+    if len(header) != TREES_HEADER_SIZE:
+        raise ValueError('Truncated model header')
+    magic, version, n_classes, n_features, n_trees, n_nodes, n_leaves, _ = \
+        struct.unpack(TREES_HEADER_FORMAT, header)
+    if magic != TREES_MAGIC:
+        raise ValueError('Not a trees model file')
+    if version != TREES_VERSION:
+        raise ValueError('Unsupported model version {}'.format(version))
+
+    # single read of everything else, into buffer of exact size
+    size = (2 * n_trees) + (2 * n_leaves) + (TREES_NODE_SIZE * n_nodes)
+    data = bytearray(size)
+    read = f.readinto(data)
+    if read != size:
+        raise ValueError('Truncated model data, expected {} bytes got {}'.format(size, read))
+
+    model = new(n_trees, n_nodes, n_leaves)
+    offset = 0
+    for i in range(n_trees):
+        root, = struct.unpack_from('<h', data, offset)
+        model.addroot(root)
+        offset += 2
+    for i in range(n_leaves):
+        leaf, = struct.unpack_from('<h', data, offset)
+        model.addleaf(leaf)
+        offset += 2
+    for i in range(n_nodes):
+        feature, left, right, value = struct.unpack_from(TREES_NODE_FORMAT, data, offset)
+        model.addnode(left, right, feature, value)
+        offset += TREES_NODE_SIZE
+    model.setdata(n_features, n_classes)
+
+    return model
+
+
 class DataProcessor():
 
-    def __init__(self):
+    def __init__(self, fixed_point=False, window_length=None, samplerate=50, gravity_cutoff=None,
+            model_path=None, motion_gate=None, cascade_model_path=None, cascade_band=(0.25, 0.75),
+            stages=None, hop_length=50):
 
         # Config
         self.max_motion_energy = 3000
+        # Use integer-only computation for orientation and energy
+        self.fixed_point = fixed_point
+        # Analysis window. If None, then each hop given to process() is analyzed on its own
+        # NOTE: must match the window used when training the model
+        self.window_length = window_length
+        # Number of samples given to each process() call. Used to preallocate buffers
+        self.hop_length = hop_length
+        # Remove gravity using a lowpass filter with this cutoff (Hz), before computing energy and features
+        # If None, then gravity is estimated as the mean of each window
+        self.gravity_cutoff = gravity_cutoff
+        self.samplerate = samplerate
+        # Features and model are only valid at the initial samplerate
+        self.model_samplerate = samplerate
+        # Skip features and model when state is sleep and motion is below this. If None, never skip
+        # With motion_gate set, sleep is also always skipped at other samplerates, see RateController
+        # NOTE: should be well below StateMachine.motion_threshold
+        self.motion_gate = motion_gate
+        # Only run the full model when the first stage of the cascade gives a probability inside this band
+        # NOTE: band should contain StateMachine.brushing_threshold and not_brushing_threshold
+        self.cascade_band = cascade_band
+        # instrument.StageTimer, for timing 'orientation', 'features' and 'predict'. Optional
+        self.stages = stages
 
         # State
-        here = dirname(__file__)
-        if here == '':
-            here = '.'
-        model_path = here + '/brushing.trees.csv'
+        if model_path is None:
+            here = dirname(__file__)
+            if here == '':
+                here = '.'
+            model_path = here + '/brushing.trees.bin'
         self.brushing_model = self.load_model(model_path)
 
+        # First stage model, using CASCADE_FEATURES. Optional
+        if cascade_model_path is None:
+            self.cascade_model = None
+        else:
+            self.cascade_model = self.load_model(cascade_model_path)
+        self.cascade_features = array.array('h', (0 for _ in range(CASCADE_FEATURES)))
+
         features_typecode = timebased.DATA_TYPECODE
         n_features = timebased.N_FEATURES
         self.features = array.array(features_typecode, (0 for _ in range(n_features)))
-    
+        self.norm_orientation = array.array('f', (0 for _ in range(3)))
+        self._xyz = [None, None, None]
+
+        if window_length is None:
+            self.windows = None
+        elif fixed_point:
+            # squares scaled down, so the running sums stay small ints
+            self.windows = SlidingWindowStats(window_length, shift=energy_shift(window_length))
+        else:
+            self.windows = SlidingWindowStats(window_length)
+        self.window_stats = array.array('i', (0 for _ in range(4))) # xo, yo, zo, energy
+
+        if gravity_cutoff is None:
+            self.gravity_splitter = None
+        else:
+            self.gravity_splitter = GravitySplitter(samplerate, lowpass_cutoff=gravity_cutoff)
+        if gravity_cutoff is None:
+            self.motion_xyz = None
+        else:
+            self.motion_xyz = [ empty_array('h', hop_length) for _ in range(3) ]
+
         self.brushing_outputs = array.array('f', (0 for _ in range(2)))
 
+        # statistics
+        self.windows_processed = 0
+        self.windows_gated = 0
+        self.windows_cascaded = 0 # decided by the first stage alone
+
 
     def load_model(self, model_path):
+        """
+        Load model from binary or CSV file
+        """
 
-        # Load a CSV file with the model
-        model = emlearn_trees.new(10, 1000, 10)
-        with open(model_path, 'r') as f:
-            emlearn_trees.load_model(model, f)
+        # NOTE: dynamic import, since emlearn_trees is a native module
+        # not available on CPython
+        import emlearn_trees
+
+        if model_path.endswith('.csv'):
+            # NOTE: slow, and model storage is not sized to the actual model
+            model = emlearn_trees.new(10, 1000, 10)
+            with open(model_path, 'r') as f:
+                emlearn_trees.load_model(model, f)
+        else:
+            with open(model_path, 'rb') as f:
+                model = load_trees_binary(f, emlearn_trees.new)
 
         return model
 
-    def process(self, xs, ys, zs):
+    def set_samplerate(self, samplerate):
+        """
+        Change samplerate of the incoming data
+
+        Samples in the analysis window are discarded, since they were at the previous samplerate
+        """
+        if samplerate == self.samplerate:
+            return
+        self.samplerate = samplerate
+        if self.windows is not None:
+            self.windows.reset()
+        if self.gravity_splitter is not None:
+            self.gravity_splitter.set_samplerate(samplerate)
+
+    def compute_features(self, xs, ys, zs):
+        """
+        Compute features for the brushing model, written in-place into self.features
+
+        NOTE: all N_FEATURES are computed, although the trees only read a few of them
+        (5 of 92 in brushing.trees.bin). Computing only those needs a selective API
+        in timebased.py, which comes from emlearn-micropython
+        """
+        xyz = self._xyz
+        xyz[0] = xs
+        xyz[1] = ys
+        xyz[2] = zs
+        ff = timebased.calculate_features_xyz(xyz)
+        copy_features(ff, self.features)
+        return self.features
+
+    def remove_gravity(self, xs, ys, zs):
+        """
+        Return x,y,z with gravity removed, in preallocated arrays
+        """
+        mx, my, mz = self.motion_xyz
+        assert len(xs) == len(mx), (len(xs), len(mx))
+        self.gravity_splitter.process_block(xs, ys, zs, mx, my, mz)
+        return mx, my, mz
+
+    def predict_cascade(self, energy):
+        """
+        Run first stage model on the cheap features. Call after norm_orientation is updated
+
+        Returns the brushing probability, or None if it is uncertain and the full model is needed
+        """
+        features = self.cascade_features
+        compute_cascade_features(energy, self.norm_orientation, features)
+
+        self.cascade_model.predict(features, self.brushing_outputs)
+        brushing = self.brushing_outputs[1]
+        low, high = self.cascade_band
+        if brushing <= low or brushing >= high:
+            return brushing
+        return None
+
+    def process(self, xs, ys, zs, state=None):
         """
         Analyze the accelerometers sensor data, to determine what is happening
+
+        xs, ys, zs are the new samples (one hop).
+        With window_length set, the analysis uses the latest window_length samples
+        state is the current StateMachine state, used for gating with motion_gate
+        Returns motion and brushing. brushing is None when the window was gated
         """
+        self.windows_processed += 1
+
+        stages = self.stages
 
         # find orientation
-        orientation_start = time.ticks_ms()
-        orientation_xyz = mean(xs), mean(ys), mean(zs)
-        mag = magnitude_3d(*orientation_xyz)
-        if mag == 0:
-            norm_orientation = [ 0.0 for c in orientation_xyz ]
+        if self.gravity_splitter is not None:
+            xs, ys, zs = self.remove_gravity(xs, ys, zs)
+
+        if self.windows is not None:
+            # incremental, cost scales with the hop length
+            self.windows.push(xs, ys, zs)
+            xs, ys, zs = self.windows.windows()
+            if self.fixed_point:
+                stats = self.windows.stats_int(self.window_stats)
+                xo = stats[0]
+                yo = stats[1]
+                zo = stats[2]
+                energy = stats[3]
+            else:
+                xo, yo, zo, energy = self.windows.stats()
+        elif self.fixed_point:
+            xo, yo, zo, energy = window_stats_int(xs, ys, zs)
         else:
-            norm_orientation = [ c/mag for c in orientation_xyz ]
+            xo, yo, zo, energy = window_stats(xs, ys, zs)
+        if self.gravity_splitter is not None:
+            # orientation is the gravity estimate, and the window stats are for motion only
+            xo, yo, zo = self.gravity_splitter.gravity
 
-        energy = energy_xyz(xs, ys, zs, orientation_xyz)    
+        mag = magnitude_3d(xo, yo, zo)
+        norm_orientation = self.norm_orientation
+        if mag == 0:
+            norm_orientation[0] = 0.0
+            norm_orientation[1] = 0.0
+            norm_orientation[2] = 0.0
+        else:
+            norm_orientation[0] = xo/mag
+            norm_orientation[1] = yo/mag
+            norm_orientation[2] = zo/mag
 
         # dummy motion classifier, heuristics
         motion = clamp(energy / self.max_motion_energy, 0.0, 1.0)
-   
-        orientation_duration = time.ticks_ms() - orientation_start
+        if stages is not None:
+            stages.lap('orientation')
+
+        gate = self.motion_gate
+        if gate is not None and state == StateMachine.SLEEP and \
+                (motion < gate or self.samplerate != self.model_samplerate):
+            # device is still, brushing cannot start. Skip the expensive parts
+            self.windows_gated += 1
+            return round(motion, 2), None
+
+        if self.cascade_model is not None:
+            brushing = self.predict_cascade(energy)
+            if brushing is not None:
+                self.windows_cascaded += 1
+                if stages is not None:
+                    stages.lap('predict')
+                return round(motion, 2), round(brushing, 2)
 
         # brushing classifier
         # compute features
-        features_start = time.ticks_ms()
-        ff = timebased.calculate_features_xyz((xs, ys, zs))
-        for i, f in enumerate(ff):
-            self.features[i] = int(f)
-        features_duration = time.ticks_ms() - features_start
+        self.compute_features(xs, ys, zs)
+        if stages is not None:
+            stages.lap('features')
 
         # run model
-        predict_start = time.ticks_ms()
         self.brushing_model.predict(self.features, self.brushing_outputs)
         brushing = self.brushing_outputs[1]
-        predict_duration = time.ticks_ms() - predict_start
+        if stages is not None:
+            stages.lap('predict')
 
-        #print('comp', features_duration, predict_duration)
         # Only maintain a sane level of decimals for probabilities
         motion = round(motion, 2)
         brushing = round(brushing, 2)
@@ -305,6 +1104,61 @@ class DataProcessor():
 
 
 
+class RateController():
+    """
+    Lower the IMU samplerate while in sleep, and return to full rate when leaving it
+
+    imu must have set_odr(hz), and set_odr(hz, low_power=True) if low_power is used.
+    The DataProcessor and SampleClock are told about changes.
+    Also counts the samples processed at the sleep rate, and for how long.
+
+    NOTE: the features and the brushing model were trained on data at 50/52 Hz,
+    and are not valid at a sleep rate like 26 Hz. So SLEEP must stay gated,
+    by setting DataProcessor motion_gate, which then skips the model for all windows at the sleep rate.
+    SLEEP only uses the motion heuristic.
+    """
+
+    def __init__(self, imu, processor, clock, full_rate, sleep_rate, low_power=False):
+        self.imu = imu
+        self.processor = processor
+        self.clock = clock
+        self.full_rate = full_rate
+        self.sleep_rate = sleep_rate
+        self.low_power = low_power
+        self.rate = full_rate
+        self.sleeping = False
+
+        # statistics
+        self.switches = 0
+        self.sleep_samples = 0
+        self.sleep_time = 0.0
+
+    def update(self, state, samples):
+        """
+        Account for samples just processed, and select the rate to use for the next ones
+
+        Returns True if the rate was changed
+        """
+        if self.sleeping:
+            self.sleep_samples += samples
+            self.sleep_time += samples / self.rate
+
+        self.sleeping = state == StateMachine.SLEEP
+        rate = self.sleep_rate if self.sleeping else self.full_rate
+        if rate == self.rate:
+            return False
+
+        if rate == self.sleep_rate and self.low_power:
+            self.imu.set_odr(rate, low_power=True)
+        else:
+            self.imu.set_odr(rate)
+        self.processor.set_samplerate(rate)
+        self.clock.set_samplerate(rate)
+        self.rate = rate
+        self.switches += 1
+        return True
+
+
 # Copy/paste from 
 progress_1 = """0 C5 1 43;2 D#5 1 43;1 D5 1 43"""
 progress_2 = """0 F5 1 43;1 F#5 1 43;2 G5 1 43"""
@@ -313,75 +1167,169 @@ progress_4 = """0 D6 1 43;1 D#6 1 43;2 F6 1 43"""
 success_song = """0 C6 1 43;1 G5 1 43;2 E5 1 43;4 C6 4 43"""
 fail_song = """3 D4 4 43;0 C5 2 43"""
 
+NOTE_NAMES = ('C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B')
+
+def note_frequency(note : str) -> int:
+    """
+    Frequency in Hz for a note name like C5 or D#4, equal-tempered with A4=440 Hz
+
+    Gives the same values as the tones table in buzzer_music
+    """
+    name = note[:-1]
+    octave = int(note[-1])
+    midi = 12*(octave+1) + NOTE_NAMES.index(name)
+    return int(440.0 * (2.0 ** ((midi - 69) / 12.0)) + 0.5)
+
+def parse_song(song : str, tempo=3):
+    """
+    Parse a song in onlinesequencer.net format into tone and duration arrays
+
+    Format is "time note duration instrument;..." in beats, same as buzzer_music.
+    Returns (tones, durations), with tones in Hz (0 is silence) and durations in ticks.
+    Only one note plays at a time, the earliest started one. There is just one buzzer.
+    Trailing silence is dropped.
+    """
+    notes = []
+    end = 0
+    for note in song.split(';'):
+        start, name, duration, _instrument = note.split(' ')
+        start = round(float(start))
+        duration = math.ceil(float(duration))
+        notes.append((start, duration, note_frequency(name)))
+        end = max(end, start+duration)
+    notes.sort()
+
+    # tone for each beat
+    beats = [ 0 ] * end
+    for start, duration, tone in notes:
+        for beat in range(start, start+duration):
+            if beats[beat] == 0:
+                beats[beat] = tone
+
+    # merge repeated beats into one step
+    tones = array.array('H')
+    durations = array.array('H')
+    for tone in beats:
+        if len(tones) and tones[-1] == tone:
+            durations[-1] += tempo
+        else:
+            tones.append(tone)
+            durations.append(tempo)
+
+    return tones, durations
+
 class OutputManager():
+    """
+    Drive LED and buzzer according to the state
+
+    Runs as its own asyncio task, see run().
+    update() only stores the latest state, so the caller never waits for audio.
+    A new state stops the song that is playing.
+    sleep_ms is for testing, defaults to compat.sleep_ms
+    """
 
-    def __init__(self, led_pin, buzzer_pin, note_step_ms=50, duty=10000):
+    states = ('sleep', 'idle', 'brushing', 'done', 'failed')
 
-        # dynamic import, since machine.PWM is not available on Unix
-        from machine import PWM
+    def __init__(self, led_pin, buzzer_pin, note_step_ms=50, duty=10000, tempo=3, PWM=None, sleep_ms=None):
+
+        if PWM is None:
+            # dynamic import, since machine.PWM is not available on Unix
+            from machine import PWM
 
         self.buzzer_pin = buzzer_pin
         self.led_pin = led_pin
         # XXX: on M5Stick PLUS2 using PWM in the audible range causes buzzer to sound =/
         self.led_pwm = PWM(self.led_pin, freq=100000, duty_u16=0)
+        self.buzzer_pwm = PWM(self.buzzer_pin, freq=1000, duty_u16=0)
         self.note_step_ms = note_step_ms
         self.duty = duty
+        self.sleep_ms = compat.sleep_ms if sleep_ms is None else sleep_ms
+
+        # parse once, instead of on every play
+        self.progress_songs = [ parse_song(s, tempo=tempo) for s in (
+            progress_1,
+            progress_2,
+            progress_3,
+            progress_4,
+        ) ]
+        self.success_song = parse_song(success_song, tempo=tempo)
+        self.fail_song = parse_song(fail_song, tempo=tempo)
+
+        # mailbox with the latest state
+        self.state = None
+        self.progress_state = None
+        self.changed = asyncio.Event()
+
+        # statistics
+        self.songs_played = 0
+        self.songs_preempted = 0
+
+    def update(self, state : str, progress_state : int):
+        """
+        Set the state to output. Returns immediately
+        """
+        if state == self.state and progress_state == self.progress_state:
+            return
+        if state not in self.states:
+            raise ValueError(f"Unsupported state {state}")
 
-        self.last_state = None
-        self.last_progress = None
-
-    async def _play_song(self, notes):
-
-        # NOTE: dynamic import of dependency
-        # since it is not portable to Unix (machine.Pin not defined)
-        from buzzer_music import music
+        self.state = state
+        self.progress_state = progress_state
+        self.changed.set()
 
-        song = music(notes, pins=[self.buzzer_pin], looping=False, duty=self.duty)
-        while True:
-            running = song.tick()
-            if not running:
-                break
-            await asyncio.sleep_ms(self.note_step_ms)    
+    def _select_song(self, state, progress_state):
+        if state == 'brushing':
+            return self.progress_songs[progress_state]
+        elif state == 'done':
+            return self.success_song
+        elif state == 'failed':
+            return self.fail_song
+        return None
 
-    async def run(self, state : str, progress_state : int):
+    async def _play_song(self, song):
+        tones, durations = song
+        pwm = self.buzzer_pwm
 
-        if state == self.last_state and progress_state == self.last_progress:
-            return
+        for i in range(len(tones)):
+            tone = tones[i]
+            if tone == 0:
+                pwm.duty_u16(0)
+            else:
+                pwm.freq(tone)
+                pwm.duty_u16(self.duty)
 
-        led_value = 0.0
-        if state == 'brushing':
-            led_value = 0.5
-        elif state == 'idle':
-            led_value = 0.02
-        else:
-            pass
- 
-        led_duty = int(led_value*(2**16))
-        self.led_pwm.duty_u16(led_duty)
-
-        if state == 'sleep':
-            pass
-        elif state == 'idle':
-            pass
-        elif state == 'brushing':
-            songs = [
-                progress_1,
-                progress_2,
-                progress_3,
-                progress_4,
-            ]
-            s = songs[progress_state]
-            await self._play_song(s)
+            for _ in range(durations[i]):
+                await self.sleep_ms(self.note_step_ms)
+                if self.changed.is_set():
+                    # preempted by a new state
+                    pwm.duty_u16(0)
+                    self.songs_preempted += 1
+                    return
 
-        elif state == 'done':
-            await self._play_song(success_song)
+        pwm.duty_u16(0)
+        self.songs_played += 1
 
-        elif state == 'failed':
-            await self._play_song(fail_song)
+    async def run(self):
+        """
+        Output task. Does not return
+        """
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            state = self.state
+            progress_state = self.progress_state
+
+            led_value = 0.0
+            if state == 'brushing':
+                led_value = 0.5
+            elif state == 'idle':
+                led_value = 0.02
+            else:
+                pass
 
-        else:
-            raise ValueError(f"Unsupported state {state}")
-    
-        self.last_state = state
-        self.last_progress = progress_state
+            led_duty = int(led_value*(2**16))
+            self.led_pwm.duty_u16(led_duty)
 
+            song = self._select_song(state, progress_state)
+            if song is not None:
+                await self._play_song(song)
@@ -0,0 +1,164 @@
+"""
+Decoding of raw data from the IMU FIFO
+"""
+
+import sys
+import struct
+import array
+
+def deinterleave_samples_xiao_python(buf : bytearray,
+        xs, ys, zs, rowstride=6, offset=0, format='>hhh'):
+    """
+    Convert raw bytes into X,Y,Z int16 arrays
+    """
+    assert (len(buf) % rowstride) == 0
+    samples = len(buf) // rowstride
+    assert len(xs) == samples
+    assert len(ys) == samples
+    assert len(zs) == samples
+
+    for i in range(samples):
+        idx = offset + (i*rowstride)
+        x, y, z = struct.unpack_from(format, buf, idx)
+        xs[i] = y
+        ys[i] = x
+        # -(-32768) does not fit in int16, saturate
+        zs[i] = -z if z != -32768 else 32767
+
+def deinterleave_samples_m5stick_python(buf : bytearray,
+        xs, ys, zs, rowstride=6, offset=0, format='>hhh'):
+    """
+    Convert raw bytes into X,Y,Z int16 arrays
+    """
+    assert (len(buf) % rowstride) == 0
+    samples = len(buf) // rowstride
+    assert len(xs) == samples
+    assert len(ys) == samples
+    assert len(zs) == samples
+
+    for i in range(samples):
+        idx = offset + (i*rowstride)
+        x, y, z = struct.unpack_from(format, buf, idx)
+        xs[i] = x
+        ys[i] = y
+        zs[i] = z
+
+def decode_samples_python(
+        buf : bytearray,
+        samples : array.array,
+        rowstride,
+        offset=0,
+        format='<hhhhhh',
+    ):
+    """
+    Convert raw bytes for gyro+accelerometer into int16 array
+    """
+
+    in_stride = rowstride
+    assert (len(buf) % in_stride) == 0
+    n_samples = len(buf) // in_stride
+
+    out_stride = len(format)-1
+    assert len(samples) == out_stride*n_samples, (len(samples), out_stride*n_samples)
+
+    #view = memoryview(buf)
+    for i in range(n_samples):
+        idx = offset + (i*in_stride)
+        values = struct.unpack_from(format, buf, idx)
+        for j, v in enumerate(values):
+            samples[(i*out_stride)+j] = v
+
+def is_native_layout(format, rowstride):
+    """
+    Return True if raw bytes in format can be used directly as an int16 array on this host
+
+    Then the FIFO can be read straight into the record array, with no decoding
+    """
+    little = format[0] == '<'
+    return little and sys.byteorder == 'little' and rowstride == 2*(len(format)-1)
+
+def decode_chunk_xiao_python(buf, xs, ys, zs, record,
+        rowstride=12, format='<hhhhhh', accel_index=3):
+    """
+    Convert raw bytes into X,Y,Z int16 arrays (from Y,X,-Z), and all values into record, in one pass
+
+    If record is buf, the raw data was read directly into the record array (see is_native_layout),
+    and only the X,Y,Z values are extracted.
+    """
+    samples = len(xs)
+    assert len(ys) == samples
+    assert len(zs) == samples
+    stride = len(format)-1
+    assert len(record) == stride*samples, (len(record), stride*samples)
+
+    if record is buf:
+        for i in range(samples):
+            o = (i*stride) + accel_index
+            xs[i] = record[o+1]
+            ys[i] = record[o]
+            z = record[o+2]
+            zs[i] = -z if z != -32768 else 32767
+        return
+
+    assert len(buf) == rowstride*samples, (len(buf), rowstride*samples)
+    for i in range(samples):
+        values = struct.unpack_from(format, buf, i*rowstride)
+        o = i*stride
+        for j in range(stride):
+            record[o+j] = values[j]
+        xs[i] = values[accel_index+1]
+        ys[i] = values[accel_index]
+        z = values[accel_index+2]
+        zs[i] = -z if z != -32768 else 32767
+
+def decode_chunk_m5stick_python(buf, xs, ys, zs, record,
+        rowstride=8, format='>hhh', accel_index=0):
+    """
+    Convert raw bytes into X,Y,Z int16 arrays, and all values into record, in one pass
+
+    If record is buf, the raw data was read directly into the record array (see is_native_layout),
+    and only the X,Y,Z values are extracted.
+    """
+    samples = len(xs)
+    assert len(ys) == samples
+    assert len(zs) == samples
+    stride = len(format)-1
+    assert len(record) == stride*samples, (len(record), stride*samples)
+
+    if record is buf:
+        for i in range(samples):
+            o = (i*stride) + accel_index
+            xs[i] = record[o]
+            ys[i] = record[o+1]
+            zs[i] = record[o+2]
+        return
+
+    assert len(buf) == rowstride*samples, (len(buf), rowstride*samples)
+    for i in range(samples):
+        values = struct.unpack_from(format, buf, i*rowstride)
+        o = i*stride
+        for j in range(stride):
+            record[o+j] = values[j]
+        xs[i] = values[accel_index]
+        ys[i] = values[accel_index+1]
+        zs[i] = values[accel_index+2]
+
+# Use versions accelerated with MicroPython native/viper emitters, when available
+# Otherwise fall back to the pure-Python versions
+try:
+    import kernels_native
+except (ImportError, SyntaxError):
+    kernels_native = None
+
+if kernels_native is None:
+    deinterleave_samples_xiao = deinterleave_samples_xiao_python
+    deinterleave_samples_m5stick = deinterleave_samples_m5stick_python
+    decode_samples = decode_samples_python
+    decode_chunk_xiao = decode_chunk_xiao_python
+    decode_chunk_m5stick = decode_chunk_m5stick_python
+else:
+    deinterleave_samples_xiao = kernels_native.deinterleave_samples_xiao
+    deinterleave_samples_m5stick = kernels_native.deinterleave_samples_m5stick
+    decode_samples = kernels_native.decode_samples
+    decode_chunk_xiao = kernels_native.decode_chunk_xiao
+    decode_chunk_m5stick = kernels_native.decode_chunk_m5stick
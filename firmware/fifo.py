@@ -0,0 +1,267 @@
+"""
+Waiting for samples in the IMU FIFO
+
+Either by polling the FIFO level, or woken by the FIFO watermark interrupt.
+Or by reading the FIFO in a separate thread, into a ring buffer
+"""
+
+import asyncio
+
+from compat import sleep_ms, thread_sleep_ms
+
+if hasattr(asyncio, 'ThreadSafeFlag'):
+    ThreadSafeFlag = asyncio.ThreadSafeFlag
+else:
+    class ThreadSafeFlag():
+        # NOTE: asyncio.Event is not thread-safe in CPython,
+        # so set() is passed to the loop of the waiting task
+        def __init__(self):
+            self.event = None
+            self.loop = None
+            self.pending = False
+
+        def set(self):
+            if self.loop is None or self.loop.is_closed():
+                # no wait() yet, or the loop of the last wait() has ended
+                self.pending = True
+            else:
+                self.loop.call_soon_threadsafe(self.event.set)
+
+        async def wait(self):
+            loop = asyncio.get_running_loop()
+            if self.loop is not loop:
+                # first wait, or used again from a new loop
+                self.event = asyncio.Event()
+                self.loop = loop
+            if self.pending:
+                # set() before wait() is consumed once
+                self.pending = False
+                self.event.set()
+            await self.event.wait()
+            self.event.clear()
+
+
+class FifoReader():
+    """
+    Wait until a hop of samples is ready in the IMU FIFO
+
+    In polling mode, the FIFO level is read every poll_interval_ms.
+    In interrupt mode, the task sleeps until notify() is called,
+    typically from the pin IRQ of the FIFO watermark interrupt.
+    The IMU must then have the watermark set to hop_length samples.
+    After wait(), acquire() reads the hop into buffer, and release() is called when done with it,
+    the same as with ThreadedReader.
+    Also counts FIFO level reads (bus transactions) and wakeups, for comparing the two modes.
+    """
+
+    def __init__(self, imu, hop_length, buffer, interrupt=False, poll_interval_ms=10):
+        self.imu = imu
+        self.hop_length = hop_length
+        self.buffer = buffer
+        self.poll_interval_ms = poll_interval_ms
+
+        if interrupt:
+            self.flag = ThreadSafeFlag()
+        else:
+            self.flag = None
+
+        # statistics
+        self.level_reads = 0
+        self.wakeups = 0
+        self.hops = 0
+
+    def notify(self, pin=None):
+        """
+        Signal that the FIFO watermark was reached. Safe to call from an IRQ handler
+        """
+        self.flag.set()
+
+    async def wait(self):
+        """
+        Return the number of samples in the FIFO, once at least hop_length are available
+        """
+        while True:
+            count = self.imu.get_fifo_count()
+            self.level_reads += 1
+            if count >= self.hop_length:
+                self.hops += 1
+                return count
+
+            if self.flag is None:
+                await sleep_ms(self.poll_interval_ms)
+            else:
+                await self.flag.wait()
+            self.wakeups += 1
+
+    def acquire(self):
+        """
+        Read a hop of raw samples from the IMU FIFO into buffer, and return it
+        """
+        self.imu.read_samples_into(self.buffer)
+        return self.buffer
+
+    def release(self):
+        pass
+
+    def stats(self):
+        """
+        Return FIFO level reads and wakeups per hop
+        """
+        hops = max(self.hops, 1)
+        return self.level_reads / hops, self.wakeups / hops
+
+
+class SampleRing():
+    """
+    Single-producer single-consumer ring buffer of hops of raw IMU samples
+
+    Lock-free: head is only changed by the producer, and tail only by the consumer.
+    Holds up to slots-1 hops.
+    """
+
+    def __init__(self, slots, slot_bytes):
+        self.slots = slots
+        self.buffers = [ bytearray(slot_bytes) for _ in range(slots) ]
+        self.head = 0 # next slot to write
+        self.tail = 0 # next slot to read
+
+    def available(self):
+        """
+        Number of hops ready for the consumer
+        """
+        return (self.head - self.tail) % self.slots
+
+    def write_slot(self):
+        """
+        Buffer to write the next hop into, or None if full. Producer only
+        """
+        if (self.head + 1) % self.slots == self.tail:
+            return None
+        return self.buffers[self.head]
+
+    def commit(self):
+        """
+        Make the hop written into write_slot() available. Producer only
+        """
+        self.head = (self.head + 1) % self.slots
+
+    def read_slot(self):
+        """
+        Buffer with the oldest hop, or None if empty. Consumer only
+        """
+        if self.head == self.tail:
+            return None
+        return self.buffers[self.tail]
+
+    def release(self):
+        """
+        Give the slot from read_slot() back to the producer. Consumer only
+        """
+        self.tail = (self.tail + 1) % self.slots
+
+
+class ThreadedReader():
+    """
+    Read the IMU FIFO in a separate thread, so a slow hop does not delay the next FIFO read
+
+    The thread polls the FIFO level, and reads whole hops into a SampleRing.
+    The processing task uses wait() like FifoReader, then acquire() to get the oldest hop,
+    and release() when done with it.
+    If the ring is full, the hop is read from the IMU anyway, to not overrun its FIFO, and dropped.
+    These are counted in overflows.
+    NOTE: the IMU must not be accessed by anything else while the thread runs.
+    Needs _thread, which is not available on all ports.
+    """
+
+    def __init__(self, imu, hop_length, bytes_per_sample, slots=8, poll_interval_ms=10):
+        import _thread
+        self._thread = _thread
+        self.imu = imu
+        self.hop_length = hop_length
+        self.poll_interval_ms = poll_interval_ms
+        self.ring = SampleRing(slots, hop_length*bytes_per_sample)
+        self.scratch = bytearray(hop_length*bytes_per_sample)
+        self.flag = ThreadSafeFlag()
+        self.running = False
+        self.error = None
+        self.done = _thread.allocate_lock()
+
+        # statistics
+        self.level_reads = 0 # by thread
+        self.overflows = 0 # by thread
+        self.high_water = 0 # by thread, in hops
+        self.wakeups = 0
+        self.hops = 0
+
+    def start(self):
+        self.running = True
+        self.done.acquire()
+        self._thread.start_new_thread(self._run, ())
+
+    def stop(self):
+        """
+        Stop the thread, and wait for it to exit
+        """
+        self.running = False
+        self.done.acquire()
+        self.done.release()
+
+    def _run(self):
+        ring = self.ring
+        hop_length = self.hop_length
+        try:
+            while self.running:
+                count = self.imu.get_fifo_count()
+                self.level_reads += 1
+                if count < hop_length:
+                    thread_sleep_ms(self.poll_interval_ms)
+                    continue
+
+                while count >= hop_length:
+                    buf = ring.write_slot()
+                    if buf is None:
+                        self.imu.read_samples_into(self.scratch)
+                        self.overflows += 1
+                    else:
+                        self.imu.read_samples_into(buf)
+                        ring.commit()
+                    count -= hop_length
+                self.high_water = max(self.high_water, ring.available())
+                self.flag.set()
+        except Exception as e:
+            self.error = e
+            self.flag.set()
+        finally:
+            self.running = False
+            self.done.release()
+
+    async def wait(self):
+        """
+        Return the number of samples in the ring, once at least hop_length are available
+        """
+        while True:
+            if self.error is not None:
+                raise self.error
+            available = self.ring.available()
+            if available > 0:
+                self.hops += 1
+                return available * self.hop_length
+
+            await self.flag.wait()
+            self.wakeups += 1
+
+    def acquire(self):
+        """
+        Return buffer with the oldest hop of raw samples
+        """
+        return self.ring.read_slot()
+
+    def release(self):
+        self.ring.release()
+
+    def stats(self):
+        """
+        Return FIFO level reads and wakeups per hop, and number of dropped hops
+        """
+        hops = max(self.hops, 1)
+        return self.level_reads / hops, self.wakeups / hops, self.overflows
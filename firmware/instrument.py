@@ -0,0 +1,168 @@
+"""
+Lightweight timing instrumentation for the processing loop
+
+Fixed-size histograms per stage, that do not allocate when recording.
+Works on MicroPython and CPython
+"""
+
+import array
+
+from compat import ticks_us, ticks_diff
+
+
+class Histogram():
+    """
+    Histogram of durations in microseconds, with logarithmic bins
+
+    Values below 4 are exact. Above, each power of two is split in 4 bins,
+    so percentiles are within 25% of the true value.
+    Values above 2**max_bits are counted in the last bin.
+    """
+
+    SUBBINS = 4
+
+    def __init__(self, max_bits=24):
+        self.n_bins = self.SUBBINS * max_bits
+        self.bins = array.array('I', (0 for _ in range(self.n_bins)))
+        self.reset()
+
+    def reset(self):
+        bins = self.bins
+        for i in range(len(bins)):
+            bins[i] = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def bin_index(self, value):
+        if value < 4:
+            return max(value, 0)
+        # position of highest set bit
+        b = 0
+        v = value
+        while v > 1:
+            v >>= 1
+            b += 1
+        sub = (value >> (b-2)) & 3
+        return min(4*(b-1) + sub, self.n_bins-1)
+
+    def bin_upper(self, index):
+        """
+        Largest value that goes into bin index
+        """
+        if index < 4:
+            return index
+        b = (index // 4) + 1
+        sub = index % 4
+        return ((4 + sub + 1) << (b-2)) - 1
+
+    def record(self, value):
+        self.bins[self.bin_index(value)] += 1
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """
+        Value at percentile q (0-100). Upper edge of the bin, clipped to min/max
+        """
+        if self.count == 0:
+            return None
+        target = (self.count * q + 99) // 100
+        cumulative = 0
+        for i in range(self.n_bins):
+            cumulative += self.bins[i]
+            if cumulative >= max(target, 1):
+                return max(self.min, min(self.bin_upper(i), self.max))
+        return self.max
+
+    def summary(self):
+        """
+        Return count, min, p50, p95, max
+        """
+        return self.count, self.min, self.percentile(50), self.percentile(95), self.max
+
+
+class StageTimer():
+    """
+    Times consecutive stages of a loop iteration, into one Histogram per stage
+
+    Call begin() at the start of an iteration, lap(stage) at the end of each stage,
+    and end() to also record the total time of the iteration as 'total'.
+    """
+
+    def __init__(self, stages, **kwargs):
+        self.stages = tuple(stages) + ('total', )
+        self.histograms = {}
+        for name in self.stages:
+            self.histograms[name] = Histogram(**kwargs)
+        self.start = ticks_us()
+        self.last = self.start
+
+    def begin(self):
+        self.start = ticks_us()
+        self.last = self.start
+
+    def lap(self, stage):
+        now = ticks_us()
+        self.histograms[stage].record(ticks_diff(now, self.last))
+        self.last = now
+
+    def end(self):
+        now = ticks_us()
+        self.histograms['total'].record(ticks_diff(now, self.start))
+        self.last = now
+
+    def reset(self):
+        for h in self.histograms.values():
+            h.reset()
+
+    def summary(self):
+        """
+        Return dict of stage name to (count, min, p50, p95, max), in microseconds
+        """
+        out = {}
+        for name in self.stages:
+            out[name] = self.histograms[name].summary()
+        return out
+
+    def report(self, prefix='stage-times'):
+        """
+        Print one line per stage: name count min p50 p95 max
+        """
+        for name in self.stages:
+            print(prefix, name, *self.histograms[name].summary())
+
+
+async def serve_commands(timer, reader=None, others=(), log=None):
+    """
+    Answer commands on the serial console, so stage times can be queried on demand
+
+    'stats' prints the report, 'reset' clears the histograms.
+    others are also reported on 'stats', anything with a report() method.
+    'log' prints the pending records of log, a binlog.BinaryLog.
+    reader must have async readline(). Defaults to sys.stdin
+    """
+    if reader is None:
+        import sys
+        import asyncio
+        reader = asyncio.StreamReader(sys.stdin)
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        if isinstance(line, bytes):
+            line = line.decode()
+        command = line.strip()
+        if command == 'stats':
+            timer.report()
+            for o in others:
+                o.report()
+        elif command == 'reset':
+            timer.reset()
+            print('stage-times-reset')
+        elif command == 'log' and log is not None:
+            log.report()
@@ -0,0 +1,260 @@
+"""
+Hot kernels accelerated using the MicroPython native and viper code emitters
+
+Only importable on MicroPython ports with the emitters enabled.
+core.py and decode.py select these at import time, and otherwise use the pure-Python versions.
+All functions give identical outputs to the pure-Python versions, for int16 arrays.
+The speedup on device has not been measured yet. bench_kernels() in benchmark.py prints it for the running port.
+"""
+
+import math
+import micropython
+
+
+# formats that passed check_format, with their endianness
+_checked_formats = {}
+
+def check_format(format):
+    """
+    Return 1 if format is big-endian int16 values, 0 if little-endian
+
+    Each format is only parsed the first time, so calls on the hot path do not allocate
+    """
+    endian = _checked_formats.get(format)
+    if endian is None:
+        if format[0] not in ('<', '>') or format[1:] != ('h' * (len(format)-1)):
+            raise ValueError('Unsupported format ' + format)
+        endian = 1 if format[0] == '>' else 0
+        _checked_formats[format] = endian
+    return endian
+
+# NOTE: viper functions can take at most 4 arguments
+
+@micropython.viper
+def _sum_int16(arr) -> int:
+    p = ptr16(arr)
+    n = int(len(arr))
+    s = 0
+    for i in range(n):
+        v = int(p[i])
+        if v > 32767:
+            v -= 65536
+        s += v
+    return s
+
+@micropython.viper
+def _unpack_int16_le(buf, out, start : int, stride : int):
+    src = ptr8(buf)
+    dst = ptr16(out)
+    n = int(len(out))
+    idx = start
+    for i in range(n):
+        dst[i] = src[idx] | (src[idx+1] << 8)
+        idx += stride
+
+@micropython.viper
+def _unpack_int16_be(buf, out, start : int, stride : int):
+    src = ptr8(buf)
+    dst = ptr16(out)
+    n = int(len(out))
+    idx = start
+    for i in range(n):
+        dst[i] = (src[idx] << 8) | src[idx+1]
+        idx += stride
+
+@micropython.viper
+def _gather_int16(src, out, start : int, stride : int):
+    s = ptr16(src)
+    dst = ptr16(out)
+    n = int(len(out))
+    idx = start
+    for i in range(n):
+        dst[i] = s[idx]
+        idx += stride
+
+@micropython.viper
+def _negate_int16(out):
+    dst = ptr16(out)
+    n = int(len(out))
+    for i in range(n):
+        v = int(dst[i])
+        # -(-32768) does not fit in int16, saturate like the Python versions
+        if v == 0x8000:
+            dst[i] = 32767
+        else:
+            dst[i] = 0 - v
+
+@micropython.viper
+def _decode_int16_le(buf, out, in_stride : int, out_stride : int):
+    src = ptr8(buf)
+    dst = ptr16(out)
+    total = int(len(out))
+    skip = in_stride - (out_stride << 1)
+    s = 0
+    d = 0
+    while d < total:
+        for j in range(out_stride):
+            dst[d] = src[s] | (src[s+1] << 8)
+            d += 1
+            s += 2
+        s += skip
+
+@micropython.viper
+def _decode_int16_be(buf, out, in_stride : int, out_stride : int):
+    src = ptr8(buf)
+    dst = ptr16(out)
+    total = int(len(out))
+    skip = in_stride - (out_stride << 1)
+    s = 0
+    d = 0
+    while d < total:
+        for j in range(out_stride):
+            dst[d] = (src[s] << 8) | src[s+1]
+            d += 1
+            s += 2
+        s += skip
+
+@micropython.viper
+def or_int16(values) -> int:
+    src = ptr16(values)
+    n = int(len(values))
+    bits = 0
+    for i in range(n):
+        bits |= int(src[i])
+    return bits
+
+@micropython.viper
+def encode_delta_varint(values, out, items : int, shift : int) -> int:
+    src = ptr16(values)
+    dst = ptr8(out)
+    total = int(len(values))
+    n = 0
+    for i in range(total):
+        v = int(src[i])
+        if v > 32767:
+            v -= 65536
+        v = v >> shift
+        if i >= items:
+            prev = int(src[i-items])
+            if prev > 32767:
+                prev -= 65536
+            v -= prev >> shift
+        if v >= 0:
+            z = v << 1
+        else:
+            z = ((0 - v) << 1) - 1
+        while z >= 0x80:
+            dst[n] = (z & 0x7F) | 0x80
+            z = z >> 7
+            n += 1
+        dst[n] = z
+        n += 1
+    return n
+
+
+def mean(arr):
+    m = _sum_int16(arr) / float(len(arr))
+    return m
+
+@micropython.native
+def energy_xyz(xs, ys, zs, orientation):
+    assert len(xs) == len(ys)
+    assert len(ys) == len(zs)
+
+    xo, yo, zo = orientation
+
+    # compute RMS of magnitude, after having removed orientation
+    s = 0.0
+    for i in range(len(xs)):
+        dx = xs[i] - xo
+        dy = ys[i] - yo
+        dz = zs[i] - zo
+        s += (dx*dx) + (dy*dy) + (dz*dz)
+
+    rms = math.sqrt(s)
+    return rms
+
+def deinterleave_samples_xiao(buf : bytearray,
+        xs, ys, zs, rowstride=6, offset=0, format='>hhh'):
+    """
+    Convert raw bytes into X,Y,Z int16 arrays
+    """
+    assert (len(buf) % rowstride) == 0
+    samples = len(buf) // rowstride
+    assert len(xs) == samples
+    assert len(ys) == samples
+    assert len(zs) == samples
+    unpack = _unpack_int16_be if check_format(format) else _unpack_int16_le
+
+    # axes are mapped to Y,X,-Z
+    unpack(buf, xs, offset+2, rowstride)
+    unpack(buf, ys, offset+0, rowstride)
+    unpack(buf, zs, offset+4, rowstride)
+    _negate_int16(zs)
+
+def deinterleave_samples_m5stick(buf : bytearray,
+        xs, ys, zs, rowstride=6, offset=0, format='>hhh'):
+    """
+    Convert raw bytes into X,Y,Z int16 arrays
+    """
+    assert (len(buf) % rowstride) == 0
+    samples = len(buf) // rowstride
+    assert len(xs) == samples
+    assert len(ys) == samples
+    assert len(zs) == samples
+    unpack = _unpack_int16_be if check_format(format) else _unpack_int16_le
+
+    unpack(buf, xs, offset+0, rowstride)
+    unpack(buf, ys, offset+2, rowstride)
+    unpack(buf, zs, offset+4, rowstride)
+
+def decode_samples(
+        buf : bytearray,
+        samples,
+        rowstride,
+        offset=0,
+        format='<hhhhhh',
+    ):
+    """
+    Convert raw bytes for gyro+accelerometer into int16 array
+    """
+    in_stride = rowstride
+    assert (len(buf) % in_stride) == 0
+    n_samples = len(buf) // in_stride
+
+    out_stride = len(format)-1
+    assert len(samples) == out_stride*n_samples, (len(samples), out_stride*n_samples)
+    decode = _decode_int16_be if check_format(format) else _decode_int16_le
+
+    if offset != 0:
+        buf = memoryview(buf)[offset:]
+    decode(buf, samples, in_stride, out_stride)
+
+def decode_chunk_xiao(buf, xs, ys, zs, record,
+        rowstride=12, format='<hhhhhh', accel_index=3):
+    """
+    Convert raw bytes into X,Y,Z int16 arrays (from Y,X,-Z), and all values into record
+    """
+    stride = len(format)-1
+    assert len(record) == stride*len(xs), (len(record), stride*len(xs))
+    if record is not buf:
+        decode_samples(buf, record, rowstride, format=format)
+
+    _gather_int16(record, xs, accel_index+1, stride)
+    _gather_int16(record, ys, accel_index+0, stride)
+    _gather_int16(record, zs, accel_index+2, stride)
+    _negate_int16(zs)
+
+def decode_chunk_m5stick(buf, xs, ys, zs, record,
+        rowstride=8, format='>hhh', accel_index=0):
+    """
+    Convert raw bytes into X,Y,Z int16 arrays, and all values into record
+    """
+    stride = len(format)-1
+    assert len(record) == stride*len(xs), (len(record), stride*len(xs))
+    if record is not buf:
+        decode_samples(buf, record, rowstride, format=format)
+
+    _gather_int16(record, xs, accel_index+0, stride)
+    _gather_int16(record, ys, accel_index+1, stride)
+    _gather_int16(record, zs, accel_index+2, stride)
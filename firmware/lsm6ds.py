@@ -12,14 +12,22 @@ WHO_AM_I = const(0x0F)
 CTRL1_XL = const(0x10) # accelerometer config
 CTRL2_G = const(0x11) # gyro config
 CTRL3_C = const(0x12)
+CTRL6_C = const(0x15)
+CTRL7_G = const(0x16)
 CTRL8_XL = const(0x17)
 CTRL10_C = const(0x19)
 STATUS_REG = const(0x1E)
 
 # FIFO registers
 CTRL5_C = const(0x14)
+FIFO_CTRL1 = const(0x06)
+FIFO_CTRL2 = const(0x07)
+INT1_CTRL = const(0x0D)
 FIFO_CTRL5 = const(0x0A)
 FIFO_STATUS1 = const(0x3A)
+FIFO_STATUS2 = const(0x3B)
+FIFO_STATUS3 = const(0x3C)
+FIFO_STATUS4 = const(0x3D)
 FIFO_DATA_OUT_L = const(0x3E)
 FIFO_CTRL3 = const(0x08)
 
@@ -53,6 +61,16 @@ TAP_THRESHOLD = const(0x02)
 DOUBLE_TAP_EN = const(0x80)
 DOUBLE_TAP_DUR = const(0x20)
 
+# Output data rate in Hz, to ODR_XL / ODR_G / ODR_FIFO register value
+ODR_CODES = (
+    (12.5, 0b0001),
+    (26, 0b0010),
+    (52, 0b0011),
+    (104, 0b0100),
+    (208, 0b0101),
+    (416, 0b0110),
+)
+
 ACCEL_FMT = "<hhh"
 GYRO_FMT = "<hhh"
 COMBO_FMT = "<hhhhhh"
@@ -64,6 +82,18 @@ class LSM6DS3:
         self.address = address
         self.mode = mode
 
+        # preallocated buffers, so that register access does not allocate
+        self._write_buffer = bytearray(1)
+        self._fifo_status = bytearray(4)
+        self._fifo_discard = bytearray(12)
+
+        # FIFO status, updated by get_fifo_count()
+        self.fifo_overrun = False # samples were lost since last read
+        self.fifo_misaligned = False # next read does not start at a sample boundary
+        self.fifo_pattern = 0 # index of next word to be read, within a sample
+        self.fifo_overruns = 0 # times the FIFO went into overrun
+        self.fifo_realigns = 0
+
         # Check that we have the expected type of device
         ID_LSM6DS3TR_C = 0x6A
         ID_LSM6DS3 = 0x69
@@ -81,41 +111,43 @@ class LSM6DS3:
         self.sample_buffer = bytearray(7)
 
         # Set gyro mode/enable
-        self.bus.writeto_mem(self.address, CTRL2_G, bytearray([self.mode]))
+        self._write_byte(CTRL2_G, self.mode)
 
         # Set accel mode/enable
-        self.bus.writeto_mem(self.address, CTRL1_XL, bytearray([self.mode]))
+        self._write_byte(CTRL1_XL, self.mode)
 
         # Send the reset bit to clear the pedometer step count
-        self.bus.writeto_mem(self.address, CTRL10_C, bytearray([RESET_STEPS]))
+        self._write_byte(CTRL10_C, RESET_STEPS)
 
         # Enable sensor functions (Tap, Tilt, Significant Motion)
-        self.bus.writeto_mem(self.address, CTRL10_C, bytearray([SET_FUNC_EN]))
+        self._write_byte(CTRL10_C, SET_FUNC_EN)
 
         # Enable X Y Z Tap Detection
-        self.bus.writeto_mem(self.address, TAP_CFG, bytearray([TAP_EN_XYZ]))
+        self._write_byte(TAP_CFG, TAP_EN_XYZ)
 
         # Enable Double tap
-        self.bus.writeto_mem(self.address, WAKE_UP_THS, bytearray([DOUBLE_TAP_EN]))
+        self._write_byte(WAKE_UP_THS, DOUBLE_TAP_EN)
 
         # Set tap threshold
-        self.bus.writeto_mem(self.address, TAP_THS_6D, bytearray([TAP_THRESHOLD]))
+        self._write_byte(TAP_THS_6D, TAP_THRESHOLD)
 
         # Set double tap max time gap
-        self.bus.writeto_mem(self.address, INT_DUR2, bytearray([DOUBLE_TAP_DUR]))
+        self._write_byte(INT_DUR2, DOUBLE_TAP_DUR)
 
         # enable BDU and IF_INC
-        self.bus.writeto_mem(self.address, CTRL3_C, bytearray([0b0100_0100]))
+        self._write_byte(CTRL3_C, 0b0100_0100)
 
 
     def _write_byte(self, reg, value):
-        self.bus.writeto_mem(self.address, reg, bytearray([value]))
+        buf = self._write_buffer
+        buf[0] = value
+        self.bus.writeto_mem(self.address, reg, buf)
 
     def _read_reg(self, reg, size):
         return self.bus.readfrom_mem(self.address, reg, size)
     
     def set_hp_filter(self, mode):
-        self.bus.writeto_mem(self.address, CTRL8_XL, bytearray([self.mode]))
+        self._write_byte(CTRL8_XL, self.mode)
 
     def get_readings(self) -> tuple[int, int, int, int, int, int]:
         # Read 12 bytes starting from 0x22. This covers the XYZ data for gyro and accel
@@ -140,9 +172,9 @@ class LSM6DS3:
 
     def reset_step_count(self):
         # Send the reset bit
-        self.bus.writeto_mem(self.address, CTRL10_C, bytearray([RESET_STEPS]))
+        self._write_byte(CTRL10_C, RESET_STEPS)
         # Enable functions again
-        self.bus.writeto_mem(self.address, CTRL10_C, bytearray([SET_FUNC_EN]))
+        self._write_byte(CTRL10_C, SET_FUNC_EN)
 
     def tilt_detected(self):
         tilt = self._read_reg(FUNC_SRC1, 1)
@@ -190,16 +222,16 @@ class LSM6DS3:
 
         # Set ODR
         val += (0x40 >> 1)
-        self.bus.writeto_mem(self.address, FIFO_CTRL5, bytearray([val]))
+        self._write_byte(FIFO_CTRL5, val)
 
         # Enable gyro and accel without decimation
         val = 0b00001001
-        self.bus.writeto_mem(self.address, FIFO_CTRL3, bytearray([val]))
+        self._write_byte(FIFO_CTRL3, val)
 
         # Set "rounding" of the FIFO readout, accel+gyro
         val = 0b0000_0000
         val += (0b011 << 5)
-        self.bus.writeto_mem(self.address, CTRL5_C, bytearray([val]))
+        self._write_byte(CTRL5_C, val)
 
         # TODO, maybe set STOP_ON_FTH bit of the CTRL4_C and the FIFO limit?
         # Ref https://community.st.com/t5/mems-sensors/lsm6ds3-fifo-data-corruption-on-random-basis/td-p/270429
@@ -207,19 +239,90 @@ class LSM6DS3:
         # XXX: 5.5 FIFO, To guarantee the correct acquisition of data during
         # the switching into and out of FIFO mode, the first sample acquired must be discarded
 
+    def set_odr(self, hz, low_power=False):
+        """
+        Change output data rate of accelerometer, gyro and FIFO, keeping full-scale settings
+
+        With low_power, high-performance mode is disabled. Only has effect at 52 Hz and below.
+        NOTE: samples already in the FIFO were taken at the previous rate
+        """
+        code = None
+        for rate, c in ODR_CODES:
+            if rate == hz:
+                code = c
+        if code is None:
+            raise ValueError("Unsupported ODR {}".format(hz))
+
+        # XL_HM_MODE / G_HM_MODE, 1 disables high-performance mode
+        self._write_byte(CTRL6_C, 0b0001_0000 if low_power else 0)
+        self._write_byte(CTRL7_G, 0b1000_0000 if low_power else 0)
+
+        self.mode = (code << 4) | (self.mode & 0x0F)
+        self._write_byte(CTRL2_G, self.mode)
+        self._write_byte(CTRL1_XL, self.mode)
+
+        FIFO_MODE_CONTINIOUS = 0b110
+        self._write_byte(FIFO_CTRL5, (code << 3) | FIFO_MODE_CONTINIOUS)
+
+    def set_fifo_watermark(self, samples):
+        """
+        Set the FIFO threshold to a number of samples, and route the threshold interrupt to INT1 pin
+
+        INT1 goes high when the FIFO has at least this many samples
+        """
+        words = samples * 6 # 3 gyro plus 3 accel
+        # FTH is 11 bits on LSM6DS3TR-C, 12 bits on LSM6DS3
+        assert words < 2048, words
+        self._write_byte(FIFO_CTRL1, words & 0xFF)
+        self._write_byte(FIFO_CTRL2, (words >> 8) & 0b0111)
+
+        INT1_FTH = 0b0000_1000
+        self._write_byte(INT1_CTRL, INT1_FTH)
+
     def get_fifo_count(self):
         """
         Return the number of samples ready in the FIFO
+
+        Reads FIFO_STATUS1-4 in one transaction, and also updates
+        fifo_overrun, fifo_overruns and fifo_misaligned
         """
-        buf = bytearray(2)
+        buf = self._fifo_status
         self.bus.readfrom_mem_into(self.address, FIFO_STATUS1, buf)
-        
+        status2 = buf[1]
+
+        # OVER_RUN stays set until the FIFO is read, only count when it goes high
+        OVER_RUN = 0b0100_0000
+        overrun = (status2 & OVER_RUN) != 0
+        if overrun and not self.fifo_overrun:
+            self.fifo_overruns += 1
+        self.fifo_overrun = overrun
+
+        # FIFO_PATTERN is the index of the next word to be read, within a sample
+        # With gyro+accel: 0=GX ... 5=AZ. Anything else means reads will not start at GX
+        pattern = ((buf[3] & 0b11) << 8) + buf[2]
+        self.fifo_pattern = pattern
+        self.fifo_misaligned = pattern != 0
+
         # only 4 bit from FIFO_STATUS2 is part of the count
-        fifo_words = ((buf[1] & 0b1111) << 8) + buf[0]
+        fifo_words = ((status2 & 0b1111) << 8) + buf[0]
         fifo_count = fifo_words // 6 # 3 gyro plus 3 accel
-        #print('fifo count', buf, fifo_words, fifo_count)
         return fifo_count
 
+    def fifo_realign(self):
+        """
+        Discard the rest of a partially read sample, so that the next read starts at GX
+
+        Uses fifo_pattern from the last get_fifo_count(). Returns number of words discarded
+        """
+        words = (6 - self.fifo_pattern) % 6
+        if words:
+            discard = memoryview(self._fifo_discard)[:2*words]
+            self.bus.readfrom_mem_into(self.address, FIFO_DATA_OUT_L, discard)
+            self.fifo_realigns += 1
+        self.fifo_pattern = 0
+        self.fifo_misaligned = False
+        return words
+
     def read_samples_into(self, buf):
         """
         Read gyro+accelerometer samples from the FIFO
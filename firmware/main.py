@@ -5,15 +5,23 @@ from machine import Pin, I2C
 import gc
 import time
 import math
-import struct
 import array
 import asyncio
 import sys
 
 sys.path.insert(0, 'lib/') # XXX: why not on path?
 
-from core import StateMachine, OutputManager, DataProcessor, empty_array, clamp
+from core import StateMachine, OutputManager, DataProcessor, SampleClock, RateController
+from core import empty_array, clamp
+from instrument import StageTimer, serve_commands
+from memory import CollectionScheduler
+from binlog import BinaryLog, scaled, state_index
+from binlog import EVENT_INPUTS, EVENT_PROGRESS, EVENT_LATENCY, EVENT_SAMPLERATE
+from decode import deinterleave_samples_xiao, deinterleave_samples_m5stick
+from decode import decode_chunk_xiao, decode_chunk_m5stick, is_native_layout
+from fifo import FifoReader, ThreadedReader
 from recorder import Recorder
+from recording import AsyncRecorder, CompressedRecorder, SegmentedRecorder
 
 HW_M5STICK_PLUS2 = 'm5stick-plus2'
 HW_XIAO_BLE_SENSE = 'xiao-ble-sense'
@@ -40,90 +48,33 @@ def _test_outputs_asyncio():
     states = sm._state_functions.keys()
     out = OutputManager(buzzer_pin=buzzer_pin, led_pin=led_pin)
 
+    asyncio.create_task(out.run())
+
     for state in states:
         sub_states = [0]
         if state == 'brushing':
             sub_states = list(range(0, 4))
         for sub in sub_states:
             print('test-output-state', state)
-            await out.run(state, sub)
-            asyncio.sleep_ms(1000)
+            out.update(state, sub)
+            await asyncio.sleep_ms(2000)
 
 def test_outputs():
     asyncio.run(_test_outputs_asyncio()) 
 
-def deinterleave_samples_xiao(buf : bytearray,
-        xs, ys, zs, rowstride=6, offset=0, format='>hhh'):
-    """
-    Convert raw bytes into X,Y,Z int16 arrays
-    """
-    assert (len(buf) % rowstride) == 0
-    samples = len(buf) // rowstride
-    assert len(xs) == samples
-    assert len(ys) == samples
-    assert len(zs) == samples
-
-    for i in range(samples):
-        idx = offset + (i*rowstride)
-        x, y, z = struct.unpack_from(format, buf, idx)
-        xs[i] = y
-        ys[i] = x
-        zs[i] = -z
-
-def deinterleave_samples_m5stick(buf : bytearray,
-        xs, ys, zs, rowstride=6, offset=0, format='>hhh'):
-    """
-    Convert raw bytes into X,Y,Z int16 arrays
-    """
-    assert (len(buf) % rowstride) == 0
-    samples = len(buf) // rowstride
-    assert len(xs) == samples
-    assert len(ys) == samples
-    assert len(zs) == samples
-
-    for i in range(samples):
-        idx = offset + (i*rowstride)
-        x, y, z = struct.unpack_from(format, buf, idx)
-        xs[i] = x
-        ys[i] = y
-        zs[i] = z
-
-def decode_samples(
-        buf : bytearray,
-        samples : array.array,
-        rowstride,
-        offset=0,
-        format='<hhhhhh',
-    ):
-    """
-    Convert raw bytes for gyro+accelerometer into int16 array
-    """
-
-    in_stride = rowstride
-    assert (len(buf) % in_stride) == 0
-    n_samples = len(buf) // in_stride
-
-    out_stride = len(format)-1
-    assert len(samples) == out_stride*n_samples, (len(samples), out_stride*n_samples)
-
-    #view = memoryview(buf)
-    for i in range(n_samples):
-        idx = offset + (i*in_stride)
-        values = struct.unpack_from(format, buf, idx)
-        for j, v in enumerate(values):
-            samples[(i*out_stride)+j] = v
-
 def main():
 
     print('init-start')
 
     # Settings
     hop_length = 50
+    # NOTE: must match the window used when training the model
     window_length = hop_length
 
     # FIXME: standardize configuration between hardwares
     if hardware == HW_M5STICK_PLUS2:
         samplerate = 50
+        sleep_samplerate = 25
         accel_offset = 0 # data is AxAyAzTc
         accel_format = '>hhh'
         # FIXME: make MPU also support gyro
@@ -131,17 +82,27 @@ def main():
         record_format = '>hhh'
     else:
         samplerate = 52
+        sleep_samplerate = 26
         bytes_per_sample = 12
         accel_offset = 6 # data is GxGyGzAxAyAz
         record_format = '<hhhhhh'
         accel_format = '<hhh'
 
+    # read the IMU FIFO in a separate thread, so a slow hop does not delay reading.
+    # Needs _thread, for example ESP32 on M5Stick
+    imu_threaded = False
+
     record_enable = True
     record_duration = 20.0
     record_dir = 'har_record'
     record_class = 'brushing'
+    # 'npy' one file per record_duration, 'hrz' same with delta/varint compression,
+    # 'hrs' one file per session, with a new segment every record_duration
+    # NOTE: 'hrz' is off by default. It only saves 10-16% on the brushing data,
+    # and the encode time per hop has not been measured on device, see bench_record_encode in benchmark.py
+    record_container = 'npy'
+    record_samples = len(record_format) - 1 # values per sample, 3 (M5Stick) or 6 (XIAO)
     if record_enable:
-        record_samples = len(record_format) - 1
         record_buffer = array.array('h', (0 for _ in range(record_samples*hop_length))) # decoded int16
     else:
         record_buffer = None
@@ -150,7 +111,11 @@ def main():
     x_values = empty_array('h', hop_length)
     y_values = empty_array('h', hop_length)
     z_values = empty_array('h', hop_length)
-    chunk = bytearray(bytes_per_sample*hop_length)
+    if record_enable and is_native_layout(record_format, bytes_per_sample) and not imu_threaded:
+        # read FIFO straight into the record buffer, no decoding needed
+        chunk = record_buffer
+    else:
+        chunk = bytearray(bytes_per_sample*hop_length)
 
     print('setup-hardware-start')
 
@@ -176,6 +141,11 @@ def main():
         assert imu.bytes_per_sample == bytes_per_sample,\
             (imu.bytes_per_sample, bytes_per_sample)
         deinterleave_samples = deinterleave_samples_m5stick
+        decode_chunk = decode_chunk_m5stick
+        # FIXME: use FIFO watermark interrupt, needs support in MPU6886 driver
+        imu_int_pin = None
+        imu_low_power = False
+        imu_fifo_status = False
 
     elif hardware == HW_XIAO_BLE_SENSE:
         print('hardware-init-xiao-ble-sense')
@@ -196,6 +166,14 @@ def main():
 
         imu.fifo_enable(True)
         deinterleave_samples = deinterleave_samples_xiao
+        decode_chunk = decode_chunk_xiao
+
+        # INT1 of the LSM6DS3TR-C is connected to P0.11
+        imu.set_fifo_watermark(hop_length)
+        imu_int_pin = machine.Pin(("gpio0", 11), machine.Pin.IN)
+        imu_low_power = True
+        # driver tracks FIFO overruns and misalignment
+        imu_fifo_status = True
 
 
     else:
@@ -205,14 +183,45 @@ def main():
 
     out = OutputManager(buzzer_pin=buzzer_pin, led_pin=led_pin)
 
-    processor = DataProcessor()
-    sm = StateMachine(time=time.time(), verbose=1, prediction_filter_length=3)
+    if imu_threaded:
+        # hops are read into a ring buffer by the thread, and taken from there
+        fifo = ThreadedReader(imu, hop_length, bytes_per_sample)
+    else:
+        # Wake up on FIFO watermark interrupt if available, otherwise poll the FIFO level
+        fifo = FifoReader(imu, hop_length, chunk, interrupt=imu_int_pin is not None)
+        if imu_int_pin is not None:
+            imu_int_pin.irq(fifo.notify, trigger=machine.Pin.IRQ_RISING)
+
+    # skip brushing model while still, motion_gate well below StateMachine.motion_threshold
+    # per-stage time histograms. Type 'stats' on the serial console to print them
+    stages = StageTimer(('read', 'decode', 'orientation', 'features', 'predict', 'state', 'outputs'))
+
+    processor = DataProcessor(fixed_point=True, samplerate=samplerate, stages=stages,
+        window_length=None if window_length == hop_length else window_length, hop_length=hop_length,
+        motion_gate=0.1)
+    # time is based on number of samples, time.time() only has 1 second resolution
+    clock = SampleClock(samplerate)
+    # per-hop tracing into a binary ring buffer instead of print().
+    # Type 'log' on the serial console to dump it, decode with binlog.py on the host
+    log = BinaryLog()
+    sm = StateMachine(time=clock.time(), verbose=1, prediction_filter_length=3, log=log)
+    # lower samplerate while sleeping
+    # NOTE: recordings assume a fixed samplerate, so recording is paused while at the sleep rate.
+    # Not with threaded reading, since the IMU is then only accessed by the reader thread
+    if imu_threaded:
+        sleep_samplerate = samplerate
+    rates = RateController(imu, processor, clock,
+        full_rate=samplerate, sleep_rate=sleep_samplerate, low_power=imu_low_power)
 
     # TEST config
     sm.brushing_target_time = 20.0
     sm.idle_time_max = 5.0
     sm.brushing_started_time = 2.0
 
+    # garbage collection only after a hop is processed, not in the middle of FIFO reads
+    # NOTE: all buffers used per hop must be allocated before this point
+    collector = CollectionScheduler()
+
     print('init-done')
 
     def main_task():
@@ -220,55 +229,111 @@ def main():
 
         count = 0
 
-        with Recorder(samplerate, record_duration, directory=record_dir, items_per_sample=6) as recorder:
+        # outputs run independently, so playing a song does not stall processing
+        asyncio.create_task(out.run())
+
+        recorder_class = {
+            'npy': Recorder,
+            'hrz': CompressedRecorder,
+            'hrs': SegmentedRecorder,
+        }[record_container]
+        with recorder_class(samplerate, record_duration, directory=record_dir,
+                items_per_sample=record_samples) as recorder:
 
+            reporters = (collector, )
             if record_enable:
                 #recorder.delete()
                 recorder.set_class(record_class)
                 recorder.start()
-
+                # files are written by a background task, several hops at a time
+                writer = AsyncRecorder(recorder, hop_items=len(record_buffer))
+                asyncio.create_task(writer.run())
+                reporters = (collector, writer)
+                if record_container != 'npy':
+                    reporters += (recorder, )
+
+            asyncio.create_task(serve_commands(stages, others=reporters, log=log))
+
+            collector.start()
+            if imu_threaded:
+                fifo.start()
             while True:
 
-                count = imu.get_fifo_count()
+                count = await fifo.wait()
                 #print('fifo check', count)
+                if imu_fifo_status and not imu_threaded and imu.fifo_misaligned:
+                    # drop the partial sample, so that reads start at GX again
+                    imu.fifo_realign()
+                    count -= 1
                 if count >= hop_length:
-                    start = time.ticks_ms()
-
-                    # read data
-                    read_start = time.ticks_ms()
+                    stages.begin()
+                    collector.begin_hop()
 
-                    imu.read_samples_into(chunk)
-                    deinterleave_samples(chunk, x_values, y_values, z_values,
-                        rowstride=bytes_per_sample, offset=accel_offset, format=accel_format)
+                    # read data. From the IMU FIFO, or the ring buffer of the reader thread
+                    hop = fifo.acquire()
+                    clock.mark_read(backlog=count-hop_length)
+                    stages.lap('read')
 
                     if record_enable:
-                        decode_samples(chunk, record_buffer,
-                            format=record_format, rowstride=bytes_per_sample)
-                        recorder.process(record_buffer)
-
-                    read_duration = time.ticks_ms() - read_start
-
-                    process_start = time.ticks_ms()
-                    motion, brushing = processor.process(x_values, y_values, z_values)
-                    process_duration = time.ticks_ms() - process_start
-            
-                    t = time.time()
+                        # accelerometer and recording decoded in one pass
+                        decode_chunk(hop, x_values, y_values, z_values, record_buffer,
+                            rowstride=bytes_per_sample, format=record_format,
+                            accel_index=accel_offset//2)
+                        writer.process(record_buffer)
+                    else:
+                        deinterleave_samples(hop, x_values, y_values, z_values,
+                            rowstride=bytes_per_sample, offset=accel_offset, format=accel_format)
+                    fifo.release()
+                    stages.lap('decode')
+
+                    # records orientation, features and predict stages
+                    motion, brushing = processor.process(x_values, y_values, z_values, state=sm.state)
+
+                    t = clock.time()
                     sm.next(t, motion, brushing)
+                    clock.advance(hop_length)
+                    clock.mark_decision()
+                    stages.lap('state')
 
-                    print('main-inputs', t, brushing, motion, sm.state)
-
+                    # Update outputs. Does not wait for them
                     progress_state = sm.progress_state
+                    out.update(sm.state, progress_state)
+                    stages.lap('outputs')
+                    stages.end()
+
+                    if rates.update(sm.state, hop_length):
+                        log.log(EVENT_SAMPLERATE, 0, rates.rate)
+                        if record_enable and rates.rate != samplerate:
+                            # the hops so far were at full rate. Blocks, but only when going to sleep
+                            writer.pause()
+                            recorder.stop()
+                        elif record_enable:
+                            recorder.start()
+                            writer.resume()
+
+                    # brushing is logged as -1 when the model was skipped
+                    brushing_logged = -1 if brushing is None else scaled(brushing, 100)
+                    log.log(EVENT_INPUTS, state_index(sm.state), brushing_logged, scaled(motion, 100))
                     progress = int(100*(sm.brushing_time / sm.brushing_target_time))
-                    print('main-progress', sm.brushing_time, progress, f'{progress}%', progress_state)
-
-                    # Update outputs
-                    await out.run(sm.state, progress_state)
-
-                    d = time.ticks_diff(time.ticks_ms(), start)
-                    print('main-iter-times', d, read_duration, process_duration)
-
-                await asyncio.sleep_ms(10)
-                #machine.lightsleep(100)
+                    log.log(EVENT_PROGRESS, progress_state, scaled(sm.brushing_time, 10), progress)
+                    log.log(EVENT_LATENCY, 0, scaled(clock.latency_ms, 1))
+
+                    # slack until next hop
+                    collector.slack(sleeping=sm.state == sm.SLEEP)
+
+                    if (fifo.hops % 60) == 0:
+                        print('main-fifo-stats', fifo.stats())
+                        if imu_fifo_status:
+                            print('main-fifo-stats', 'overruns', imu.fifo_overruns,
+                                'misaligned', imu.fifo_misaligned, 'realigns', imu.fifo_realigns)
+                        print('main-gated', processor.windows_gated, processor.windows_processed)
+                        print('main-sleep-samples', rates.sleep_samples, rates.sleep_time)
+                        for r in reporters:
+                            r.report()
+                        print('main-log-dropped', log.dropped)
+
+                # let other tasks run
+                await asyncio.sleep_ms(0)
 
     asyncio.run(main_task())
 
@@ -0,0 +1,98 @@
+"""
+Scheduled garbage collection, for predictable timing in the processing loop
+
+Automatic collection can run in the middle of reading the IMU FIFO, and cause an overrun.
+Instead, collection is disabled, and done at known slack moments, like right after a hop is processed
+"""
+
+import gc
+
+from compat import ticks_us, ticks_diff
+from instrument import Histogram
+
+
+class CollectionScheduler():
+    """
+    Run gc.collect() only when slack() is called, and heap usage is above threshold
+
+    threshold is the fraction of the heap that may be used before collecting.
+    When sleeping there is more time, so sleep_threshold is used instead.
+    NOTE: MicroPython still collects if an allocation fails while disabled.
+    These are counted as forced, when detected by heap usage going down.
+    Records collection pause durations (us), heap high-water mark and allocation per hop (bytes).
+    gc_module is for testing, defaults to gc.
+    """
+
+    def __init__(self, threshold=0.5, sleep_threshold=0.2, gc_module=None):
+        self.gc = gc if gc_module is None else gc_module
+        self.threshold = threshold
+        self.sleep_threshold = sleep_threshold
+        self.has_stats = hasattr(self.gc, 'mem_alloc')
+
+        # statistics
+        self.pauses = Histogram()
+        self.hop_allocations = Histogram()
+        self.collections = 0
+        self.forced = 0
+        self.high_water = 0
+        self.heap_size = None
+        self._after_collect = 0
+        self._hop_start = 0
+
+    def start(self):
+        """
+        Collect once, and disable automatic collection
+        """
+        self.collect()
+        self.gc.disable()
+
+    def stop(self):
+        self.gc.enable()
+
+    def collect(self):
+        start = ticks_us()
+        self.gc.collect()
+        self.pauses.record(ticks_diff(ticks_us(), start))
+        self.collections += 1
+        if self.has_stats:
+            self._after_collect = self.gc.mem_alloc()
+            self.heap_size = self._after_collect + self.gc.mem_free()
+
+    def begin_hop(self):
+        """
+        Mark start of processing, for measuring allocations per hop
+        """
+        if self.has_stats:
+            self._hop_start = self.gc.mem_alloc()
+
+    def slack(self, sleeping=False):
+        """
+        Called when there is time to spare. Collects if needed
+
+        Returns True if a collection was done
+        """
+        if not self.has_stats or self.heap_size is None:
+            # no heap information, collect every time
+            self.collect()
+            return True
+
+        allocated = self.gc.mem_alloc()
+        if allocated < self._after_collect or allocated < self._hop_start:
+            # heap shrunk without us collecting
+            self.forced += 1
+            self._after_collect = allocated
+        else:
+            self.hop_allocations.record(allocated - self._hop_start)
+        self.high_water = max(self.high_water, allocated)
+
+        threshold = self.sleep_threshold if sleeping else self.threshold
+        if allocated > threshold * self.heap_size:
+            self.collect()
+            return True
+        return False
+
+    def report(self, prefix='gc-stats'):
+        print(prefix, 'collections', self.collections, 'forced', self.forced,
+            'high-water', self.high_water, 'heap', self.heap_size)
+        print(prefix, 'pause', *self.pauses.summary())
+        print(prefix, 'hop-allocated', *self.hop_allocations.summary())
@@ -6,32 +6,8 @@ import time
 
 import npyfile
 
-from core import StateMachine, DataProcessor, empty_array
-
-class GravitySplitter():
-
-    def __init__(self, samplerate, lowpass_cutoff=0.5):
-
-        rc = 1.0/(2*3.14*lowpass_cutoff)
-        dt = 1.0/samplerate
-        self.lowpass_alpha = rc / (rc + dt)
-
-        self.gravity = None
-        self.motion = array.array('f', [0, 0, 0])
-
-    def process(self, xyz):
-        assert len(xyz) == 3, xyz
-
-        if self.gravity is None:
-            # jump straigth to it, to avoid slow ramp-in
-            self.gravity = array.array('f', xyz)
-        
-        a = self.lowpass_alpha
-        for i in range(len(xyz)):
-            self.gravity[i] = (a * self.gravity[i]) + ((1.0 - a) * xyz[i])
-            self.motion[i] = xyz[i] - self.gravity[i]
-
-
+from core import StateMachine, DataProcessor, GravitySplitter, SampleClock, empty_array
+from instrument import StageTimer
 
 def read_data_file(path,
         chunk_length,
@@ -62,35 +38,57 @@ def read_data_file(path,
                 break
 
 
-def process_file(path):
+PROCESS_STAGES = ('decode', 'orientation', 'features', 'predict', 'state')
+
+def process_file(path, **kwargs):
+    return process_chunks(read_data_file(path, chunk_length=50), **kwargs)
+
+def process_chunks(chunks, window_length=None, motion_gate=None, cascade_model_path=None,
+        cascade_band=(0.25, 0.75), stages=None):
+    """
+    Run processing and state machine on chunks of interleaved X,Y,Z samples, one hop each
+    """
 
     samplerate = 50
     hop_length = 50
-    window_length = hop_length
 
     x_values = empty_array('h', hop_length)
     y_values = empty_array('h', hop_length)
     z_values = empty_array('h', hop_length)
 
-    p = DataProcessor()
-    sm = StateMachine(time=0.0)
+    # Only buffer when analysis windows are longer than the hop
+    if window_length == hop_length:
+        window_length = None
+    p = DataProcessor(window_length=window_length, hop_length=hop_length, motion_gate=motion_gate,
+        cascade_model_path=cascade_model_path, cascade_band=cascade_band, stages=stages)
+    clock = SampleClock(samplerate)
+    sm = StateMachine(time=clock.time())
 
     n_axes = 3
-    sample_no = 0
-    for xyz in read_data_file(path, chunk_length=hop_length):
-        t = (1.0/samplerate) * sample_no
+    for xyz in chunks:
+        if stages is not None:
+            stages.begin()
+        t = clock.time()
         n_samples = len(xyz) // n_axes
         for i in range(n_samples):
             x_values[i] = xyz[(i*3)+0]
             y_values[i] = xyz[(i*3)+1]
             z_values[i] = xyz[(i*3)+2]
+        if stages is not None:
+            stages.lap('decode')
 
-        motion, brushing = p.process(x_values, y_values, z_values)
+        motion, brushing = p.process(x_values, y_values, z_values, state=sm.state)
         sm.next(t, motion, brushing)
-        sample_no += n_samples
+        clock.advance(n_samples)
+        if stages is not None:
+            stages.lap('state')
+            stages.end()
 
         yield t, motion, brushing, sm.state, sm.brushing_time
 
+    if motion_gate is not None:
+        print('process-gated', p.windows_gated, p.windows_processed)
+
 
 def test_process_happy():
 
@@ -112,10 +110,12 @@ def main():
     import sys
 
     total_brushing_time = 0.0
+    stages = StageTimer(PROCESS_STAGES)
 
     data_path = sys.argv[1]
     out_path = sys.argv[2]
-    out_columns = ['time', 'motion', 'brushing', 'state', 'brushing_time']
+    # brushing is empty when the model was skipped by the motion gate, see gated
+    out_columns = ['time', 'motion', 'brushing', 'state', 'brushing_time', 'gated']
     endline = '\n'
     delim = ','
 
@@ -128,20 +128,23 @@ def main():
                 out.write(delim)
         out.write(endline)
 
-        for res in process_file(data_path):
+        for res in process_file(data_path, stages=stages):
             t, motion, brushing, state, brushing_time = res
             print('toothbrush-state-out', res)
 
-            assert len(res) == len(out_columns)
-            for i, v in enumerate(res):
+            gated = brushing is None
+            row = (t, motion, '' if gated else brushing, state, brushing_time, int(gated))
+            assert len(row) == len(out_columns)
+            for i, v in enumerate(row):
                 out.write(str(v))
-                if i != len(res)-1:
+                if i != len(row)-1:
                     out.write(delim)
             out.write(endline)
 
             total_brushing_time = max(brushing_time, total_brushing_time)
 
         print('toothbrush-done', total_brushing_time)
+        stages.report()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,428 @@
+"""
+Writing recordings without stalling the processing loop
+
+The hot loop only copies each hop into one of two preallocated buffers.
+Full buffers are written by a background task, several hops at a time.
+Recordings can also be written in a compressed format, see CompressedRecorder,
+or as one segmented file per session, see SegmentedRecorder
+"""
+
+import os
+import time
+import array
+import struct
+import asyncio
+
+from compat import ticks_us, ticks_diff, sleep_ms
+from instrument import Histogram
+
+# Compressed recording format, .hrz
+# File header, then blocks. Each block has a header with number of samples, payload bytes and shift.
+# Values are shifted right by shift, the number of low bits that are 0 in the whole block.
+# The payload is, for each sample and channel, the difference to the previous sample as zigzag varint.
+# The first sample of a block is relative to 0, so blocks can be decoded independently.
+# NOTE: must match software/dataset/harz.py
+HRZ_MAGIC = b'HRZ'
+HRZ_VERSION = 1
+HRZ_HEADER_FORMAT = '<3sBBBH' # magic, version, items per sample, reserved, samplerate
+HRZ_BLOCK_FORMAT = '<HHB' # samples, payload bytes, shift
+HRZ_BLOCK_HEADER_SIZE = 5
+HRZ_SUFFIX = '.hrz'
+# int16 differences are up to 17 bits
+HRZ_MAX_VALUE_BYTES = 3
+
+
+def or_int16_python(values):
+    bits = 0
+    for v in values:
+        bits |= v & 0xFFFF
+    return bits
+
+def encode_delta_varint_python(values, out, items, shift):
+    """
+    Encode int16 values with items per sample into out, after shifting right by shift.
+    Returns number of bytes written
+    """
+    n = 0
+    for i in range(len(values)):
+        d = (values[i] >> shift) - (values[i-items] >> shift) if i >= items else values[i] >> shift
+        z = (d << 1) if d >= 0 else ((-d) << 1) - 1
+        while z >= 0x80:
+            out[n] = (z & 0x7F) | 0x80
+            z >>= 7
+            n += 1
+        out[n] = z
+        n += 1
+    return n
+
+def zero_low_bits(bits):
+    """
+    Number of low bits that are 0 in bits, from or_int16()
+    """
+    if bits == 0:
+        return 0
+    shift = 0
+    while (bits >> shift) & 1 == 0:
+        shift += 1
+    return shift
+
+# Use versions accelerated with MicroPython viper emitter, when available
+try:
+    import kernels_native
+    or_int16 = kernels_native.or_int16
+    encode_delta_varint = kernels_native.encode_delta_varint
+except (ImportError, SyntaxError):
+    or_int16 = or_int16_python
+    encode_delta_varint = encode_delta_varint_python
+
+
+class AsyncRecorder():
+    """
+    Double-buffered writes to a Recorder
+
+    process() copies a hop of values into the active buffer. When it is full,
+    the buffers are swapped, and run() passes the full one to recorder.process(),
+    in slices of hops_per_slice hops, yielding to other tasks between slices.
+    If the previous buffer is still not written when the next one is full,
+    the new data is dropped and counted in dropped, instead of waiting.
+    While paused, process() ignores the data, for example while the IMU is at another samplerate.
+    Write durations (us) per slice are recorded in write_times.
+    """
+
+    def __init__(self, recorder, hop_items, hops_per_write=4, hops_per_slice=1, typecode='h'):
+        self.recorder = recorder
+        self.hop_items = hop_items
+        self.buffer_items = hop_items * hops_per_write
+        self.slice_items = hop_items * hops_per_slice
+        self.buffers = [ array.array(typecode, (0 for _ in range(self.buffer_items))) for _ in range(2) ]
+        self.views = [ memoryview(b) for b in self.buffers ]
+        self.active = 0
+        self.fill = 0 # items in active buffer
+        self.pending = None # index of buffer being written, or waiting to be
+        self.written = 0 # items of pending buffer written so far
+        self.paused = False
+        self.ready = asyncio.Event()
+
+        # statistics
+        self.write_times = Histogram()
+        self.writes = 0 # buffers written
+        self.dropped = 0
+
+    def process(self, values):
+        """
+        Add a hop of values. Returns immediately
+        """
+        if self.paused:
+            return
+        n = len(values)
+        assert n == self.hop_items, (n, self.hop_items)
+        buf = self.buffers[self.active]
+        buf[self.fill:self.fill+n] = values
+        self.fill += n
+        if self.fill < self.buffer_items:
+            return
+
+        self.fill = 0
+        if self.pending is not None:
+            # writer is behind. Drop this buffer, reuse it
+            self.dropped += 1
+            return
+        self.pending = self.active
+        self.active = 1 - self.active
+        self.ready.set()
+
+    def _write(self, data):
+        start = ticks_us()
+        self.recorder.process(data)
+        self.write_times.record(ticks_diff(ticks_us(), start))
+
+    def _write_slice(self):
+        # write the next slice of the pending buffer
+        start = self.written
+        end = min(start + self.slice_items, self.buffer_items)
+        self._write(self.views[self.pending][start:end])
+        if end < self.buffer_items:
+            self.written = end
+            return
+        self.written = 0
+        self.pending = None
+        self.writes += 1
+
+    async def run(self):
+        """
+        Writer task
+        """
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            # a slow write only delays the processing loop by one slice
+            while self.pending is not None:
+                self._write_slice()
+                await sleep_ms(0)
+
+    def flush(self):
+        """
+        Write pending and partially filled buffers. Blocks
+        """
+        while self.pending is not None:
+            self._write_slice()
+        if self.fill:
+            self._write(self.views[self.active][:self.fill])
+            self.writes += 1
+            self.fill = 0
+
+    def pause(self):
+        """
+        Write what is buffered, then ignore process() until resume(). Blocks
+        """
+        self.flush()
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def report(self, prefix='recorder-stats'):
+        print(prefix, 'writes', self.writes, 'dropped', self.dropped)
+        print(prefix, 'write-time', *self.write_times.summary())
+
+
+def format_time(t):
+    return '{:04d}-{:02d}-{:02d}T{:02d}{:02d}{:02d}'.format(t[0], t[1], t[2], t[3], t[4], t[5])
+
+
+class CompressedRecorder():
+    """
+    Write recordings in the compressed .hrz format, one file per duration
+
+    Same interface and file naming as Recorder, TIME_CLASS.hrz.
+    Each process() call is written as one or more blocks of at most block_samples,
+    encoded into a preallocated buffer.
+    Tracks raw and encoded bytes, and encode durations (us) per block in encode_times.
+    NOTE: not used by default in main.py. Ratio is 1.10-1.16 on the brushing recordings,
+    and encode time on device is not measured yet
+    """
+
+    def __init__(self, samplerate, duration, directory='har_record',
+            items_per_sample=3, block_samples=200, suffix=HRZ_SUFFIX):
+        self.samplerate = samplerate
+        self.max_samples = int(duration * samplerate)
+        self.directory = directory
+        self.items_per_sample = items_per_sample
+        self.block_samples = block_samples
+        self.suffix = suffix
+
+        self.out = bytearray(HRZ_BLOCK_HEADER_SIZE + HRZ_MAX_VALUE_BYTES*items_per_sample*block_samples)
+        self.out_view = memoryview(self.out)
+        self.file = None
+        self.file_samples = 0
+        self.recording = False
+        self.classname = None
+
+        # statistics
+        self.files = 0
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+        self.encode_times = Histogram()
+
+    def __enter__(self):
+        try:
+            os.mkdir(self.directory)
+        except OSError:
+            pass # already exists
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def set_class(self, classname):
+        self.close()
+        self.classname = classname
+
+    def start(self):
+        self.recording = True
+
+    def stop(self):
+        self.recording = False
+        self.close()
+
+    def delete(self):
+        for f in os.listdir(self.directory):
+            if f.endswith(self.suffix):
+                os.remove(self.directory + '/' + f)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _open(self):
+        name = format_time(time.localtime()) + '_' + self.classname + self.suffix
+        self.file = open(self.directory + '/' + name, 'wb')
+        self.file.write(struct.pack(HRZ_HEADER_FORMAT, HRZ_MAGIC, HRZ_VERSION,
+            self.items_per_sample, 0, self.samplerate))
+        self.file_samples = 0
+        self.files += 1
+
+    def process(self, values):
+        if not self.recording:
+            return
+
+        items = self.items_per_sample
+        samples = len(values) // items
+        view = memoryview(values)
+        offset = 0
+        while offset < samples:
+            if self.file is None:
+                self._open()
+            n = min(samples - offset, self.block_samples, self.max_samples - self.file_samples)
+
+            start = ticks_us()
+            block = view[offset*items:(offset+n)*items]
+            shift = zero_low_bits(or_int16(block))
+            size = encode_delta_varint(block, self.out_view[HRZ_BLOCK_HEADER_SIZE:], items, shift)
+            struct.pack_into(HRZ_BLOCK_FORMAT, self.out, 0, n, size, shift)
+            self.encode_times.record(ticks_diff(ticks_us(), start))
+
+            self.file.write(self.out_view[:HRZ_BLOCK_HEADER_SIZE+size])
+            self.raw_bytes += 2*n*items
+            self.encoded_bytes += HRZ_BLOCK_HEADER_SIZE + size
+
+            offset += n
+            self.file_samples += n
+            if self.file_samples >= self.max_samples:
+                self.close()
+
+    def report(self, prefix='hrz-stats'):
+        ratio = self.raw_bytes / max(self.encoded_bytes, 1)
+        print(prefix, 'raw', self.raw_bytes, 'encoded', self.encoded_bytes, 'ratio', ratio)
+        print(prefix, 'encode-time', *self.encode_times.summary())
+
+
+# Segmented recording session, .hrs with index .hri
+# The data file has a header, then int16 samples appended for the whole session, little-endian.
+# A segment starts every duration seconds, or when the class changes.
+# Each segment appends one entry to the index file: sample offset, start time and class.
+# NOTE: must match software/dataset/segments.py
+HRS_MAGIC = b'HRS'
+HRS_VERSION = 1
+HRS_HEADER_FORMAT = '<3sBBBH' # magic, version, items per sample, reserved, samplerate
+HRS_SUFFIX = '.hrs'
+HRS_INDEX_SUFFIX = '.hri'
+# sample offset, year, month, day, hour, minute, second, reserved, class
+HRS_INDEX_FORMAT = '<IHBBBBBB12s'
+HRS_INDEX_SIZE = 24
+
+
+class SegmentedRecorder():
+    """
+    Write a recording session into one append-only data file, with an index of segments
+
+    Same interface as Recorder. Instead of a new file every duration,
+    a new segment is started, which only appends an entry to the index.
+    Files are opened on the first samples after start(), and closed by stop().
+    NOTE: samples are written in native byte order, which is little-endian on the supported devices
+    """
+
+    def __init__(self, samplerate, duration, directory='har_record',
+            items_per_sample=3, suffix=HRS_SUFFIX):
+        self.samplerate = samplerate
+        self.max_samples = int(duration * samplerate)
+        self.directory = directory
+        self.items_per_sample = items_per_sample
+        self.suffix = suffix
+
+        self.data = None
+        self.index = None
+        self.samples = 0 # in session
+        self.segment_samples = 0
+        self.recording = False
+        self.classname = None
+        self.new_segment = True
+
+        # statistics
+        self.sessions = 0
+        self.segments = 0
+        self.write_times = Histogram()
+
+    def __enter__(self):
+        try:
+            os.mkdir(self.directory)
+        except OSError:
+            pass # already exists
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def set_class(self, classname):
+        if len(classname) > 12:
+            raise ValueError("Class name longer than 12: " + classname)
+        self.classname = classname
+        self.new_segment = True
+
+    def start(self):
+        self.recording = True
+
+    def stop(self):
+        self.recording = False
+        self.close()
+
+    def delete(self):
+        for f in os.listdir(self.directory):
+            if f.endswith(self.suffix) or f.endswith(HRS_INDEX_SUFFIX):
+                os.remove(self.directory + '/' + f)
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.index.close()
+            self.data = None
+            self.index = None
+
+    def _open(self):
+        base = self.directory + '/' + format_time(time.localtime())
+        self.data = open(base + self.suffix, 'wb')
+        self.data.write(struct.pack(HRS_HEADER_FORMAT, HRS_MAGIC, HRS_VERSION,
+            self.items_per_sample, 0, self.samplerate))
+        self.index = open(base + HRS_INDEX_SUFFIX, 'wb')
+        self.samples = 0
+        self.sessions += 1
+        self.new_segment = True
+
+    def _start_segment(self):
+        t = time.localtime()
+        self.index.write(struct.pack(HRS_INDEX_FORMAT, self.samples,
+            t[0], t[1], t[2], t[3], t[4], t[5], 0, self.classname.encode()))
+        # make the finished segment durable
+        self.data.flush()
+        self.index.flush()
+        self.segment_samples = 0
+        self.new_segment = False
+        self.segments += 1
+
+    def process(self, values):
+        if not self.recording:
+            return
+        if self.data is None:
+            self._open()
+
+        items = self.items_per_sample
+        samples = len(values) // items
+        view = memoryview(values)
+        offset = 0
+        while offset < samples:
+            if self.new_segment or self.segment_samples >= self.max_samples:
+                self._start_segment()
+            n = min(samples - offset, self.max_samples - self.segment_samples)
+
+            start = ticks_us()
+            self.data.write(view[offset*items:(offset+n)*items])
+            self.write_times.record(ticks_diff(ticks_us(), start))
+
+            offset += n
+            self.samples += n
+            self.segment_samples += n
+
+    def report(self, prefix='hrs-stats'):
+        print(prefix, 'sessions', self.sessions, 'segments', self.segments, 'samples', self.samples)
+        print(prefix, 'write-time', *self.write_times.summary())
@@ -1,6 +1,29 @@
 
-from core import StateMachine
-from process import process_file
+import gc
+import os
+import math
+import array
+import struct
+
+from core import StateMachine, MedianFilter, median
+from core import window_stats, mean, energy_xyz
+from core import window_stats_int, energy_shift, isqrt
+from core import DataProcessor, copy_features, WindowBuffer, SlidingWindowStats
+from core import GravitySplitter, SampleClock, clamp
+from core import OutputManager, parse_song, success_song, fail_song
+from core import load_trees_binary, dirname, RateController, empty_array
+from core import mean_python, energy_xyz_python
+import decode
+import asyncio
+from fifo import FifoReader, SampleRing, ThreadedReader, ThreadSafeFlag
+from compat import sleep_ms, thread_sleep_ms
+from process import process_file, process_chunks, read_data_file, PROCESS_STAGES
+from instrument import Histogram, StageTimer, serve_commands
+from memory import CollectionScheduler
+from recording import AsyncRecorder, CompressedRecorder, SegmentedRecorder
+import recording
+import binlog
+from binlog import BinaryLog, decode_records, scaled
 
 def run_scenario(sm, trace, default_dt = 0.1):
 
@@ -114,6 +137,1603 @@ def test_states_basic_sad():
         check_expectations(row, outputs)
 
 
+def test_median_filter():
+    # check that running median gives same output as median() of the last N values
+    inputs = [ ((i*7) % 11) / 10.0 for i in range(100) ]
+
+    for length in range(1, 9):
+        f = MedianFilter(length)
+        history = [0.0] * length
+        for v in inputs:
+            history = history[1:] + [v]
+            out = f.push(v)
+            expect = median(history)
+            assert out == expect, (length, out, expect, history)
+
+        f.reset(0.0)
+        assert f.median() == 0.0
+
+
+def assert_close(a, b, rel=1e-4, abs=1e-3):
+    assert math.fabs(a - b) <= max(rel*max(math.fabs(a), math.fabs(b)), abs), (a, b)
+
+def test_window_stats():
+    # check that fused kernel gives same results as mean() and energy_xyz()
+    n = 50
+    still = [ 16000 + (i % 3) for i in range(n) ]
+    moving = [ ((i*1237) % 8000) - 4000 for i in range(n) ]
+    cases = [
+        ([0]*n, [0]*n, [0]*n),
+        (still, [100]*n, [-200]*n),
+        (moving, still, moving[::-1]),
+        ([32767, -32768]*(n//2), moving, [-32768]*n),
+    ]
+
+    for xx, yy, zz in cases:
+        xs = array.array('h', xx)
+        ys = array.array('h', yy)
+        zs = array.array('h', zz)
+
+        xo, yo, zo, energy = window_stats(xs, ys, zs)
+        orientation = mean(xs), mean(ys), mean(zs)
+        assert_close(xo, orientation[0])
+        assert_close(yo, orientation[1])
+        assert_close(zo, orientation[2])
+        assert_close(energy, energy_xyz(xs, ys, zs, orientation))
+
+
+def test_window_stats_int():
+    # check that fixed-point kernel stays within documented error bounds of the float version
+
+    for v in (0, 1, 2, 3, 4, 15, 16, 17, 1000, 2**30, 2**30 + 1):
+        r = isqrt(v)
+        assert r*r <= v and (r+1)*(r+1) > v, (v, r)
+
+    def check(xs, ys, zs):
+        n = len(xs)
+        xo, yo, zo, energy = window_stats(xs, ys, zs)
+        ixo, iyo, izo, ienergy = window_stats_int(xs, ys, zs)
+        assert math.fabs(ixo - xo) <= 0.5, (ixo, xo)
+        assert math.fabs(iyo - yo) <= 0.5, (iyo, yo)
+        assert math.fabs(izo - zo) <= 0.5, (izo, zo)
+
+        shift = energy_shift(n)
+        squared_error = (1.5*n*(2**shift)) + (0.75*n)
+        bound = math.sqrt(squared_error)
+        if energy > 0:
+            bound = min(bound, squared_error / (2*energy))
+        bound += 2**(shift//2)
+        assert math.fabs(ienergy - energy) <= bound, (ienergy, energy, bound)
+
+    n = 50
+    moving = [ ((i*1237) % 8000) - 4000 for i in range(n) ]
+    still = [ 16000 + (i % 3) for i in range(n) ]
+    check(array.array('h', [0]*n), array.array('h', [0]*n), array.array('h', [0]*n))
+    check(array.array('h', moving), array.array('h', still), array.array('h', moving[::-1]))
+
+    data_path = 'data/jonnor-brushing-1/testdata/VID_20241231_155624.mkv.npy'
+    for xyz in read_data_file(data_path, chunk_length=n):
+        xs = array.array('h', (xyz[(i*3)+0] for i in range(n)))
+        ys = array.array('h', (xyz[(i*3)+1] for i in range(n)))
+        zs = array.array('h', (xyz[(i*3)+2] for i in range(n)))
+        check(xs, ys, zs)
+
+
+# Allocation budget for DataProcessor.process(), in bytes per window,
+# on top of what timebased.calculate_features_xyz allocates for its list of features.
+# That is measured on the same interpreter, since it depends on the timebased version.
+# What remains is a few boxed floats for orientation, motion and brushing, and the returned tuple.
+# 512 bytes is 16 objects of 32 bytes. Not yet checked on MicroPython
+PROCESS_ALLOCATION_BUDGET = 512
+
+def measure_allocation(func, repeats):
+    """
+    Bytes allocated per call of func()
+
+    On MicroPython, all allocations with gc disabled, divided by repeats.
+    On CPython objects are freed as soon as they are unused, so the peak of traced memory is used.
+    That is an upper bound for what a single call allocates. Memory kept after the calls is also included
+    """
+    if hasattr(gc, 'mem_alloc'):
+        gc.collect()
+        gc.disable()
+        try:
+            before = gc.mem_alloc()
+            for i in range(repeats):
+                func()
+            after = gc.mem_alloc()
+        finally:
+            gc.enable()
+        return (after - before) / repeats
+
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        # fill interpreter caches and free-lists first
+        for i in range(repeats):
+            func()
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        for i in range(repeats):
+            func()
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return max(peak - before, after - before)
+
+def test_features_no_allocation():
+    # check that writing features into the preallocated array does not allocate
+
+    p = DataProcessor()
+    n_features = len(p.features)
+    values = [ float(i) + 0.5 for i in range(n_features) ]
+
+    copy_features(values, p.features)
+    assert p.features[1] == 1, p.features[1]
+
+    allocated = measure_allocation(lambda: copy_features(values, p.features), 1000)
+    # CPython allocates call frames, which is less than one object per feature
+    limit = 0 if hasattr(gc, 'mem_alloc') else 4*n_features
+    assert allocated <= limit, allocated
+
+def test_process_allocation():
+    # check that processing windows allocates nothing beyond the timebased features, and that nothing accumulates
+    n = 50
+    xs = array.array('h', ((i*37) % 200 for i in range(n)))
+    ys = array.array('h', (-((i*13) % 300) for i in range(n)))
+    zs = array.array('h', ((2000 + (i*7) % 50) for i in range(n)))
+
+    for fixed_point in (False, True):
+        processor = DataProcessor(fixed_point=fixed_point, window_length=2*n)
+        def process():
+            processor.process(xs, ys, zs, state=StateMachine.IDLE)
+        def features():
+            processor.compute_features(xs, ys, zs)
+
+        allocated = measure_allocation(process, 1000)
+        features_allocated = measure_allocation(features, 1000)
+        print('process-allocation', 'fixed-point', fixed_point, 'bytes-per-window', allocated,
+            'timebased', features_allocated)
+        # the float path boxes floats for the window statistics. main.py uses fixed_point
+        if fixed_point:
+            assert allocated - features_allocated <= PROCESS_ALLOCATION_BUDGET, (allocated, features_allocated)
+
+
+def make_fifo_chunk(n_samples, values_per_sample, rowstride, format):
+    # raw bytes like from IMU FIFO, with some padding if rowstride is larger than values
+    buf = bytearray(n_samples*rowstride)
+    for i in range(n_samples):
+        values = [ (((i*values_per_sample)+j)*7919 % 65535) - 32767 for j in range(values_per_sample) ]
+        struct.pack_into(format, buf, i*rowstride, *values)
+    return buf
+
+def test_kernels_match_python():
+    # check that the selected (possibly native/viper accelerated) kernels match the pure-Python versions
+    n = 50
+
+    xs = array.array('h', ( ((i*1237) % 8000) - 4000 for i in range(n) ))
+    ys = array.array('h', ( 16000 + ((i*311) % 2000) for i in range(n) ))
+    zs = array.array('h', ( -32768 + ((i*733) % 4000) for i in range(n) ))
+    for arr in (xs, ys, zs):
+        assert mean(arr) == mean_python(arr), (mean(arr), mean_python(arr))
+    orientation = mean(xs), mean(ys), mean(zs)
+    assert energy_xyz(xs, ys, zs, orientation) == energy_xyz_python(xs, ys, zs, orientation)
+
+    # M5Stick: AxAyAzT, big-endian. XIAO: GxGyGzAxAyAz, little-endian
+    hardware_formats = [
+        (8, 0, '>hhh', '>hhhh', '>hhh'),
+        (12, 6, '<hhh', '<hhhhhh', '<hhhhhh'),
+    ]
+    for rowstride, offset, accel_format, raw_format, record_format in hardware_formats:
+        chunk = make_fifo_chunk(n, len(raw_format)-1, rowstride, raw_format)
+        # most negative value, which cannot be negated in int16
+        struct.pack_into(raw_format, chunk, rowstride, *([-32768]*(len(raw_format)-1)))
+
+        for name in ('deinterleave_samples_xiao', 'deinterleave_samples_m5stick'):
+            outputs = []
+            for func in (getattr(decode, name), getattr(decode, name+'_python')):
+                out = [ array.array('h', [0]*n) for _ in range(3) ]
+                func(chunk, out[0], out[1], out[2],
+                    rowstride=rowstride, offset=offset, format=accel_format)
+                outputs.append(out)
+            assert outputs[0] == outputs[1], name
+
+        outputs = []
+        for func in (decode.decode_samples, decode.decode_samples_python):
+            out = array.array('h', [0]*(n*(len(record_format)-1)))
+            func(chunk, out, format=record_format, rowstride=rowstride)
+            outputs.append(out)
+        assert outputs[0] == outputs[1]
+
+        for name in ('decode_chunk_xiao', 'decode_chunk_m5stick'):
+            outputs = []
+            for func in (getattr(decode, name), getattr(decode, name+'_python')):
+                out = [ array.array('h', [0]*n) for _ in range(4) ]
+                out[3] = array.array('h', [0]*(n*(len(record_format)-1)))
+                func(chunk, out[0], out[1], out[2], out[3],
+                    rowstride=rowstride, format=record_format, accel_index=offset//2)
+                outputs.append(out)
+            assert outputs[0] == outputs[1], name
+            if name == 'decode_chunk_xiao':
+                # -Z saturates
+                assert outputs[0][2][1] == 32767, outputs[0][2][1]
+
+    values = array.array('h', (zs[i//3] + (i % 3) for i in range(n*3)))
+    outputs = []
+    for func in (recording.encode_delta_varint, recording.encode_delta_varint_python):
+        out = bytearray(3*len(values))
+        size = func(values, out, 3, 2)
+        outputs.append(out[:size])
+    assert outputs[0] == outputs[1]
+    assert recording.or_int16(values) == recording.or_int16_python(values)
+
+    # check the axis mapping against struct
+    chunk = make_fifo_chunk(n, 6, 12, '<hhhhhh')
+    decode.deinterleave_samples_xiao(chunk, xs, ys, zs, rowstride=12, offset=6, format='<hhh')
+    x, y, z = struct.unpack_from('<hhh', chunk, 6+12)
+    assert (xs[1], ys[1], zs[1]) == (y, x, -z)
+
+
+def test_window_buffer():
+    # check that sliding window gives the latest samples, for hops shorter and longer than the window
+    stream = [ (i*31 % 200) - 100 for i in range(1000) ]
+
+    for window_length, hop_length in ((128, 64), (50, 50), (10, 3), (4, 7)):
+        buf = WindowBuffer(window_length)
+        pos = 0
+        while pos + hop_length <= len(stream):
+            hop = array.array('h', stream[pos:pos+hop_length])
+            buf.push(hop)
+            pos += hop_length
+
+            # before buffer is filled, oldest values repeat the first sample
+            expect = stream[max(0, pos-window_length):pos]
+            expect = [ stream[0] ] * (window_length - len(expect)) + expect
+            window = buf.window()
+            assert len(window) == window_length
+            assert list(window) == expect, (window_length, hop_length, pos)
+
+def test_sliding_window_stats():
+    # check that incremental statistics match a full recompute over the window
+    n = 2000
+    xx = [ ((i*1237) % 8000) - 4000 for i in range(n) ]
+    yy = [ 16000 + ((i*311) % 2000) for i in range(n) ]
+    zz = [ ((i*733) % 30000) - 15000 for i in range(n) ]
+
+    out = array.array('i', [0, 0, 0, 0])
+    for window_length, hop_length in ((128, 64), (50, 50), (100, 7), (10, 30)):
+        stats = SlidingWindowStats(window_length)
+        # squares scaled down, like in DataProcessor with fixed_point
+        shift = energy_shift(window_length)
+        shifted = SlidingWindowStats(window_length, shift=shift)
+        pos = 0
+        while pos + hop_length <= n:
+            xs = array.array('h', xx[pos:pos+hop_length])
+            ys = array.array('h', yy[pos:pos+hop_length])
+            zs = array.array('h', zz[pos:pos+hop_length])
+            stats.push(xs, ys, zs)
+            shifted.push(xs, ys, zs)
+            pos += hop_length
+
+            xs, ys, zs = stats.windows()
+            expect = window_stats(xs, ys, zs)
+            result = stats.stats()
+            for a, b in zip(result, expect):
+                assert_close(a, b)
+
+            assert stats.stats_int(out) is out
+            for a, b in zip(out[:3], expect[:3]):
+                assert math.fabs(a - b) <= 0.5, (a, b)
+            assert math.fabs(out[3] - expect[3]) <= 1.0, (out[3], expect[3])
+
+            shifted.stats_int(out)
+            for a, b in zip(out[:3], expect[:3]):
+                assert math.fabs(a - b) <= 0.5, (a, b)
+            energy = max(expect[3], 1.0)
+            squared_error = (3*window_length*2**shift) + 2**(shift+1) + 3
+            bound = min(math.sqrt(squared_error), squared_error / (2*energy))
+            bound += 2**(shift//2) + 1
+            assert math.fabs(out[3] - expect[3]) <= bound, (window_length, out[3], expect[3], bound)
+
+def test_gravity_splitter_block():
+    # check that block filtering matches per-sample filtering, with state carried across blocks
+    hop_length = 50
+    data_path = 'data/jonnor-brushing-1/testdata/VID_20241231_155624.mkv.npy'
+
+    reference = GravitySplitter(samplerate=50)
+    block = GravitySplitter(samplerate=50)
+    inplace = GravitySplitter(samplerate=50)
+    mx = array.array('h', [0]*hop_length)
+    my = array.array('h', [0]*hop_length)
+    mz = array.array('h', [0]*hop_length)
+
+    for xyz in read_data_file(data_path, chunk_length=hop_length, limit_samples=50):
+        xs = array.array('h', (xyz[(i*3)+0] for i in range(hop_length)))
+        ys = array.array('h', (xyz[(i*3)+1] for i in range(hop_length)))
+        zs = array.array('h', (xyz[(i*3)+2] for i in range(hop_length)))
+        block.process_block(xs, ys, zs, mx, my, mz)
+
+        for i in range(hop_length):
+            reference.process((xs[i], ys[i], zs[i]))
+            for axis, m in enumerate((mx, my, mz)):
+                assert math.fabs(m[i] - reference.motion[axis]) <= 2.0, (i, m[i], reference.motion[axis])
+
+        # in-place gives same as separate outputs
+        inplace.process_block(xs, ys, zs, xs, ys, zs)
+        assert (xs, ys, zs) == (mx, my, mz)
+
+    # step between the int16 extremes saturates, instead of overflowing the output
+    for start, end, expect in ((-32767, 32767, 32767), (32767, -32767, -32768)):
+        splitter = GravitySplitter(samplerate=50)
+        gravity = splitter.gravity # preallocated, only updated in-place
+        xs = array.array('h', [start]*10 + [end]*10)
+        out = array.array('h', [0]*len(xs))
+        splitter.process_block(xs, xs, xs, out, out, out)
+        assert splitter.gravity is gravity
+        assert out[10] == expect, (start, end, out[10])
+        assert out[-1] == int(clamp(end - splitter.gravity[0], -32768, 32767))
+
+
+def test_processor_window_same_as_hop():
+    # check that buffering windows of same length as hop gives same results as without
+    hop_length = 50
+    data_path = 'data/jonnor-brushing-1/testdata/VID_20241231_155624.mkv.npy'
+    direct = DataProcessor()
+    buffered = DataProcessor(window_length=hop_length)
+
+    for xyz in read_data_file(data_path, chunk_length=hop_length, limit_samples=50):
+        xs = array.array('h', (xyz[(i*3)+0] for i in range(hop_length)))
+        ys = array.array('h', (xyz[(i*3)+1] for i in range(hop_length)))
+        zs = array.array('h', (xyz[(i*3)+2] for i in range(hop_length)))
+        assert direct.process(xs, ys, zs) == buffered.process(xs, ys, zs)
+
+
+def test_decode_chunk():
+    # check that fused decoding matches separate deinterleave + decode
+    n = 50
+    hardware = [
+        # fused, separate, rowstride, accel_offset, raw_format, accel_format, record_format
+        ('decode_chunk_m5stick', decode.deinterleave_samples_m5stick, 8, 0, '>hhhh', '>hhh', '>hhh'),
+        ('decode_chunk_xiao', decode.deinterleave_samples_xiao, 12, 6, '<hhhhhh', '<hhh', '<hhhhhh'),
+    ]
+    for fused, deinterleave, rowstride, offset, raw_format, accel_format, record_format in hardware:
+        chunk = make_fifo_chunk(n, len(raw_format)-1, rowstride, raw_format)
+        stride = len(record_format)-1
+
+        expect = [ array.array('h', [0]*n) for _ in range(3) ]
+        deinterleave(chunk, expect[0], expect[1], expect[2],
+            rowstride=rowstride, offset=offset, format=accel_format)
+        expect_record = array.array('h', [0]*(n*stride))
+        decode.decode_samples(chunk, expect_record, format=record_format, rowstride=rowstride)
+
+        for impl in (getattr(decode, fused), getattr(decode, fused+'_python')):
+            out = [ array.array('h', [0]*n) for _ in range(3) ]
+            record = array.array('h', [0]*(n*stride))
+            impl(chunk, out[0], out[1], out[2], record,
+                rowstride=rowstride, format=record_format, accel_index=offset//2)
+            assert out == expect
+            assert record == expect_record
+
+            # raw data read directly into record array
+            if decode.is_native_layout(record_format, rowstride):
+                record = array.array('h', expect_record)
+                out = [ array.array('h', [0]*n) for _ in range(3) ]
+                impl(record, out[0], out[1], out[2], record,
+                    rowstride=rowstride, format=record_format, accel_index=offset//2)
+                assert out == expect
+                assert bytes(record) == bytes(chunk)
+
+
+class SimulatedIMU():
+    """
+    IMU with a FIFO that fills up at samplerate, for testing on PC
+
+    Counts bus transactions, and calls on_watermark when FIFO level reaches watermark
+    """
+
+    def __init__(self, samplerate, bytes_per_sample=12):
+        self.samplerate = samplerate
+        self.bytes_per_sample = bytes_per_sample
+        self.fifo_level = 0
+        self.watermark = None
+        self.on_watermark = None
+        self.bus_transactions = 0
+        self.read = 0
+
+    def set_fifo_watermark(self, samples):
+        self.bus_transactions += 3
+        self.watermark = samples
+
+    def get_fifo_count(self):
+        self.bus_transactions += 1
+        return self.fifo_level
+
+    def read_samples_into(self, buf):
+        self.bus_transactions += 1
+        # buf is bytes, or int16 array when read straight into the record buffer
+        n_bytes = len(buf) if isinstance(buf, bytearray) else 2*len(buf)
+        n = n_bytes // self.bytes_per_sample
+        assert n <= self.fifo_level, (n, self.fifo_level)
+        self.fifo_level -= n
+        # sequence number of the sample as last int16 value, AZ on LSM6DS3
+        for i in range(n):
+            struct.pack_into('<h', buf, (i+1)*self.bytes_per_sample - 2, self.read + i)
+        self.read += n
+
+    async def run(self, samples, batch=5):
+        # produce samples in batches, in real time
+        interval_ms = (1000 * batch) // self.samplerate
+        for i in range(samples // batch):
+            await sleep_ms(interval_ms)
+            before = self.fifo_level
+            self.fifo_level += batch
+            w = self.watermark
+            if w is not None and before < w and self.fifo_level >= w and self.on_watermark:
+                self.on_watermark()
+
+def run_fifo_reader(interrupt, hops=10, hop_length=50):
+    imu = SimulatedIMU(samplerate=1000)
+    chunk = bytearray(imu.bytes_per_sample*hop_length)
+    reader = FifoReader(imu, hop_length, chunk, interrupt=interrupt)
+    if interrupt:
+        imu.set_fifo_watermark(hop_length)
+        imu.on_watermark = reader.notify
+
+    async def consume():
+        for i in range(hops):
+            await reader.wait()
+            reader.acquire()
+            reader.release()
+
+    async def run():
+        await asyncio.gather(imu.run((hops+1)*hop_length), consume())
+
+    imu.bus_transactions = 0
+    asyncio.run(run())
+    assert reader.hops == hops
+    return imu.bus_transactions / hops, reader.wakeups / hops
+
+def test_fifo_interrupt():
+    # check that watermark interrupt mode needs fewer bus transactions and wakeups than polling
+    poll_transactions, poll_wakeups = run_fifo_reader(interrupt=False)
+    irq_transactions, irq_wakeups = run_fifo_reader(interrupt=True)
+    print('fifo-per-hop', 'transactions', poll_transactions, irq_transactions,
+        'wakeups', poll_wakeups, irq_wakeups)
+
+    assert irq_transactions <= 3.5, irq_transactions
+    assert irq_wakeups <= 1.5, irq_wakeups
+    assert poll_transactions > irq_transactions
+    assert poll_wakeups > irq_wakeups
+
+def test_thread_safe_flag():
+    # a set() before the first wait() wakes that wait only, later waits block until the next set()
+    flag = ThreadSafeFlag()
+    flag.set()
+    woken = []
+
+    async def waiter():
+        for i in range(2):
+            await flag.wait()
+            woken.append(i)
+
+    async def run():
+        task = asyncio.create_task(waiter())
+        for _ in range(5):
+            await sleep_ms(0)
+        assert woken == [0], woken
+        flag.set()
+        for _ in range(5):
+            await sleep_ms(0)
+        assert woken == [0, 1], woken
+        await task
+
+    asyncio.run(run())
+
+    # same, when used again from a new loop
+    flag.set()
+    woken.clear()
+    asyncio.run(run())
+
+
+def test_fifo_reader_hop():
+    # one hop of the main loop without reader thread: wait, acquire, decode, release
+    # with the FIFO read straight into the record buffer, as done when is_native_layout()
+    hop_length = 50
+    imu = SimulatedIMU(samplerate=1000)
+    imu.fifo_level = hop_length
+    record = array.array('h', [0]*(6*hop_length))
+    reader = FifoReader(imu, hop_length, record)
+    xs, ys, zs = [ array.array('h', [0]*hop_length) for _ in range(3) ]
+
+    async def hop():
+        count = await reader.wait()
+        assert count >= hop_length
+        buf = reader.acquire()
+        decode.decode_chunk_xiao(buf, xs, ys, zs, record)
+        reader.release()
+        return buf
+
+    buf = asyncio.run(hop())
+    assert buf is record
+    assert imu.fifo_level == 0
+    assert reader.hops == 1
+    # Z is -AZ, which has the sample number
+    assert list(zs) == [ -i for i in range(hop_length) ], zs
+    assert list(record[5::6]) == list(range(hop_length))
+
+class SteppedIMU():
+    """
+    Simulated IMU where samples arrive in the FIFO when the test calls produce(), can be read from any thread
+
+    Each sample has its sequence number in the first 4 bytes
+    """
+
+    def __init__(self, bytes_per_sample=8):
+        self.bytes_per_sample = bytes_per_sample
+        self.produced = 0
+        self.read = 0
+
+    def produce(self, samples):
+        self.produced += samples
+
+    def get_fifo_count(self):
+        return self.produced - self.read
+
+    def read_samples_into(self, buf):
+        n = len(buf) // self.bytes_per_sample
+        assert n <= self.get_fifo_count()
+        for i in range(n):
+            struct.pack_into('<I', buf, i*self.bytes_per_sample, self.read + i)
+        self.read += n
+
+def wait_until(condition, timeout_ms=5000):
+    """
+    Block until condition() is true, for waiting on another thread
+    """
+    for _ in range(timeout_ms):
+        if condition():
+            return
+        thread_sleep_ms(1)
+    raise AssertionError('Timeout')
+
+def run_threaded_reader(hops, hop_length=50, slots=8, stall_hop=None, stall_hops=0):
+    imu = SteppedIMU()
+    reader = ThreadedReader(imu, hop_length, imu.bytes_per_sample, slots=slots, poll_interval_ms=1)
+    first = []
+
+    async def consume():
+        for i in range(hops):
+            if reader.ring.available() == 0:
+                # next hop arrives when the loop has caught up
+                imu.produce(hop_length)
+            await reader.wait()
+            buf = reader.acquire()
+            first.append(struct.unpack_from('<I', buf, 0)[0])
+            reader.release()
+            if i == stall_hop:
+                # slow hop, blocks the loop while stall_hops more hops arrive and are read by the thread
+                imu.produce(stall_hops*hop_length)
+                wait_until(lambda: imu.read == imu.produced)
+                # thread is back to polling, so the hops read are also committed
+                reads = reader.level_reads
+                wait_until(lambda: reader.level_reads > reads)
+
+    reader.start()
+    try:
+        asyncio.run(consume())
+    finally:
+        reader.stop()
+    assert reader.hops == hops
+    return reader, first
+
+def test_threaded_reader():
+    ring = SampleRing(4, 2)
+    assert ring.read_slot() is None
+    for i in range(3):
+        buf = ring.write_slot()
+        buf[0] = i
+        ring.commit()
+    assert ring.write_slot() is None # full, holds slots-1
+    assert ring.available() == 3
+    assert ring.read_slot()[0] == 0
+    ring.release()
+    assert ring.write_slot() is not None
+    assert ring.available() == 2
+
+    # a slow hop does not lose samples, they are waiting in the ring
+    hop_length = 50
+    reader, first = run_threaded_reader(hops=12, stall_hop=2, stall_hops=4)
+    assert first == [ i*hop_length for i in range(12) ], first
+    assert reader.overflows == 0
+    assert reader.high_water == 4, reader.high_water
+
+    # ring too small for the stall, holds only 1 hop. The others are dropped and counted
+    reader, first = run_threaded_reader(hops=6, slots=2, stall_hop=1, stall_hops=4)
+    gaps = sum((b - a) // hop_length - 1 for a, b in zip(first, first[1:]))
+    assert gaps == 3, (gaps, first)
+    assert reader.overflows == 3, reader.overflows
+    print('threaded-reader', 'overflows', reader.overflows, 'stats', reader.stats())
+
+class FakeLSM6DS3Bus():
+    """
+    Register-level fake of I2C bus with an LSM6DS3, for testing the driver
+
+    Has a FIFO of gyro+accel samples. Counts transactions and bytes transferred
+    """
+
+    def __init__(self, fifo_samples=400):
+        self.registers = bytearray(128)
+        self.registers[0x0F] = 0x6A # WHO_AM_I, LSM6DS3TR-C
+        self.fifo = bytearray(12*fifo_samples)
+        self.fifo_words = 0 # words available
+        self.read_pos = 0 # next byte to read in fifo
+        self.write_pos = 0
+        self.overrun = False
+        self.transactions = 0
+        self.bytes = 0
+
+    def add_samples(self, n, value=0):
+        capacity = len(self.fifo) // 2
+        for i in range(n*12):
+            self.fifo[self.write_pos] = (value + i) % 256
+            self.write_pos = (self.write_pos + 1) % len(self.fifo)
+        self.fifo_words += n*6
+        if self.fifo_words > capacity:
+            # continuous mode, oldest samples are overwritten
+            lost = self.fifo_words - capacity
+            self.read_pos = (self.read_pos + (2*lost)) % len(self.fifo)
+            self.fifo_words = capacity
+            self.overrun = True
+
+    def writeto_mem(self, address, reg, buf):
+        self.transactions += 1
+        self.bytes += len(buf)
+        for i in range(len(buf)):
+            self.registers[reg+i] = buf[i]
+
+    def readfrom_mem(self, address, reg, size):
+        buf = bytearray(size)
+        self.readfrom_mem_into(address, reg, buf)
+        return buf
+
+    def readfrom_mem_into(self, address, reg, buf):
+        self.transactions += 1
+        self.bytes += len(buf)
+        if reg == 0x3A:
+            # FIFO_STATUS1-4
+            words = self.fifo_words
+            pattern = (self.read_pos // 2) % 6
+            buf[0] = words & 0xFF
+            buf[1] = ((words >> 8) & 0x0F) | (0b0100_0000 if self.overrun else 0)
+            buf[2] = pattern & 0xFF
+            buf[3] = pattern >> 8
+        elif reg == 0x3E:
+            # FIFO_DATA_OUT
+            for i in range(len(buf)):
+                buf[i] = self.fifo[self.read_pos]
+                self.read_pos = (self.read_pos + 1) % len(self.fifo)
+            self.fifo_words -= len(buf) // 2
+            self.overrun = False
+        else:
+            for i in range(len(buf)):
+                buf[i] = self.registers[reg+i]
+
+def test_lsm6ds_driver():
+    # check FIFO readout of the LSM6DS3 driver, against a fake I2C bus
+    import lsm6ds
+
+    hop_length = 50
+    bus = FakeLSM6DS3Bus()
+    imu = lsm6ds.LSM6DS3(bus, mode=lsm6ds.MODE_52HZ)
+    imu.fifo_enable(True)
+    imu.set_fifo_watermark(hop_length)
+    assert bus.registers[0x06] == (hop_length*6) & 0xFF
+    assert bus.registers[0x0D] == 0b0000_1000 # INT1_FTH
+    chunk = bytearray(12*hop_length)
+
+    # normal operation
+    hops = 100
+    bus.transactions = 0
+    bus.bytes = 0
+    gc.collect()
+    before = gc.mem_alloc() if hasattr(gc, 'mem_alloc') else 0
+    for i in range(hops):
+        bus.add_samples(hop_length, value=i)
+        count = imu.get_fifo_count()
+        assert count == hop_length, count
+        assert not imu.fifo_overrun
+        assert not imu.fifo_misaligned
+        imu.read_samples_into(chunk)
+        assert chunk[0] == i % 256
+    after = gc.mem_alloc() if hasattr(gc, 'mem_alloc') else 0
+    print('lsm6ds-per-hop', 'transactions', bus.transactions / hops,
+        'bytes', bus.bytes / hops, 'allocated', (after - before) / hops)
+    assert bus.transactions == 2*hops, bus.transactions
+    assert after - before == 0, (after - before)
+
+    # overrun, counted once while the flag stays set
+    bus.add_samples(500)
+    imu.get_fifo_count()
+    assert imu.fifo_overrun
+    imu.get_fifo_count()
+    assert imu.fifo_overrun
+    assert imu.fifo_overruns == 1, imu.fifo_overruns
+    imu.read_samples_into(chunk)
+    imu.get_fifo_count()
+    assert not imu.fifo_overrun
+    bus.add_samples(500)
+    imu.get_fifo_count()
+    assert imu.fifo_overruns == 2, imu.fifo_overruns
+
+    # reading a partial sample leaves FIFO misaligned
+    imu.read_samples_into(chunk)
+    imu.read_samples_into(bytearray(4))
+    imu.get_fifo_count()
+    assert imu.fifo_misaligned
+    assert imu.fifo_pattern == 2, imu.fifo_pattern
+    # realigning discards the rest of the sample
+    assert imu.fifo_realign() == 4
+    imu.get_fifo_count()
+    assert not imu.fifo_misaligned
+    assert imu.fifo_realigns == 1
+
+    # changing data rate keeps full-scale bits
+    imu.set_odr(26, low_power=True)
+    assert bus.registers[0x10] == (0b0010 << 4) | (lsm6ds.MODE_52HZ & 0x0F)
+    assert bus.registers[0x0A] == (0b0010 << 3) | 0b110
+    assert bus.registers[0x15] & 0b0001_0000
+    imu.set_odr(52)
+    assert bus.registers[0x10] == lsm6ds.MODE_52HZ
+    assert bus.registers[0x11] == lsm6ds.MODE_52HZ
+    assert not bus.registers[0x15] & 0b0001_0000
+    try:
+        imu.set_odr(50)
+        assert False, 'should raise'
+    except ValueError:
+        pass
+
+
+class FakeClock():
+    """
+    Simulated time in milliseconds, so tests do not depend on the speed of the machine
+
+    Time only moves with advance(), or when all tasks are waiting in sleep_ms(), see run()
+    """
+
+    def __init__(self):
+        self.now = 0
+        self.sleepers = [] # (wakeup time, asyncio.Event)
+
+    def ticks_ms(self):
+        return self.now
+
+    def advance(self, ms):
+        self.now += ms
+
+    async def sleep_ms(self, ms):
+        event = asyncio.Event()
+        self.sleepers.append((self.now + ms, event))
+        await event.wait()
+
+    def run(self, main, settle=10):
+        """
+        Run coroutine main. When tasks have settled, time jumps to the next sleep_ms() wakeup
+        """
+        done = []
+        async def wrapped():
+            await main
+            done.append(True)
+
+        async def schedule():
+            asyncio.create_task(wrapped())
+            while True:
+                for _ in range(settle):
+                    await asyncio.sleep(0)
+                if done:
+                    return
+                assert self.sleepers, 'No tasks sleeping, would never finish'
+                self.now = min(t for t, _ in self.sleepers)
+                waking = [ e for t, e in self.sleepers if t <= self.now ]
+                self.sleepers = [ (t, e) for t, e in self.sleepers if t > self.now ]
+                for event in waking:
+                    event.set()
+
+        asyncio.run(schedule())
+
+def test_sample_clock():
+    # time follows the number of samples, also at samplerates not divisible by hop length
+    samplerate = 52
+    hop_length = 50
+    ticks = FakeClock()
+    clock = SampleClock(samplerate, ticks_ms=ticks.ticks_ms)
+    sm = StateMachine(time=clock.time(), prediction_filter_length=1)
+    sm.brushing_target_time = 1000.0
+
+    hops = 20
+    for i in range(hops):
+        sm.next(clock.time(), 1.0, 1.0)
+        clock.advance(hop_length)
+
+    expect_time = (hops * hop_length) / samplerate
+    assert_close(clock.time(), expect_time, abs=1e-6)
+    assert sm.state == sm.BRUSHING, sm.state
+    # first hop is the transition from SLEEP, the second into BRUSHING
+    expect_brushing = ((hops-2) * hop_length) / samplerate
+    assert_close(sm.brushing_time, expect_brushing, abs=1e-3)
+
+    # latency includes samples left in FIFO after the read
+    assert clock.mark_decision() is None
+    clock.mark_read(backlog=26)
+    ticks.advance(30)
+    latency = clock.mark_decision()
+    assert latency == 500 + 30, latency
+    assert clock.max_latency_ms == latency
+
+    clock.mark_read(backlog=0)
+    ticks.advance(20)
+    latency = clock.mark_decision()
+    assert latency == 20, latency
+    assert clock.max_latency_ms == 530
+
+class FakePWM():
+    """
+    Stand-in for machine.PWM, records the tones played
+    """
+    def __init__(self, pin, freq=1000, duty_u16=0):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty_u16
+        self.tones = []
+
+    def freq(self, value):
+        self._freq = value
+
+    def duty_u16(self, value):
+        self._duty = value
+        if value:
+            self.tones.append(self._freq)
+
+def test_parse_song():
+    tones, durations = parse_song(success_song, tempo=3)
+    assert list(tones) == [1047, 784, 659, 0, 1047], list(tones)
+    assert list(durations) == [3, 3, 3, 3, 12], list(durations)
+
+    # notes out of order in the string
+    tones, durations = parse_song(fail_song, tempo=1)
+    assert list(tones) == [523, 0, 294], list(tones)
+    assert list(durations) == [2, 1, 4], list(durations)
+
+def test_outputs_nonblocking():
+    # check that processing loop does not wait for songs, and that a new state stops the song
+    clock = FakeClock()
+    out = OutputManager(led_pin=1, buzzer_pin=2, note_step_ms=10, PWM=FakePWM, sleep_ms=clock.sleep_ms)
+    hop_interval = 10
+    states = [ ('brushing', 0) ] * 3 + [ ('brushing', 1) ] * 3 + [ ('done', 0) ] * 30
+
+    gaps = []
+    async def process():
+        last = clock.ticks_ms()
+        for state, progress in states:
+            await clock.sleep_ms(hop_interval)
+            out.update(state, progress)
+            now = clock.ticks_ms()
+            gaps.append(now - last)
+            last = now
+
+    async def run():
+        task = asyncio.create_task(out.run())
+        await process()
+        task.cancel()
+
+    clock.run(run())
+
+    # each progress song is 90 ms, success song 210 ms. Hops are 10 ms, and never delayed by a song
+    assert gaps == [ hop_interval ] * len(states), gaps
+    assert out.songs_preempted == 2, out.songs_preempted
+    assert out.songs_played == 1, out.songs_played
+
+    # success song played in full, after the start of the two preempted ones
+    tones = out.buzzer_pwm.tones
+    assert tones[0] == 523, tones
+    assert tones[1] == 698, tones
+    assert tones[-4:] == [1047, 784, 659, 1047], tones
+
+class FakeTreesBuilder():
+    """
+    Records how a model is built, using the same methods as emlearn_trees
+    """
+    def __init__(self, max_trees, max_nodes, max_leaves):
+        self.max_trees = max_trees
+        self.max_nodes = max_nodes
+        self.max_leaves = max_leaves
+        self.roots = []
+        self.leaves = []
+        self.nodes = []
+        self.data = None
+
+    def addroot(self, root):
+        self.roots.append(root)
+
+    def addleaf(self, leaf):
+        self.leaves.append(leaf)
+
+    def addnode(self, left, right, feature, value):
+        self.nodes.append((feature, value, left, right))
+
+    def setdata(self, n_features, n_classes):
+        self.data = (n_features, n_classes)
+
+def test_model_binary():
+    # check that binary model is up-to-date with the CSV, and is right-sized
+    here = dirname(__file__)
+    if here == '':
+        here = '.'
+
+    expect = FakeTreesBuilder(0, 0, 0)
+    with open(here + '/brushing.trees.csv', 'r') as f:
+        for line in f:
+            tok = line.strip().split(',')
+            if tok[0] == 'f':
+                n_features = int(tok[1])
+            elif tok[0] == 'c':
+                n_classes = int(tok[1])
+            elif tok[0] == 'r':
+                expect.addroot(int(tok[1]))
+            elif tok[0] == 'l':
+                expect.addleaf(int(tok[1]))
+            elif tok[0] == 'n':
+                expect.addnode(int(tok[3]), int(tok[4]), int(tok[1]), float(tok[2]))
+
+    with open(here + '/brushing.trees.bin', 'rb') as f:
+        model = load_trees_binary(f, FakeTreesBuilder)
+
+    assert model.data == (n_features, n_classes), model.data
+    assert model.roots == expect.roots, model.roots
+    assert model.leaves == expect.leaves, model.leaves
+    assert model.nodes == expect.nodes, (model.nodes, expect.nodes)
+    assert model.max_trees == len(expect.roots)
+    assert model.max_nodes == len(expect.nodes)
+    assert model.max_leaves == len(expect.leaves)
+
+    # truncated file
+    with open(here + '/brushing.trees.bin', 'rb') as f:
+        data = f.read()
+    import io
+    try:
+        load_trees_binary(io.BytesIO(data[:-4]), FakeTreesBuilder)
+        assert False, 'should raise'
+    except ValueError:
+        pass
+
+def session_outcomes(rows):
+    # time and state of each DONE or FAILED session end, from (time, state, brushing_time)
+    out = []
+    previous = None
+    for t, state, brushing_time in rows:
+        if state != previous and state in (StateMachine.DONE, StateMachine.FAILED):
+            out.append((t, state))
+        previous = state
+    return out
+
+def test_motion_gate_replay():
+    # check that skipping the model while still does not change the outcome
+    data_dir = 'data/jonnor-brushing-1/testdata'
+    filter_length = StateMachine().prediction_filter_length
+
+    for f in sorted(os.listdir(data_dir)):
+        recording = list(read_data_file(data_dir + '/' + f, chunk_length=50))
+        # the recordings are brushing all the way. Lying still before and after,
+        # long enough to go back to sleep, and brushing again after that
+        still = array.array('h', recording[0][0:3] * 50)
+        chunks = [ still ] * 60 + recording + [ still ] * 60 + recording
+
+        reference_out = list(process_chunks(chunks))
+        reference = [ (r[0], r[3], r[4]) for r in reference_out ]
+        gated = []
+        skipped = 0
+        for r, e in zip(process_chunks(chunks, motion_gate=0.1), reference_out):
+            gated.append((r[0], r[3], r[4]))
+            # motion is always computed, and where gating is not active, the model output is exactly the same
+            assert r[0] == e[0] and r[1] == e[1], (f, r, e)
+            if r[2] is None:
+                skipped += 1
+            else:
+                assert r[2] == e[2], (f, r, e)
+        assert len(gated) == len(reference)
+        assert skipped >= 60, (f, skipped)
+
+        # in the reference, predictions on still windows are still in the filter history
+        # when leaving sleep. So brushing can start a few hops apart, but with the same outcome
+        outcomes = session_outcomes(gated)
+        expect = session_outcomes(reference)
+        assert [ s for t, s in outcomes ] == [ s for t, s in expect ], (f, outcomes, expect)
+        for (t, _), (e, _) in zip(outcomes, expect):
+            assert abs(t - e) <= filter_length, (f, outcomes, expect)
+        assert abs(gated[-1][2] - reference[-1][2]) <= filter_length, (f, gated[-1], reference[-1])
+
+    # unit check of the counters, and that gating only happens in sleep
+    processor = DataProcessor(motion_gate=0.1)
+    still = array.array('h', (1000 for _ in range(50)))
+    motion, brushing = processor.process(still, still, still, state=StateMachine.SLEEP)
+    assert brushing is None
+    assert processor.windows_gated == 1
+    processor.process(still, still, still, state=StateMachine.IDLE)
+    assert processor.windows_gated == 1
+    assert processor.windows_processed == 2
+
+    # at a lower samplerate than the model was trained for, sleep is gated also when moving
+    moving = array.array('h', (3000 * (i % 2) for i in range(50)))
+    motion, brushing = processor.process(moving, still, still, state=StateMachine.SLEEP)
+    assert motion >= 0.1 and brushing is not None, (motion, brushing)
+    processor.set_samplerate(25)
+    motion, brushing = processor.process(moving, still, still, state=StateMachine.SLEEP)
+    assert motion >= 0.1 and brushing is None, (motion, brushing)
+    motion, brushing = processor.process(moving, still, still, state=StateMachine.IDLE)
+    assert brushing is not None
+
+    # gated windows do not enter the brushing filter history
+    sm = StateMachine(verbose=0, prediction_filter_length=3)
+    for b in (0.9, 0.9, 0.9):
+        sm.next(0.0, 0.0, b)
+    sm.next(0.0, 0.0, None)
+    assert list(sm.brushing_filter.values) == [0.9, 0.9, 0.9]
+    assert sm.brushing_filter.median() == 0.9
+
+class SimulatedRateIMU():
+    """
+    IMU with adjustable output data rate, producing still or moving accelerometer data
+    """
+
+    def __init__(self, samplerate, motion_periods):
+        self.samplerate = samplerate
+        self.motion_periods = motion_periods # list of (start, end) in seconds
+        self.time = 0.0
+        self.samples = 0
+        self.odr_changes = []
+
+    def set_odr(self, hz, low_power=False):
+        self.samplerate = hz
+        self.odr_changes.append((self.time, hz, low_power))
+
+    def moving(self):
+        for start, end in self.motion_periods:
+            if self.time >= start and self.time < end:
+                return True
+        return False
+
+    def read_hop(self, xs, ys, zs):
+        for i in range(len(xs)):
+            a = 2000 if (self.moving() and i % 2) else 0
+            xs[i] = a
+            ys[i] = -a
+            zs[i] = 4096
+            self.time += 1.0 / self.samplerate
+            self.samples += 1
+
+def run_rate_scenario(adaptive, duration, motion_periods, hop_length=50, writer=None):
+    full_rate = 52
+    imu = SimulatedRateIMU(full_rate, motion_periods)
+    processor = DataProcessor(window_length=2*hop_length, hop_length=hop_length, samplerate=full_rate,
+        gravity_cutoff=0.5, motion_gate=0.1)
+    clock = SampleClock(full_rate)
+    sm = StateMachine(time=clock.time(), verbose=0, prediction_filter_length=3)
+    rates = RateController(imu, processor, clock,
+        full_rate=full_rate, sleep_rate=26 if adaptive else full_rate, low_power=True)
+
+    xs = empty_array('h', hop_length)
+    ys = empty_array('h', hop_length)
+    zs = empty_array('h', hop_length)
+    if writer is not None:
+        record = empty_array('h', writer.hop_items)
+    states = []
+    while imu.time < duration:
+        imu.read_hop(xs, ys, zs)
+        if writer is not None:
+            # recorded as in main.py. Values are the samplerate of the hop
+            for i in range(len(record)):
+                record[i] = imu.samplerate
+            writer.process(record)
+            if writer.pending is not None:
+                # as if the writer task keeps up
+                writer.flush()
+        motion, brushing = processor.process(xs, ys, zs, state=sm.state)
+        sm.next(clock.time(), motion, brushing)
+        clock.advance(hop_length)
+        if rates.update(sm.state, hop_length) and writer is not None:
+            if rates.rate != full_rate:
+                writer.pause()
+            else:
+                writer.resume()
+        states.append((imu.time, sm.state, imu.samplerate))
+
+        # clock follows the sensor, also across rate changes
+        assert abs(clock.time() - imu.time) < 1e-3, (clock.time(), imu.time)
+        assert processor.samplerate == imu.samplerate
+
+    return imu, rates, states
+
+def test_adaptive_samplerate():
+    # check that IMU runs at lower rate while sleeping, and wakes up on motion
+    duration = 15*60.0
+    motion_periods = [ (600.0, 630.0) ]
+    imu_fixed, rates_fixed, states_fixed = run_rate_scenario(False, duration, motion_periods)
+    imu, rates, states = run_rate_scenario(True, duration, motion_periods)
+
+    assert imu_fixed.odr_changes == []
+    assert rates.switches == 3, imu.odr_changes
+    assert imu.odr_changes[0] == (imu.odr_changes[0][0], 26, True)
+
+    # wakes up within a few seconds of motion starting, then stays at full rate while moving
+    woke = [ t for t, hz, low_power in imu.odr_changes if hz == 52 ]
+    assert len(woke) == 1
+    assert woke[0] >= 600.0 and woke[0] < 600.0 + 10.0, woke
+    for t, state, hz in states:
+        if state != StateMachine.SLEEP:
+            assert hz == 52, (t, state, hz)
+
+    # reduction of samples processed while idle
+    fixed_per_hour = (3600 * rates_fixed.sleep_samples) / rates_fixed.sleep_time
+    adaptive_per_hour = (3600 * rates.sleep_samples) / rates.sleep_time
+    print('idle-samples-per-hour', round(fixed_per_hour), round(adaptive_per_hour),
+        'total', imu_fixed.samples, imu.samples)
+    assert adaptive_per_hour <= 0.51 * fixed_per_hour, adaptive_per_hour
+    assert imu.samples < 0.6 * imu_fixed.samples
+
+def test_adaptive_samplerate_recording():
+    # check that recording has only the hops at full rate, also after sleep and wake up
+    hop_length = 50
+    recorder = FakeRecorder()
+    writer = AsyncRecorder(recorder, hop_items=3*hop_length, hops_per_write=4)
+    motion_periods = [ (100.0, 130.0) ]
+    imu, rates, states = run_rate_scenario(True, 200.0, motion_periods, writer=writer)
+    writer.flush()
+
+    full_hops = 0
+    previous = 52
+    for t, state, hz in states:
+        # the hop before a rate change was read at the previous rate
+        if previous == 52:
+            full_hops += 1
+        previous = hz
+    woke = [ t for t, hz, low_power in imu.odr_changes if hz == 52 ]
+    assert len(woke) == 1, imu.odr_changes
+    assert rates.switches >= 2
+
+    assert writer.dropped == 0
+    assert len(recorder.values) == full_hops * 3*hop_length, (len(recorder.values), full_hops)
+    assert set(recorder.values) == { 52 }, set(recorder.values)
+    # includes the hops after waking up
+    assert full_hops > 30, full_hops
+
+class FakeModel():
+    """
+    Model giving fixed probability of class 1, and counting calls
+    """
+    def __init__(self, probability):
+        self.probability = probability
+        self.calls = 0
+
+    def predict(self, features, out):
+        self.calls += 1
+        out[0] = 1.0 - self.probability
+        out[1] = self.probability
+
+def test_cascade():
+    # check that full model is only run when first stage is uncertain
+    processor = DataProcessor(cascade_band=(0.25, 0.75))
+    full = FakeModel(0.55)
+    processor.brushing_model = full
+
+    n = 50
+    xs = array.array('h', (((i*37) % 200) for i in range(n)))
+    ys = array.array('h', ((-(i*13) % 300) for i in range(n)))
+    zs = array.array('h', ((2000 + (i*7) % 50) for i in range(n)))
+
+    expect_calls = 0
+    for p, expect_full in ((0.9, False), (0.75, False), (0.1, False), (0.5, True), (0.3, True)):
+        stage1 = FakeModel(p)
+        processor.cascade_model = stage1
+        motion, brushing = processor.process(xs, ys, zs)
+        assert stage1.calls == 1
+        if expect_full:
+            expect_calls += 1
+            assert brushing == 0.55, (p, brushing)
+        else:
+            assert brushing == p, (p, brushing)
+        assert full.calls == expect_calls, (p, full.calls)
+
+    assert processor.windows_cascaded == 3, processor.windows_cascaded
+
+    # cheap features are from the orientation and energy of the window
+    f = processor.cascade_features
+    assert f[0] > 0
+    assert f[3] > 900, f[3]
+
+def test_histogram():
+    h = Histogram()
+    assert h.summary() == (0, None, None, None, None)
+
+    # exact for small values
+    for v in (0, 1, 2, 3):
+        assert h.bin_upper(h.bin_index(v)) == v
+    # bins are contiguous and increasing
+    for v in range(4, 5000):
+        i = h.bin_index(v)
+        assert h.bin_upper(i) >= v, (v, i)
+        assert h.bin_upper(i-1) < v, (v, i)
+
+    for v in range(1, 1001):
+        h.record(v)
+    count, lo, p50, p95, hi = h.summary()
+    assert (count, lo, hi) == (1000, 1, 1000)
+    assert 500 <= p50 <= 500*1.25, p50
+    assert 950 <= p95 <= 1000, p95
+
+    # huge values go in the last bin
+    h.record(2**30)
+    assert h.max == 2**30
+    assert h.bins[-1] == 1
+
+    if hasattr(gc, 'mem_alloc'):
+        gc.collect()
+        before = gc.mem_alloc()
+        for i in range(100):
+            h.record(i*37)
+        assert gc.mem_alloc() - before == 0, gc.mem_alloc() - before
+
+    h.reset()
+    assert h.count == 0 and sum(h.bins) == 0
+
+def test_stage_timer_process():
+    # instrumentation of processing works also for offline runs
+    data_path = 'data/jonnor-brushing-1/testdata/VID_20241231_155624.mkv.npy'
+    stages = StageTimer(PROCESS_STAGES)
+    windows = 0
+    for res in process_file(data_path, stages=stages):
+        windows += 1
+
+    summary = stages.summary()
+    for name in ('decode', 'orientation', 'features', 'predict', 'state', 'total'):
+        count, lo, p50, p95, hi = summary[name]
+        assert count == windows, (name, count, windows)
+        assert lo <= p50 <= p95 <= hi, (name, summary[name])
+    assert summary['total'][4] >= summary['features'][4]
+
+    # query on demand
+    class Lines():
+        def __init__(self, lines):
+            self.lines = lines
+        async def readline(self):
+            return self.lines.pop(0) if self.lines else b''
+    asyncio.run(serve_commands(stages, Lines([b'stats\n', b'reset\n'])))
+    assert stages.summary()['total'][0] == 0
+
+class FakeGC():
+    """
+    Heap that grows with alloc(), and is emptied by collect()
+    """
+    def __init__(self, heap_size=10000, live=1000):
+        self.heap_size = heap_size
+        self.live = live
+        self.allocated = live
+        self.enabled = True
+        self.collects = 0
+
+    def alloc(self, n):
+        if self.allocated + n > self.heap_size:
+            # allocation failure triggers collection, also when disabled
+            self.allocated = self.live
+        self.allocated += n
+
+    def collect(self):
+        self.collects += 1
+        self.allocated = self.live
+
+    def disable(self):
+        self.enabled = False
+
+    def enable(self):
+        self.enabled = True
+
+    def mem_alloc(self):
+        return self.allocated
+
+    def mem_free(self):
+        return self.heap_size - self.allocated
+
+def test_collection_scheduler():
+    fake = FakeGC()
+    collector = CollectionScheduler(threshold=0.5, sleep_threshold=0.2, gc_module=fake)
+    collector.start()
+    assert not fake.enabled
+    assert collector.heap_size == 10000
+
+    # collects only at slack moments, once usage is above threshold
+    collected = []
+    for hop in range(20):
+        collector.begin_hop()
+        fake.alloc(500)
+        collected.append(collector.slack(sleeping=False))
+    assert collected.count(True) == 2, collected
+    assert fake.collects == 3
+    assert collector.high_water == 5500, collector.high_water
+    assert collector.hop_allocations.summary()[1:] == (500, 500, 500, 500)
+
+    # more often when sleeping
+    fake.collect()
+    collected = []
+    for hop in range(3):
+        collector.begin_hop()
+        fake.alloc(600)
+        collected.append(collector.slack(sleeping=True))
+    assert collected == [False, True, False], collected
+
+    # collection caused by allocation failure is detected
+    fake.allocated = 9900
+    collector.begin_hop()
+    fake.alloc(500)
+    collector.slack()
+    assert collector.forced == 1, collector.forced
+    assert collector.pauses.count == collector.collections
+
+    collector.stop()
+    assert fake.enabled
+
+def test_binary_log():
+    log = BinaryLog(records=8)
+
+    # wraps around, oldest records are dropped
+    for i in range(10):
+        log.log(binlog.EVENT_INPUTS, 2, scaled(i/100, 100), scaled(1000.0, 100))
+    assert log.count == 8
+    assert log.dropped == 2
+
+    chunks = []
+    n = log.drain(lambda data: chunks.append(bytes(data)))
+    assert n == 8
+    assert len(chunks) == 2, len(chunks)
+    assert log.drain(lambda data: chunks.append(bytes(data))) == 0
+
+    records = list(decode_records(b''.join(chunks)))
+    assert [ r[2]['brushing'] for r in records ] == [ i/100 for i in range(2, 10) ]
+    ticks, name, values = records[0]
+    assert name == 'main-inputs'
+    assert values['state'] == 'brushing'
+    assert values['motion'] == 327.67 # saturated
+
+    # state machine traces into the log
+    sm = StateMachine(verbose=2, log=log)
+    for i in range(5):
+        sm.next(time=0.1*i, motion=1.0, brushing=0.0)
+    assert sm.state == 'idle'
+    data = bytearray()
+    log.drain(data.extend)
+    records = list(decode_records(data))
+    assert records[0][1] == 'sm-next'
+    transitions = [ r[2] for r in records if r[1] == 'sm-transition' ]
+    assert transitions == [ dict(state='sleep', next_state='idle') ], transitions
+
+    if not hasattr(gc, 'mem_alloc'):
+        print('skip-test-binary-log-allocation', 'gc.mem_alloc not available')
+        return
+
+    # logging integers does not allocate
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.mem_alloc()
+        for i in range(100):
+            log.log(binlog.EVENT_LATENCY, 0, i)
+        after = gc.mem_alloc()
+    finally:
+        gc.enable()
+    assert after == before, (after - before)
+
+class FakeRecorder():
+    def __init__(self, delay_ms=0, clock=None):
+        self.values = []
+        self.writes = 0
+        self.max_items = 0
+        self.delay_ms = delay_ms # simulated slow storage, blocks. Advances clock
+        self.clock = clock
+
+    def process(self, data):
+        self.writes += 1
+        self.max_items = max(self.max_items, len(data))
+        self.values.extend(data)
+        if self.delay_ms:
+            self.clock.advance(self.delay_ms)
+
+def test_async_recorder():
+    hop_items = 6
+    recorder = FakeRecorder()
+    writer = AsyncRecorder(recorder, hop_items=hop_items, hops_per_write=4)
+
+    def hop(i):
+        return array.array('h', (i for _ in range(hop_items)))
+
+    async def run():
+        task = asyncio.create_task(writer.run())
+
+        # hot path only copies, full buffers are written one hop per slice
+        for i in range(10):
+            writer.process(hop(i))
+            await sleep_ms(0)
+        for _ in range(5):
+            await sleep_ms(0)
+        assert writer.writes == 2, writer.writes
+        assert recorder.writes == 8, recorder.writes
+        assert recorder.max_items == hop_items
+        assert writer.dropped == 0
+
+        # writer does not get to run, data is dropped instead of waiting
+        for i in range(10, 22):
+            writer.process(hop(i))
+        assert writer.dropped == 2, writer.dropped
+        await sleep_ms(0)
+        writer.flush()
+        task.cancel()
+
+    asyncio.run(run())
+    hops = [ recorder.values[i] for i in range(0, len(recorder.values), hop_items) ]
+    assert hops == list(range(0, 12)) + [20, 21], hops
+    assert writer.writes == 4, writer.writes
+    assert writer.write_times.count == recorder.writes
+
+    # storage slower than the data comes in. Hops arrive on a clock, like from the IMU FIFO,
+    # and the processing loop only waits for one slice at a time
+    # Each pass of the processing loop takes 1 ms
+    hop_ms = 5
+    n_hops = 40
+    clock = FakeClock()
+    recorder = FakeRecorder(delay_ms=20, clock=clock)
+    writer = AsyncRecorder(recorder, hop_items=hop_items, hops_per_write=4)
+
+    stalls = Histogram()
+
+    async def produce():
+        task = asyncio.create_task(writer.run())
+        start = clock.ticks_ms()
+        last = start
+        produced = 0
+        while produced < n_hops:
+            now = clock.ticks_ms()
+            stalls.record(now - last)
+            last = now
+            due = min(n_hops, ((now - start) // hop_ms) + 1)
+            while produced < due:
+                writer.process(hop(produced))
+                produced += 1
+            clock.advance(1)
+            await sleep_ms(0)
+        writer.flush()
+        task.cancel()
+
+    asyncio.run(produce())
+    hops = [ recorder.values[i] for i in range(0, len(recorder.values), hop_items) ]
+    assert writer.dropped > 0, writer.dropped
+    assert len(hops) + 4*writer.dropped == n_hops, (len(hops), writer.dropped)
+    assert hops == sorted(hops)
+    assert recorder.max_items == hop_items
+    # loop is stalled by one slice at a time, not a whole buffer of 4 hops
+    assert stalls.max == recorder.delay_ms + 1, stalls.max
+    print('async-recorder-slow', 'dropped', writer.dropped, 'writes', writer.writes, 'max-stall-ms', stalls.max)
+
+def decode_hrz(data):
+    # pure-Python version of software/dataset/harz.py
+    _, version, items, _, samplerate = struct.unpack_from(recording.HRZ_HEADER_FORMAT, data, 0)
+    offset = struct.calcsize(recording.HRZ_HEADER_FORMAT)
+    values = []
+    blocks = 0
+    while offset < len(data):
+        samples, size, shift = struct.unpack_from(recording.HRZ_BLOCK_FORMAT, data, offset)
+        offset += recording.HRZ_BLOCK_HEADER_SIZE
+        end = offset + size
+        block = []
+        z = 0
+        bit = 0
+        while offset < end:
+            b = data[offset]
+            offset += 1
+            z |= (b & 0x7F) << bit
+            bit += 7
+            if b & 0x80:
+                continue
+            d = (z >> 1) if (z & 1) == 0 else -((z + 1) >> 1)
+            block.append(d + (block[-items] if len(block) >= items else 0))
+            z = 0
+            bit = 0
+        assert len(block) == samples*items
+        values.extend(v << shift for v in block)
+        blocks += 1
+    return samplerate, items, blocks, values
+
+def test_compressed_recorder():
+    import os
+    directory = 'test_hrz_record'
+    items = 3
+    hop_length = 50
+
+    # include largest possible differences, and low bits that are 0
+    hops = []
+    for h in range(7):
+        hops.append(array.array('h', (
+            (32767 if (i//items) % 2 else -32768) if h == 3 else (((h*977 + i*131) % 256) - 128) * (1 << h)
+            for i in range(items*hop_length) )))
+
+    def record(duration, chunks):
+        with CompressedRecorder(50, duration=duration, directory=directory,
+                items_per_sample=items, block_samples=80) as recorder:
+            recorder.delete()
+            recorder.set_class('brushing')
+            recorder.start()
+            for values in chunks:
+                recorder.process(values)
+        return recorder
+
+    # NOTE: files are named by time in seconds, so only one file is checked
+    recorder = record(10.0, hops)
+    files = os.listdir(directory)
+    assert len(files) == 1 and files[0].endswith('_brushing.hrz'), files
+    with open(directory + '/' + files[0], 'rb') as f:
+        samplerate, n_items, blocks, decoded = decode_hrz(f.read())
+    assert (samplerate, n_items) == (50, items)
+    assert blocks == len(hops)
+
+    expected = []
+    for values in hops:
+        expected.extend(values)
+    assert decoded == expected
+    assert recorder.raw_bytes == 2*len(expected)
+    print('hrz-ratio', recorder.raw_bytes / recorder.encoded_bytes)
+
+    # long writes are split into blocks, and files rotated after duration
+    recorder = record(3.0, [ array.array('h', expected) ])
+    assert recorder.files == 3, recorder.files
+    assert recorder.encode_times.count == 5, recorder.encode_times.count # 80+70 80+70 50
+
+    recorder.delete()
+    os.rmdir(directory)
+
+def test_segmented_recorder():
+    import os
+    directory = 'test_hrs_record'
+    items = 3
+    hop = array.array('h', range(items*50))
+
+    with SegmentedRecorder(50, duration=3.0, directory=directory, items_per_sample=items) as recorder:
+        recorder.delete()
+        recorder.set_class('brushing')
+        recorder.start()
+        # 4 hops in one write, crosses a segment boundary
+        recorder.process(array.array('h', list(hop)*4))
+        recorder.process(hop)
+        recorder.set_class('other')
+        recorder.process(hop)
+        assert recorder.sessions == 1
+
+    # one session, not one file per segment
+    files = sorted(os.listdir(directory))
+    assert len(files) == 2, files
+    assert files[0].endswith('.hri') and files[1].endswith('.hrs'), files
+
+    with open(directory + '/' + files[0], 'rb') as f:
+        index = f.read()
+    assert len(index) == 3*recording.HRS_INDEX_SIZE
+    entries = [ struct.unpack_from(recording.HRS_INDEX_FORMAT, index, i*recording.HRS_INDEX_SIZE)
+        for i in range(3) ]
+    assert [ e[0] for e in entries ] == [0, 150, 250], entries
+    assert [ e[8].rstrip(b'\0') for e in entries ] == [b'brushing', b'brushing', b'other'], entries
+
+    header_size = struct.calcsize(recording.HRS_HEADER_FORMAT)
+    with open(directory + '/' + files[1], 'rb') as f:
+        data = f.read()
+    assert len(data) == header_size + 2*items*300, len(data)
+    assert struct.unpack_from('<hh', data, header_size + 2*items*50) == (0, 1)
+
+    recorder.delete()
+    os.rmdir(directory)
+
 def test_processing_happy():
 
     total_brushing_time = 0.0
@@ -134,6 +1754,37 @@ def test_processing_happy():
 def main():
     test_states_basic_happy()
     #test_states_basic_sad()
+    test_median_filter()
+    test_window_stats()
+    test_window_stats_int()
+    test_features_no_allocation()
+    test_process_allocation()
+    test_kernels_match_python()
+    test_decode_chunk()
+    test_fifo_interrupt()
+    test_thread_safe_flag()
+    test_fifo_reader_hop()
+    test_threaded_reader()
+    test_lsm6ds_driver()
+    test_window_buffer()
+    test_sliding_window_stats()
+    test_gravity_splitter_block()
+    test_processor_window_same_as_hop()
+    test_sample_clock()
+    test_parse_song()
+    test_outputs_nonblocking()
+    test_model_binary()
+    test_motion_gate_replay()
+    test_adaptive_samplerate()
+    test_adaptive_samplerate_recording()
+    test_cascade()
+    test_histogram()
+    test_stage_timer_process()
+    test_collection_scheduler()
+    test_binary_log()
+    test_async_recorder()
+    test_compressed_recorder()
+    test_segmented_recorder()
 
     test_processing_happy()
 
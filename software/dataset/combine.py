@@ -11,6 +11,8 @@ import pandas
 import numpy
 
 from software.utils.labelstudio import read_timeseries_labels
+from software.dataset.harz import read_harz, HRZ_SUFFIX
+from software.dataset.segments import session_recordings, HRS_SUFFIX
 
 
 def parse_har_record_filename(f, default_date=None):
@@ -18,7 +20,7 @@ def parse_har_record_filename(f, default_date=None):
     if default_date is not None:
         f = f.replace('0000-00-00', default_date.strftime('%Y-%m-%d'))
 
-    tok = f.replace('.npy', '').split('_')
+    tok = os.path.splitext(f)[0].split('_')
     datestr, label = tok
 
     s = pandas.Series({
@@ -27,6 +29,13 @@ def parse_har_record_filename(f, default_date=None):
     })
     return s
 
+def read_har_record_file(path):
+    """Read one recording, either .npy or compressed .hrz"""
+    if path.endswith(HRZ_SUFFIX):
+        data, _ = read_harz(path)
+        return data
+    return numpy.load(path, allow_pickle=True)
+
 def load_har_record(path,
         samplerate,
         sensitivity,
@@ -34,40 +43,49 @@ def load_har_record(path,
         suffix = '.npy',
         columns=None,
         ):
-    """Load dataset from har_record.py, from emlearn-micropython har_trees example"""
+    """Load dataset from har_record.py, from emlearn-micropython har_trees example
+
+    suffix '.hrz' loads recordings in the compressed format, see software/dataset/harz.py
+    suffix '.hrs' loads each segment of recording sessions, see software/dataset/segments.py
+    """
 
     files = []
 
     if columns is None:
         columns = ['x', 'y', 'z']
 
+    recordings = []
     for f in os.listdir(path):
         if f.endswith(suffix):
             p = os.path.join(path, f)
             try:
-                data = numpy.load(p, allow_pickle=True)
+                if suffix == HRS_SUFFIX:
+                    recordings += session_recordings(p)
+                else:
+                    recordings.append((f, read_har_record_file(p)))
             except Exception as e:
                 print(e)
                 continue
 
-            df = pandas.DataFrame(data, columns=columns)
+    for f, data in recordings:
+        df = pandas.DataFrame(data, columns=columns)
 
-            # Scale values into physical units (g)
-            df = df.astype(float) / maxvalue * sensitivity
+        # Scale values into physical units (g)
+        df = df.astype(float) / maxvalue * sensitivity
 
-            # Add a time column, use as index
-            t = numpy.arange(0, len(df)) * (1.0/samplerate)
-            df['time'] = t
-            df = df.set_index('time')
+        # Add a time column, use as index
+        t = numpy.arange(0, len(df)) * (1.0/samplerate)
+        df['time'] = t
+        df = df.set_index('time')
 
-            classname = f.split('_')[1].rstrip(suffix)
-            
-            # Remove :, special character on Windows
-            filename = f.replace(':', '')
+        classname = f.split('_')[1][:-len(suffix)]
+        
+        # Remove :, special character on Windows
+        filename = f.replace(':', '')
 
-            files.append(dict(data=df, filename=filename, classname=classname))
+        files.append(dict(data=df, filename=filename, classname=classname))
 
-            #print(f, data.shape)
+        #print(f, data.shape)
 
     out = pandas.DataFrame.from_records(files)
     out = out.set_index('filename')
@@ -100,7 +118,7 @@ def read_labels(path):
 
     # Enrich
     labels['duration'] = labels['end'] - labels['start']
-    gg = labels.groupby('filename', as_index=False).apply(find_label_gaps, include_groups=False).droplevel(0)
+    gg = labels.groupby('filename', group_keys=False).apply(find_label_gaps, include_groups=False)
     labels['gap'] = gg
 
     return labels
@@ -162,6 +180,30 @@ def load_videos(path):
 
     return videos
 
+def read_session_labels(labels_path, sessions_path):
+    """
+    Read labels, and place them in sensor data time using the sessions metadata
+
+    Labels are made on the videos, so start_time and end_time are the video file time,
+    plus the label_alignment of the session, plus the label start/end.
+    """
+    labels = read_labels(labels_path)
+    sessions = load_videos(sessions_path)
+
+    # the current data was labeled based on the video, which has the google drive ID as the unique id
+    labels['gdrive_id'] = labels['filename'].str.replace('ucexportdownloadid', '')
+    labels = labels.drop(columns=['data_url', 'file', 'filename'])
+
+    mm = pandas.merge(labels, sessions, left_on='gdrive_id', right_on='gdrive_id')
+    mm = mm.drop(columns=['updated_at', 'created_at', 'lead_time', 'annotator', 'annotation_id', 'activity', 'channel', 'id'])
+    align_label = pandas.to_timedelta(mm['label_alignment'], unit='s')
+    mm['start_time'] = mm['file_time'] + align_label + pandas.to_timedelta(mm['start'], unit='s')
+    mm['end_time'] = mm['file_time'] + align_label + pandas.to_timedelta(mm['end'], unit='s')
+    mm = mm.drop(columns=['file_time', 'start', 'end'])
+    mm = mm.drop(columns=['gdrive_id'])
+
+    return mm
+
 def apply_sessions(data, labels, pad_start='30s', pad_end='30s'):
 
     pad_start = pandas.Timedelta(pad_start)
@@ -181,9 +223,9 @@ def apply_sessions(data, labels, pad_start='30s', pad_end='30s'):
 
     return df
 
-def load_sensor_data(path, samplerate=50, sensitivity=2.0, columns=None, default_date=None):
+def load_sensor_data(path, samplerate=50, sensitivity=2.0, columns=None, default_date=None, suffix='.npy'):
 
-    files = load_har_record(path, samplerate=samplerate, sensitivity=sensitivity, columns=columns)
+    files = load_har_record(path, samplerate=samplerate, sensitivity=sensitivity, columns=columns, suffix=suffix)
     files = files.reset_index()
     stats = files.filename.apply(parse_har_record_filename, default_date=default_date).add_prefix('file_')
     files = pandas.merge(files, stats, right_index=True, left_index=True)
@@ -233,6 +275,9 @@ def parse():
     parser.add_argument('--columns', type=comma_separated_strings, default=None,
                         help='Comma-separated column names to process')
 
+    parser.add_argument('--suffix', type=str, default='.npy',
+                        help='Recording file suffix. .npy or .hrz (compressed)')
+
     parser.add_argument('--default-date', type=date_type, default=None,
                         help='Date to set if data has 0000-00-00')
 
@@ -250,49 +295,18 @@ def main():
         sensitivity=args.sensitivity,
         samplerate=args.samplerate,
         default_date=args.default_date,
+        suffix=args.suffix,
     )
     # drop duplicates
     data = data.drop_duplicates(subset=['time'])
 
     print(data.head())
     
-    # Load session data
-    sessions = None
-    if args.sessions is not None:
-        sessions = load_videos(args.sessions)
-
-    # Load labels
+    # Load labels, combined with session information
     labels_path = args.labels
     if labels_path is not None:
-        labels = read_labels(args.labels)
-        labels_display_columns = [
-            'start',
-            'end',
-            'class',
-            'duration',
-            'gap',
-            'file',
-            'id',
-            'filename',
-        ]
-
-        print(sorted(labels.columns))
-        print(labels[labels_display_columns])
-        print(labels['file'].unique())
-
-        # Combine labels with session information
-        # the current data was labeled based on the video, which has the google drive ID as the unique id
-        labels['gdrive_id'] = labels['filename'].str.replace('ucexportdownloadid', '')
-        labels = labels.drop(columns=['data_url', 'file', 'filename'])
-
-        mm = pandas.merge(labels, sessions, left_on='gdrive_id', right_on='gdrive_id')
-        mm = mm.drop(columns=['updated_at', 'created_at', 'lead_time', 'annotator', 'annotation_id', 'activity', 'channel', 'id'])
-        align_label = pandas.to_timedelta(mm['label_alignment'], unit='s')
-        mm['start_time'] = mm['file_time'] + align_label + pandas.to_timedelta(mm['start'], unit='s')
-        mm['end_time'] = mm['file_time'] + align_label + pandas.to_timedelta(mm['end'], unit='s')
+        mm = read_session_labels(labels_path, args.sessions)
         mm['dummy_filename'] = 'only-one-sensor'
-        mm = mm.drop(columns=['file_time', 'start', 'end'])
-        mm = mm.drop(columns=['gdrive_id'])
 
         print(mm.head())
 
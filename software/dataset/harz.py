@@ -0,0 +1,153 @@
+"""
+Compressed recording format (.hrz) written by CompressedRecorder in firmware/recording.py
+
+Reports the compression ratio on existing .npy recordings
+
+    python -m software.dataset.harz data/jonnor-brushing-1/har_record
+"""
+
+import os
+import struct
+
+import numpy
+
+# NOTE: must match firmware/recording.py
+HRZ_MAGIC = b'HRZ'
+HRZ_VERSION = 1
+HRZ_HEADER_FORMAT = '<3sBBBH'
+HRZ_BLOCK_FORMAT = '<HHB'
+HRZ_SUFFIX = '.hrz'
+
+
+def encode_block(data):
+    """
+    Encode int16 samples x channels as one block. Same as encode_delta_varint() in firmware
+    """
+    data = numpy.asarray(data, dtype=numpy.int64)
+    # number of low bits that are 0 in all values
+    bits = int(numpy.bitwise_or.reduce(data.ravel() & 0xFFFF)) if data.size else 0
+    shift = 0
+    if bits:
+        while (bits >> shift) & 1 == 0:
+            shift += 1
+    deltas = numpy.diff(data >> shift, axis=0, prepend=0).ravel()
+    z = numpy.where(deltas >= 0, deltas << 1, ((-deltas) << 1) - 1)
+
+    # varint, 7 bits per byte, low first
+    out = bytearray()
+    for v in z.tolist():
+        while v >= 0x80:
+            out.append((v & 0x7F) | 0x80)
+            v >>= 7
+        out.append(v)
+
+    return struct.pack(HRZ_BLOCK_FORMAT, len(data), len(out), shift) + bytes(out)
+
+
+def encode_harz(data, samplerate, block_samples=200):
+    """
+    Encode int16 samples x channels into .hrz file contents
+    """
+    out = [ struct.pack(HRZ_HEADER_FORMAT, HRZ_MAGIC, HRZ_VERSION, data.shape[1], 0, samplerate) ]
+    for start in range(0, len(data), block_samples):
+        out.append(encode_block(data[start:start+block_samples]))
+    return b''.join(out)
+
+
+def decode_block(payload, samples, channels, shift=0):
+    b = numpy.frombuffer(payload, dtype=numpy.uint8)
+
+    # each value ends at a byte without continuation bit
+    ends = numpy.flatnonzero((b & 0x80) == 0)
+    assert len(ends) == samples*channels, (len(ends), samples, channels)
+    starts = numpy.concatenate([[0], ends[:-1] + 1])
+    value_index = numpy.repeat(numpy.arange(len(ends)), ends - starts + 1)
+    position = numpy.arange(len(b)) - starts[value_index]
+
+    z = numpy.zeros(len(ends), dtype=numpy.int64)
+    numpy.add.at(z, value_index, (b & 0x7F).astype(numpy.int64) << (7 * position))
+    deltas = (z >> 1) ^ -(z & 1)
+
+    values = numpy.cumsum(deltas.reshape(samples, channels), axis=0) << shift
+    return values.astype(numpy.int16)
+
+
+def decode_harz(data):
+    """
+    Decode .hrz file contents. Returns int16 array of samples x channels, and samplerate
+    """
+    header_size = struct.calcsize(HRZ_HEADER_FORMAT)
+    block_header_size = struct.calcsize(HRZ_BLOCK_FORMAT)
+
+    magic, version, channels, _, samplerate = struct.unpack_from(HRZ_HEADER_FORMAT, data, 0)
+    if magic != HRZ_MAGIC:
+        raise ValueError(f"Not a .hrz file, magic={magic}")
+    if version != HRZ_VERSION:
+        raise ValueError(f"Unsupported .hrz version {version}")
+
+    blocks = []
+    offset = header_size
+    while offset + block_header_size <= len(data):
+        samples, size, shift = struct.unpack_from(HRZ_BLOCK_FORMAT, data, offset)
+        offset += block_header_size
+        if offset + size > len(data):
+            # truncated last block, for example from power loss while writing
+            break
+        blocks.append(decode_block(data[offset:offset+size], samples, channels, shift))
+        offset += size
+
+    if not blocks:
+        return numpy.zeros((0, channels), dtype=numpy.int16), samplerate
+    return numpy.concatenate(blocks), samplerate
+
+
+def read_harz(path):
+    with open(path, 'rb') as f:
+        return decode_harz(f.read())
+
+
+def compression_report(path, samplerate=50):
+    """
+    Encode all .npy recordings in path, check round-trip, and return sizes per file as DataFrame
+    """
+    import pandas
+
+    rows = []
+    for f in sorted(os.listdir(path)):
+        if not f.endswith('.npy'):
+            continue
+        p = os.path.join(path, f)
+        try:
+            data = numpy.load(p)
+        except ValueError as e:
+            # some recordings are truncated
+            print(f, e)
+            continue
+        encoded = encode_harz(data, samplerate)
+        decoded, _ = decode_harz(encoded)
+        assert numpy.array_equal(decoded, data), f
+
+        rows.append(dict(file=f, samples=len(data), npy=os.path.getsize(p),
+            raw=data.nbytes, hrz=len(encoded)))
+
+    return pandas.DataFrame.from_records(rows)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Report compression of .npy recordings with the .hrz format')
+    parser.add_argument('path', type=str, help='Directory with har_record .npy files')
+    parser.add_argument('--samplerate', type=int, default=50)
+    args = parser.parse_args()
+
+    df = compression_report(args.path, samplerate=args.samplerate)
+    total = df[['samples', 'npy', 'raw', 'hrz']].sum()
+    print(f"files={len(df)} samples={total.samples}")
+    print(f"npy={total.npy} bytes raw={total.raw} bytes hrz={total.hrz} bytes")
+    print(f"ratio raw/hrz={total.raw / total.hrz:.2f} npy/hrz={total.npy / total.hrz:.2f}")
+    print(f"bytes per sample={total.hrz / total.samples:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Segmented recording sessions (.hrs data, .hri index) written by SegmentedRecorder in firmware/recording.py
+
+The data is memory-mapped, so a time range can be read without loading the whole session
+
+    python -m software.dataset.segments data/session/2025-01-01T120000.hrs
+"""
+
+import os
+import struct
+
+import numpy
+import pandas
+
+# NOTE: must match firmware/recording.py
+HRS_MAGIC = b'HRS'
+HRS_VERSION = 1
+HRS_HEADER_FORMAT = '<3sBBBH'
+HRS_SUFFIX = '.hrs'
+HRS_INDEX_SUFFIX = '.hri'
+HRS_INDEX_FORMAT = '<IHBBBBBB12s'
+
+
+def read_index(path):
+    """
+    Read segment index. Returns DataFrame with offset, start and classname per segment
+    """
+    entry_size = struct.calcsize(HRS_INDEX_FORMAT)
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    rows = []
+    # ignore a partially written last entry
+    for pos in range(0, len(data) - entry_size + 1, entry_size):
+        offset, year, month, day, hour, minute, second, _, classname = \
+            struct.unpack_from(HRS_INDEX_FORMAT, data, pos)
+        rows.append(dict(offset=offset,
+            start=pandas.Timestamp(year, month, day, hour, minute, second),
+            classname=classname.rstrip(b'\0').decode()))
+
+    return pandas.DataFrame.from_records(rows, columns=['offset', 'start', 'classname'])
+
+
+class Session():
+    """
+    A recording session, with data memory-mapped as int16 samples x channels
+    """
+
+    def __init__(self, path):
+        header_size = struct.calcsize(HRS_HEADER_FORMAT)
+        with open(path, 'rb') as f:
+            header = f.read(header_size)
+        magic, version, channels, _, samplerate = struct.unpack(HRS_HEADER_FORMAT, header)
+        if magic != HRS_MAGIC:
+            raise ValueError(f"Not a .hrs file, magic={magic}")
+        if version != HRS_VERSION:
+            raise ValueError(f"Unsupported .hrs version {version}")
+
+        # a partially written last sample is ignored
+        n_samples = (os.path.getsize(path) - header_size) // (2 * channels)
+        self.path = path
+        self.samplerate = samplerate
+        self.data = numpy.memmap(path, dtype='<i2', mode='r', offset=header_size, shape=(n_samples, channels))
+
+        segments = read_index(path[:-len(HRS_SUFFIX)] + HRS_INDEX_SUFFIX)
+        # samples written after the last index entry belong to the last segment
+        segments = segments[segments.offset < n_samples].copy()
+        ends = list(segments.offset[1:]) + [ n_samples ]
+        segments['samples'] = numpy.array(ends, dtype=int) - segments.offset.values
+        segments['end'] = segments.start + pandas.to_timedelta(segments.samples / samplerate, unit='s')
+        self.segments = segments
+
+    def sample_at(self, t):
+        """
+        Sample index at time t. Times are relative to the start of the segment containing t
+        """
+        t = pandas.Timestamp(t)
+        segments = self.segments
+        idx = segments.start.searchsorted(t, side='right') - 1
+        if idx < 0:
+            return 0
+        seg = segments.iloc[idx]
+        position = int((t - seg.start).total_seconds() * self.samplerate)
+        return seg.offset + min(position, seg.samples)
+
+    def read(self, start, end):
+        """
+        Samples between times start and end, as a view into the memory-mapped data
+        """
+        return self.data[self.sample_at(start):self.sample_at(end)]
+
+    def segment_data(self, index):
+        seg = self.segments.iloc[index]
+        return self.data[seg.offset:seg.offset+seg.samples]
+
+
+def session_recordings(path):
+    """
+    Segments of a session as (filename, data), named like the files from Recorder, TIME_CLASS.hrs
+    """
+    session = Session(path)
+    out = []
+    for i, seg in enumerate(session.segments.itertuples()):
+        filename = f"{seg.start:%Y-%m-%dT%H%M%S}_{seg.classname}{HRS_SUFFIX}"
+        out.append((filename, numpy.asarray(session.segment_data(i))))
+    return out
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Show segments of a recording session')
+    parser.add_argument('path', type=str, help='Path to .hrs file')
+    args = parser.parse_args()
+
+    session = Session(args.path)
+    print(f"samplerate={session.samplerate} samples={len(session.data)} channels={session.data.shape[1]}")
+    print(session.segments)
+
+
+if __name__ == '__main__':
+    main()
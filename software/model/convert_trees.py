@@ -0,0 +1,105 @@
+"""
+Convert a tree ensemble from emlearn CSV format into the binary format loaded by the firmware
+
+The binary format is read with a single read on device, into storage sized from the header.
+See load_trees_binary() in firmware/core.py
+
+    python -m software.model.convert_trees firmware/brushing.trees.csv firmware/brushing.trees.bin
+"""
+
+import struct
+
+# NOTE: must match firmware/core.py
+TREES_MAGIC = b'EMLT'
+TREES_VERSION = 1
+TREES_HEADER_FORMAT = '<4sBBHHHHH'
+TREES_NODE_FORMAT = '<hhhf'
+
+
+def read_trees_csv(path):
+    """
+    Read a tree ensemble in emlearn CSV format
+
+    Returns a dict with n_features, n_classes, roots, leaves, and nodes as (feature, value, left, right)
+    """
+    trees = dict(n_features=None, n_classes=None, roots=[], leaves=[], nodes=[])
+
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            tok = line.split(',')
+            kind = tok[0]
+            if kind == 'f':
+                trees['n_features'] = int(tok[1])
+            elif kind == 'c':
+                trees['n_classes'] = int(tok[1])
+            elif kind == 'r':
+                trees['roots'].append(int(tok[1]))
+            elif kind == 'l':
+                trees['leaves'].append(int(tok[1]))
+            elif kind == 'n':
+                feature, value, left, right = int(tok[1]), float(tok[2]), int(tok[3]), int(tok[4])
+                trees['nodes'].append((feature, value, left, right))
+            else:
+                raise ValueError(f"Unknown line type '{kind}' in {path}")
+
+    if trees['n_features'] is None or trees['n_classes'] is None:
+        raise ValueError(f"Missing number of features/classes in {path}")
+
+    return trees
+
+
+def encode_trees_binary(trees) -> bytes:
+    """
+    Encode tree ensemble into binary format
+    """
+    roots = trees['roots']
+    leaves = trees['leaves']
+    nodes = trees['nodes']
+
+    out = bytearray()
+    out += struct.pack(TREES_HEADER_FORMAT, TREES_MAGIC, TREES_VERSION,
+        trees['n_classes'], trees['n_features'], len(roots), len(nodes), len(leaves), 0)
+    for root in roots:
+        out += struct.pack('<h', root)
+    for leaf in leaves:
+        out += struct.pack('<h', leaf)
+    for feature, value, left, right in nodes:
+        out += struct.pack(TREES_NODE_FORMAT, feature, left, right, value)
+
+    return bytes(out)
+
+
+def parse():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert emlearn trees CSV model to binary format for firmware')
+
+    parser.add_argument('input', type=str,
+                        help='Path to model in CSV format')
+    parser.add_argument('output', type=str,
+                        help='Path to write binary model')
+
+    return parser.parse_args()
+
+
+def main():
+    import os.path
+
+    args = parse()
+
+    trees = read_trees_csv(args.input)
+    data = encode_trees_binary(trees)
+    with open(args.output, 'wb') as f:
+        f.write(data)
+
+    csv_size = os.path.getsize(args.input)
+    print(f"Wrote {args.output}")
+    print(f"trees={len(trees['roots'])} nodes={len(trees['nodes'])} leaves={len(trees['leaves'])}")
+    print(f"size: csv={csv_size} bytes binary={len(data)} bytes")
+
+
+if __name__ == '__main__':
+    main()
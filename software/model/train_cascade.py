@@ -0,0 +1,247 @@
+"""
+Train the first stage of the brushing model cascade, and export it for the firmware
+
+The first stage is a small tree ensemble on cheap features that the firmware computes anyway:
+window motion energy, and normalized orientation. See compute_cascade_features() in firmware/core.py.
+When it is confident, the full model is not run.
+
+Windows are labeled using the Label Studio annotations of the recording sessions,
+the same as software/dataset/combine.py does for the full model.
+
+    python -m software.model.train_cascade --data data/jonnor-brushing-1/har_record \\
+        --labels data/jonnor-brushing-1/labels/project-7-at-2024-12-31-23-50-84589958.csv \\
+        --sessions data/jonnor-brushing-1/videos.csv \\
+        --out firmware/brushing_stage1.trees.bin
+"""
+
+import os
+
+import numpy
+import pandas
+
+from software.model.convert_trees import encode_trees_binary
+
+# NOTE: must match firmware/core.py
+CASCADE_ORIENTATION_SCALE = 1000
+FEATURE_NAMES = ['energy', 'orientation_x', 'orientation_y', 'orientation_z']
+
+
+def compute_cascade_features(data, window_length=50, hop_length=50):
+    """
+    Compute first stage features for each window of int16 accelerometer data (samples x 3)
+    """
+    windows = []
+    for start in range(0, len(data) - window_length + 1, hop_length):
+        w = data[start:start+window_length].astype(float)
+        orientation = w.mean(axis=0)
+        energy = numpy.sqrt(numpy.sum((w - orientation) ** 2))
+        mag = numpy.linalg.norm(orientation)
+        norm = orientation / mag if mag > 0 else numpy.zeros(3)
+
+        features = [ min(energy, 32767) ] + list(norm * CASCADE_ORIENTATION_SCALE)
+        windows.append(numpy.trunc(features).astype(numpy.int16))
+
+    return numpy.array(windows, dtype=numpy.int16).reshape(-1, len(FEATURE_NAMES))
+
+
+def session_extents(labels, pad_start='30s', pad_end='30s'):
+    """
+    Start and end time of each session, padded. Same as apply_sessions() in software/dataset/combine.py
+    """
+    extents = []
+    for session, ll in labels.groupby('filename'):
+        s = ll['start_time'].min() - pandas.Timedelta(pad_start)
+        e = ll['end_time'].max() + pandas.Timedelta(pad_end)
+        extents.append((session, s, e))
+    return extents
+
+
+def load_windows(path, labels, positive_class='brushing', samplerate=50, window_length=50, hop_length=50):
+    """
+    Load har_record .npy files, and compute features for each window
+
+    labels are the annotations from read_session_labels() in software/dataset/combine.py.
+    Only windows inside a labeled session are used. A window is positive if its center
+    is inside an annotation of positive_class. Groups are the sessions
+    NOTE: the class in the filename is not used, "brushing" files also have idle periods
+    """
+    from software.dataset.combine import parse_har_record_filename
+
+    sessions = session_extents(labels)
+    positive = labels[labels['class'] == positive_class]
+    positive_start = positive['start_time'].values
+    positive_end = positive['end_time'].values
+
+    X = []
+    Y = []
+    groups = []
+    for f in sorted(os.listdir(path)):
+        if not f.endswith('.npy'):
+            continue
+        try:
+            data = numpy.load(os.path.join(path, f))
+        except ValueError as e:
+            # some recordings are truncated
+            print(f, e)
+            continue
+        features = compute_cascade_features(data[:, :3], window_length=window_length, hop_length=hop_length)
+
+        file_time = parse_har_record_filename(f)['time']
+        for i, window in enumerate(features):
+            offset = (i*hop_length + window_length/2) / samplerate
+            center = numpy.datetime64(file_time + pandas.Timedelta(seconds=offset))
+            session = [ n for n, s, e in sessions if s <= center <= e ]
+            if not session:
+                continue
+            X.append(window)
+            Y.append(int(numpy.any((positive_start <= center) & (center <= positive_end))))
+            groups.append(session[0])
+
+    return numpy.array(X, dtype=numpy.int16), numpy.array(Y), numpy.array(groups)
+
+
+def export_forest(estimator, n_features):
+    """
+    Convert a scikit-learn tree ensemble into emlearn trees structure
+
+    Leaves are the majority class. Thresholds are adjusted for integer features,
+    so x <= threshold in scikit-learn is the same as x < value in emlearn.
+    """
+    trees = dict(n_features=n_features, n_classes=len(estimator.classes_),
+        roots=[], leaves=[], nodes=[])
+
+    leaf_index = {}
+    def leaf(cls):
+        if cls not in leaf_index:
+            leaf_index[cls] = len(trees['leaves'])
+            trees['leaves'].append(cls)
+        return -leaf_index[cls] - 1
+
+    for e in estimator.estimators_:
+        t = e.tree_
+        offset = len(trees['nodes'])
+
+        def child(idx):
+            if t.children_left[idx] == -1:
+                return leaf(int(numpy.argmax(t.value[idx])))
+            return offset + node_ids[idx]
+
+        # only decision nodes are stored, leaves are references
+        node_ids = {}
+        for idx in range(t.node_count):
+            if t.children_left[idx] != -1:
+                node_ids[idx] = len(node_ids)
+
+        if not node_ids:
+            # tree is a single leaf. Store as node that always goes left
+            c = leaf(int(numpy.argmax(t.value[0])))
+            trees['roots'].append(len(trees['nodes']))
+            trees['nodes'].append((0, 32767.0, c, c))
+            continue
+
+        trees['roots'].append(offset)
+        for idx in sorted(node_ids, key=node_ids.get):
+            value = float(numpy.floor(t.threshold[idx]) + 1)
+            trees['nodes'].append((int(t.feature[idx]), value, child(t.children_left[idx]), child(t.children_right[idx])))
+
+    return trees
+
+
+def predict_proba(trees, X):
+    """
+    Probability of class 1, as vote fraction. Same as emlearn_trees
+    """
+    out = numpy.zeros(len(X))
+    for i, x in enumerate(X):
+        votes = 0
+        for root in trees['roots']:
+            idx = root
+            while idx >= 0:
+                feature, value, left, right = trees['nodes'][idx]
+                idx = left if x[feature] < value else right
+            votes += trees['leaves'][-idx-1]
+        out[i] = votes / len(trees['roots'])
+    return out
+
+
+def write_trees_csv(trees, path):
+    with open(path, 'w') as f:
+        f.write(f"f,{trees['n_features']}\n")
+        f.write(f"c,{trees['n_classes']}\n")
+        for leaf in trees['leaves']:
+            f.write(f"l,{leaf}\n")
+        for root in trees['roots']:
+            f.write(f"r,{root}\n")
+        for feature, value, left, right in trees['nodes']:
+            f.write(f"n,{feature},{value},{left},{right}\n")
+
+
+def parse():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Train first stage model for the cascade')
+
+    parser.add_argument('--data', type=str, default='data/jonnor-brushing-1/har_record',
+                        help='Path to directory with har_record .npy files')
+    parser.add_argument('--labels', type=str,
+                        default='data/jonnor-brushing-1/labels/project-7-at-2024-12-31-23-50-84589958.csv',
+                        help='Path to labels CSV file, exported from Label Studio')
+    parser.add_argument('--sessions', type=str, default='data/jonnor-brushing-1/videos.csv',
+                        help='Path sessions metadata file (CSV)')
+    parser.add_argument('--hop', type=float, default=1.0,
+                        help='Time between windows (seconds), for the brushing time estimate')
+    parser.add_argument('--out', type=str, default='firmware/brushing_stage1.trees.bin',
+                        help='Output path for binary model. CSV is written next to it')
+    parser.add_argument('--trees', type=int, default=10,
+                        help='Number of trees')
+    parser.add_argument('--depth', type=int, default=4,
+                        help='Maximum depth of trees')
+    parser.add_argument('--min-samples-leaf', type=int, default=30,
+                        help='Minimum number of windows in a leaf')
+    parser.add_argument('--band', type=float, nargs=2, default=(0.25, 0.75),
+                        help='Uncertainty band, probabilities inside go to the full model')
+
+    return parser.parse_args()
+
+
+def main():
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.model_selection import LeaveOneGroupOut
+    from software.dataset.combine import read_session_labels
+
+    args = parse()
+
+    labels = read_session_labels(args.labels, args.sessions)
+    X, Y, groups = load_windows(args.data, labels)
+    print(f"windows={len(X)} positive={Y.mean():.2f} sessions={len(set(groups))}")
+
+    # evaluate on each held-out session, then train final model on all
+    low, high = args.band
+    # balanced, so that confident decisions are not biased towards brushing, the majority class
+    est = RandomForestClassifier(n_estimators=args.trees, max_depth=args.depth,
+        min_samples_leaf=args.min_samples_leaf, class_weight='balanced', random_state=1)
+    for train, test in LeaveOneGroupOut().split(X, Y, groups):
+        est.fit(X[train], Y[train])
+        p = predict_proba(export_forest(est, X.shape[1]), X[test])
+
+        confident = (p <= low) | (p >= high)
+        correct = (p >= 0.5) == (Y[test] == 1)
+        # brushing time, if the full model is right on the windows passed to it
+        labeled_time = Y[test].sum() * args.hop
+        cascade_time = ((p >= 0.5) & confident).sum() * args.hop + Y[test][~confident].sum() * args.hop
+        print(f"test {groups[test][0]}: confident={confident.mean():.2f}"
+            f" accuracy-confident={correct[confident].mean():.3f} accuracy-all={correct.mean():.3f}"
+            f" brushing-time labeled={labeled_time:.0f}s cascade={cascade_time:.0f}s")
+
+    est.fit(X, Y)
+    trees = export_forest(est, X.shape[1])
+
+    with open(args.out, 'wb') as f:
+        f.write(encode_trees_binary(trees))
+    csv_path = args.out.replace('.bin', '.csv')
+    write_trees_csv(trees, csv_path)
+    print(f"Wrote {args.out} {csv_path} nodes={len(trees['nodes'])}")
+
+
+if __name__ == '__main__':
+    main()